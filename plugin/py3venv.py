@@ -3,10 +3,9 @@
 
 # Copyright (c) 2013 Masami HIRATA <msmhrt@gmail.com>
 
-import distutils
 import os
-import re
 import sys
+import time
 
 if sys.platform == "win32":
     BIN_PATH = "Scripts"
@@ -16,19 +15,428 @@ else:
     LIB_PATH = os.path.join("lib",
                             "python{0}.{1}".format(*sys.version_info))
 
+SITE_PACKAGES_PATH = os.path.join(LIB_PATH, "site-packages")
+
 AS_IS = object()
 NOT_FOUND = object()
 
-RE_VENV_HOME = re.compile(r"""(?xa)
-    \A\s*home\s*=\s*(?P<home>[^\r\n]+)""")
-RE_PYTHON_VERSION = re.compile(r"""(?xa)
-    \A\s*__version__\s*=\s*\"(?P<version>[^"]+)\"""")
+ACTIVATION_CACHE_VERSION = 3
+PROBE_CACHE_VERSION = 1
+PROBE_SCRIPT = """\
+import json
+import site
+import sys
+site_dirs = site.getsitepackages()
+if site.ENABLE_USER_SITE:
+    site_dirs.append(site.getusersitepackages())
+print(json.dumps({"path": sys.path[1:],
+                  "prefix": sys.prefix,
+                  "exec_prefix": sys.exec_prefix,
+                  "executable": sys.executable,
+                  "version": list(sys.version_info[:3]),
+                  "site_dirs": site_dirs}))
+"""
+SNAPSHOT_SYS_ATTRS = ("executable", "prefix", "exec_prefix", "path",
+                      "real_prefix")
+SNAPSHOT_ENVIRON = ("PATH", "VIRTUAL_ENV")
+
+VENV_POOL_SIZE = 8
+OPTIMIZE_SYSPATH = False
+USE_MODULE_INDEX = False
+MODULE_INDEX_VERSION = 1
+VENV_DIR_NAMES = (".venv", "venv")
+PROTECTED_MODULES = frozenset(["__main__", "vim", __name__])
+DISCOVERY_TTL = 2.0
+RESOLVER_MARKERS = ("pyproject.toml", "poetry.toml", "uv.lock", "Pipfile",
+                    ".venv", ".python-version")
+RESOLVER_ENVIRON = ("HOME", "USERPROFILE", "APPDATA", "LOCALAPPDATA",
+                    "XDG_CACHE_HOME", "XDG_CONFIG_HOME", "XDG_DATA_HOME",
+                    "POETRY_CACHE_DIR", "POETRY_CONFIG_DIR",
+                    "POETRY_VIRTUALENVS_PATH", "POETRY_VIRTUALENVS_IN_PROJECT",
+                    "WORKON_HOME", "PIPENV_VENV_IN_PROJECT",
+                    "PIPENV_CUSTOM_VENV_NAME", "UV_PROJECT_ENVIRONMENT",
+                    "PYENV_ROOT")
+PRELOAD_MODULES = ()
+TRACE_MEMORY = False
+WATCH_STAT_BUDGET = 16
+ZIP_SITE_PACKAGES = False
+ZIP_SNAPSHOT_VERSION = 1
+ZIP_PACKAGE_FILES = (".py", ".pyi", "py.typed")
+CATALOG_VERSION = 1
+CATALOG_ROOTS = ()
+PRECOMPILE_BYTECODE = False
+PRECOMPILE_WORKERS = 0
+PRECOMPILE_USER_CACHE = False
+PRECOMPILE_SCRIPT = (
+    "import os, runpy\n"
+    "if hasattr(os, 'nice'):\n"
+    "    os.nice(10)\n"
+    "runpy.run_module('compileall', run_name='__main__', alter_sys=True)\n")
+BASELINE_SYS_ATTRS = ("executable", "prefix", "exec_prefix", "path",
+                      "real_prefix", "_home", "__egginsert")
+BASELINE_ENVIRON = ("PATH", "VIRTUAL_ENV")
+
+_activation_done = False
+_activated_venv_prefix = None
+_current_venv_prefix = None
+_baseline_sys_state = None
+_baseline_sys_attrs = None
+_baseline_environ = None
+# Dicts keep insertion order, so the first key is the least recently used
+_venv_pool = {}
+_discovery_index = {}
+_resolver_cache = {}
+_pth_cache = {}
+_venv_layout_cache = {}
+_prognames = None
+_realpath_cache = {}
+_syspath_report = None
+_module_indexes = {}
+_preload_thread = None
+_preload_report = {}
+_watcher = None
+_pending_probe = None
+_precompile_report = None
+_saved_pycache_prefix = NOT_FOUND
+_zip_build_threads = {}
+_zip_snapshot_files = {}
+_catalog = None
+_current_profile = None
+_last_profile = None
 
 
 def get_venv_prefix():
     return os.environ.get("VIRTUAL_ENV")
 
 
+def is_venv_dir(path):
+    return (os.path.isfile(os.path.join(path, "pyvenv.cfg")) or
+            os.path.isfile(os.path.join(path, LIB_PATH, "orig-prefix.txt")))
+
+
+def find_local_venv(dir_path):
+    if is_venv_dir(dir_path):
+        return dir_path
+
+    for name in VENV_DIR_NAMES:
+        venv_prefix = os.path.join(dir_path, name)
+        if is_venv_dir(venv_prefix):
+            return venv_prefix
+
+    return None
+
+
+def lookup_local_venv(dir_path, now):
+    # entry: [mtime_ns of dir_path, time of last check, venv or None]
+    entry = _discovery_index.get(dir_path)
+    if entry is not None and now - entry[1] < DISCOVERY_TTL:
+        return entry[2]
+
+    try:
+        mtime = os.stat(dir_path).st_mtime_ns
+    except EnvironmentError:
+        mtime = None
+
+    if entry is not None and entry[0] == mtime:
+        entry[1] = now
+        return entry[2]
+
+    venv_prefix = None
+    if mtime is not None:
+        venv_prefix = find_local_venv(dir_path)
+    _discovery_index[dir_path] = [mtime, now, venv_prefix]
+    return venv_prefix
+
+
+def find_venv_prefix(dir_path):
+    try:
+        dir_path = os.path.abspath(dir_path)
+    except TypeError:
+        return None
+
+    now = time.monotonic()
+    while True:
+        venv_prefix = lookup_local_venv(dir_path, now)
+        if venv_prefix is None:
+            # lookup_local_venv() has just looked at the mtime of dir_path
+            venv_prefix = lookup_managed_venv(dir_path, now,
+                                              _discovery_index[dir_path][0])
+        if venv_prefix is not None:
+            return venv_prefix
+
+        parent_path = os.path.dirname(dir_path)
+        if parent_path == dir_path:
+            return None
+        dir_path = parent_path
+
+
+def clear_discovery_index():
+    _discovery_index.clear()
+    _resolver_cache.clear()
+
+
+def is_true_value(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return value is True
+
+
+def load_toml(path):
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            return None
+
+    try:
+        with open(path, "rb") as toml_file:
+            return tomllib.load(toml_file)
+    except (EnvironmentError, ValueError):
+        return None
+
+
+def get_toml_value(document, *keys):
+    for key in keys:
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+
+def make_path_hash(data, length):
+    import base64
+    import hashlib
+
+    digest = hashlib.sha256(data.encode("utf-8", "surrogateescape")).digest()
+    return base64.urlsafe_b64encode(digest[:length]).decode("ascii")[:8]
+
+
+def get_poetry_config_dir():
+    config_dir = os.environ.get("POETRY_CONFIG_DIR")
+    if config_dir:
+        return config_dir
+
+    if sys.platform == "win32":
+        return os.path.join(os.environ.get("APPDATA", ""), "pypoetry")
+    elif sys.platform == "darwin":
+        return os.path.expanduser(os.path.join(
+            "~", "Library", "Application Support", "pypoetry"))
+    return os.path.join(os.environ.get("XDG_CONFIG_HOME") or
+                        os.path.expanduser(os.path.join("~", ".config")),
+                        "pypoetry")
+
+
+def get_poetry_default_cache_dir():
+    if sys.platform == "win32":
+        return os.path.join(os.environ.get("LOCALAPPDATA", ""), "pypoetry",
+                            "Cache")
+    elif sys.platform == "darwin":
+        return os.path.expanduser(os.path.join("~", "Library", "Caches",
+                                               "pypoetry"))
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                        os.path.expanduser(os.path.join("~", ".cache")),
+                        "pypoetry")
+
+
+def make_poetry_env_name(name, project_dir):
+    import re
+
+    # Poetry passes the canonicalized name of the package to
+    # EnvManager.generate_env_name(), so "My.Project" is "my-project".
+    name = re.sub(r"[-_.]+", "-", name).lower()
+    sanitized_name = re.sub(r'[ $`!*@"\\\r\n\t]', "_", name)[:42]
+    normalized_path = os.path.normcase(os.path.realpath(project_dir))
+    return "{}-{}".format(sanitized_name,
+                          make_path_hash(normalized_path, 32))
+
+
+def resolve_poetry_venv(project_dir):
+    pyproject = load_toml(os.path.join(project_dir, "pyproject.toml"))
+    name = (get_toml_value(pyproject, "tool", "poetry", "name") or
+            get_toml_value(pyproject, "project", "name"))
+    if not isinstance(name, str) or not name:
+        return None
+
+    # Settings from the environment, then poetry.toml, then config.toml
+    configs = [load_toml(os.path.join(project_dir, "poetry.toml")),
+               load_toml(os.path.join(get_poetry_config_dir(),
+                                      "config.toml"))]
+
+    def get_setting(env_name, *keys):
+        value = os.environ.get(env_name)
+        for config in configs:
+            if value is not None:
+                break
+            value = get_toml_value(config, *keys)
+        return value
+
+    if is_true_value(get_setting("POETRY_VIRTUALENVS_IN_PROJECT",
+                                 "virtualenvs", "in-project")):
+        venv_prefix = os.path.join(project_dir, ".venv")
+        return venv_prefix if is_venv_dir(venv_prefix) else None
+
+    cache_dir = get_setting("POETRY_CACHE_DIR", "cache-dir")
+    if not isinstance(cache_dir, str):
+        cache_dir = get_poetry_default_cache_dir()
+    virtualenvs_path = get_setting("POETRY_VIRTUALENVS_PATH",
+                                   "virtualenvs", "path")
+    if not isinstance(virtualenvs_path, str):
+        virtualenvs_path = os.path.join("{cache-dir}", "virtualenvs")
+    virtualenvs_path = os.path.expanduser(
+        virtualenvs_path.replace("{cache-dir}", cache_dir))
+
+    # envs.toml records the Python version selected by 'poetry env use'
+    env_name = make_poetry_env_name(name, project_dir)
+    minor = get_toml_value(
+        load_toml(os.path.join(virtualenvs_path, "envs.toml")),
+        env_name, "minor")
+    if not isinstance(minor, str):
+        minor = "{0}.{1}".format(*sys.version_info)
+
+    venv_prefix = os.path.join(virtualenvs_path,
+                               "{}-py{}".format(env_name, minor))
+    return venv_prefix if is_venv_dir(venv_prefix) else None
+
+
+def get_pipenv_workon_home():
+    workon_home = os.environ.get("WORKON_HOME")
+    if not workon_home:
+        if sys.platform == "win32":
+            workon_home = os.path.join("~", ".virtualenvs")
+        else:
+            workon_home = os.path.join(
+                os.environ.get("XDG_DATA_HOME") or
+                os.path.join("~", ".local", "share"),
+                "virtualenvs")
+    return os.path.expanduser(workon_home)
+
+
+def make_pipenv_env_name(project_dir):
+    import re
+
+    # Same as Project.virtualenv_name of Pipenv
+    sanitized_name = re.sub(r'[ &$`!*@"()\[\]\\\r\n\t]', "_",
+                            os.path.basename(project_dir))[:42]
+    pipfile_path = os.path.normcase(os.path.realpath(
+        os.path.join(project_dir, "Pipfile")))
+    return "{}-{}".format(sanitized_name, make_path_hash(pipfile_path, 6))
+
+
+def resolve_pipenv_venv(project_dir):
+    if not os.path.isfile(os.path.join(project_dir, "Pipfile")):
+        return None
+
+    venv_prefix = os.path.join(project_dir, ".venv")
+    if is_true_value(os.environ.get("PIPENV_VENV_IN_PROJECT")):
+        return venv_prefix if is_venv_dir(venv_prefix) else None
+
+    workon_home = get_pipenv_workon_home()
+    env_name = os.environ.get("PIPENV_CUSTOM_VENV_NAME")
+    if not env_name and os.path.isfile(venv_prefix):
+        # A .venv file names the venv in WORKON_HOME or gives its path
+        try:
+            with open(venv_prefix, encoding="utf-8") as venv_file:
+                env_name = venv_file.read().strip()
+        except (EnvironmentError, ValueError):
+            env_name = None
+    if not env_name:
+        env_name = make_pipenv_env_name(project_dir)
+
+    venv_prefix = os.path.join(workon_home, os.path.expanduser(env_name))
+    return venv_prefix if is_venv_dir(venv_prefix) else None
+
+
+def resolve_uv_venv(project_dir):
+    if not (os.path.isfile(os.path.join(project_dir, "uv.lock")) or
+            os.path.isfile(os.path.join(project_dir, "pyproject.toml"))):
+        return None
+
+    venv_prefix = os.environ.get("UV_PROJECT_ENVIRONMENT") or ".venv"
+    venv_prefix = os.path.join(project_dir, os.path.expanduser(venv_prefix))
+    return venv_prefix if is_venv_dir(venv_prefix) else None
+
+
+def resolve_pyenv_venv(project_dir):
+    try:
+        with open(os.path.join(project_dir, ".python-version"),
+                  encoding="utf-8") as version_file:
+            version_names = version_file.read().split()
+    except (EnvironmentError, ValueError):
+        return None
+
+    pyenv_root = os.path.expanduser(os.environ.get("PYENV_ROOT") or
+                                    os.path.join("~", ".pyenv"))
+    for version_name in version_names:
+        if version_name.startswith("#") or version_name == "system":
+            continue
+        # versions/<name> is a link to versions/<version>/envs/<name>
+        venv_prefix = os.path.join(pyenv_root, "versions", version_name)
+        if is_venv_dir(venv_prefix):
+            return venv_prefix
+
+    return None
+
+
+VENV_RESOLVERS = (resolve_uv_venv, resolve_poetry_venv, resolve_pipenv_venv,
+                  resolve_pyenv_venv)
+
+
+def get_resolver_environ():
+    return tuple(os.environ.get(name) for name in RESOLVER_ENVIRON)
+
+
+def make_resolver_stamp(dir_path):
+    mtimes = []
+    for name in RESOLVER_MARKERS:
+        try:
+            mtimes.append(os.stat(os.path.join(dir_path, name)).st_mtime_ns)
+        except EnvironmentError:
+            mtimes.append(None)
+    return (tuple(mtimes), get_resolver_environ())
+
+
+def resolve_managed_venv(dir_path):
+    for resolver in VENV_RESOLVERS:
+        venv_prefix = resolver(dir_path)
+        if venv_prefix is not None:
+            return venv_prefix
+
+    return None
+
+
+def lookup_managed_venv(dir_path, now, dir_mtime=NOT_FOUND):
+    # entry: [stamp of markers and settings, time of last check, venv,
+    #         mtime_ns of dir_path]
+    entry = _resolver_cache.get(dir_path)
+    if entry is not None and now - entry[1] < DISCOVERY_TTL:
+        return entry[2]
+
+    # Markers can't appear without changing the mtime of dir_path, so
+    # a directory which had none isn't looked at again.
+    if (entry is not None and entry[2] is None and
+            dir_mtime is not NOT_FOUND and entry[3] == dir_mtime and
+            not any(mtime is not None for mtime in entry[0][0]) and
+            entry[0][1] == get_resolver_environ()):
+        entry[1] = now
+        return None
+
+    stamp = make_resolver_stamp(dir_path)
+    if entry is not None and entry[0] == stamp:
+        entry[1] = now
+        if entry[2] is not None and is_venv_dir(entry[2]):
+            return entry[2]
+    if not any(mtime is not None for mtime in stamp[0]):
+        # Not a project directory of any tool
+        _resolver_cache[dir_path] = [stamp, now, None, dir_mtime]
+        return None
+
+    venv_prefix = resolve_managed_venv(dir_path)
+    _resolver_cache[dir_path] = [stamp, now, venv_prefix, dir_mtime]
+    return venv_prefix
+
+
 def is_venv_activated():
     # venv module has been added in Python 3.3
     if sys.version_info < (3, 3):
@@ -47,107 +455,250 @@ def is_venv_activated():
     return activated
 
 
-def make_pyvenv_cfg_path(venv_prefix=None):
+def scan_dir_entries(path):
+    # name -> True for (links to) files, False for anything else
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name: entry.is_file() for entry in entries}
+    except (EnvironmentError, TypeError, ValueError):
+        return None
+
+
+class VenvLayout:
+    __slots__ = ("prefix", "prefix_entries", "bin_entries", "lib_entries")
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.prefix_entries = scan_dir_entries(prefix) or {}
+        self.bin_entries = {}
+        if BIN_PATH in self.prefix_entries:
+            self.bin_entries = scan_dir_entries(
+                os.path.join(prefix, BIN_PATH)) or {}
+        self.lib_entries = None
+        if LIB_PATH.split(os.sep)[0] in self.prefix_entries:
+            self.lib_entries = scan_dir_entries(
+                os.path.join(prefix, LIB_PATH))
+
+    def has_pyvenv_cfg(self):
+        return self.prefix_entries.get("pyvenv.cfg", False)
+
+    def has_lib_path(self):
+        return self.lib_entries is not None
+
+    def has_orig_prefix_txt(self):
+        return (self.lib_entries is not None and
+                self.lib_entries.get("orig-prefix.txt", False))
+
+    def has_activate_this(self):
+        return self.bin_entries.get("activate_this.py", False)
+
+    def find_executable(self):
+        for progname in make_prognames():
+            if self.bin_entries.get(progname, False):
+                return os.path.abspath(os.path.join(self.prefix, BIN_PATH,
+                                                    progname))
+        return None
+
+
+def get_venv_layout(venv_prefix=None, refresh=False):
     if venv_prefix is None:
         venv_prefix = get_venv_prefix()
         if venv_prefix is None:
             return None
 
+    if not refresh:
+        venv_layout = _venv_layout_cache.get(venv_prefix)
+        if venv_layout is not None:
+            return venv_layout
+
     try:
-        pyvenv_cfg_path = os.path.join(venv_prefix, "pyvenv.cfg")
+        os.fspath(venv_prefix)
     except TypeError:
-        pyvenv_cfg_path = None
+        return None
 
-    return pyvenv_cfg_path
+    venv_layout = VenvLayout(venv_prefix)
+    _venv_layout_cache[venv_prefix] = venv_layout
+    return venv_layout
 
 
-def get_venv_original_prefix(venv_prefix=None):
-    pyvenv_cfg_path = make_pyvenv_cfg_path(venv_prefix)
-    if pyvenv_cfg_path is None:
+def clear_venv_layout_cache():
+    _venv_layout_cache.clear()
+
+
+def make_pyvenv_cfg_path(venv_prefix=None):
+    venv_layout = get_venv_layout(venv_prefix)
+    if venv_layout is None or not venv_layout.has_pyvenv_cfg():
+        return None
+
+    return os.path.join(venv_layout.prefix, "pyvenv.cfg")
+
+
+class VenvInfo:
+    __slots__ = ("prefix", "home", "version", "version_info",
+                 "include_system_site_packages", "executable")
+
+    def __init__(self, prefix, home=None, version=None,
+                 include_system_site_packages=False, executable=None):
+        self.prefix = prefix
+        self.home = home
+        self.version = version
+        self.version_info = parse_version(version)
+        self.include_system_site_packages = include_system_site_packages
+        self.executable = executable
+
+    def __repr__(self):
+        return "{}(prefix={!r}, home={!r}, version={!r})".format(
+            type(self).__name__, self.prefix, self.home, self.version)
+
+
+_venv_info_cache = {}
+
+
+def clear_venv_info_cache():
+    _venv_info_cache.clear()
+
+
+def forget_venv(venv_prefix):
+    _venv_info_cache.pop(("venv", venv_prefix), None)
+    _venv_info_cache.pop(("virtualenv", venv_prefix), None)
+    _venv_layout_cache.pop(venv_prefix, None)
+
+
+def parse_version(version):
+    if version is None:
+        return None
+    elif type(version) in (tuple, list):
+        # e.g. sys.version_info[:3] which has gone through JSON
+        return tuple(version) or None
+
+    version_info = []
+    for part in str(version).split("."):
+        if not part.isdigit():
+            break
+        version_info.append(int(part))
+
+    if not version_info:
         return None
+    return tuple(version_info)
 
-    original_prefix = None
+
+def parse_pyvenv_cfg(pyvenv_cfg_path):
+    # Same format as parsed by venv() in the site module
+    config = {}
     try:
         # 'pyvenv.cfg' is written in UTF-8
         with open(pyvenv_cfg_path, encoding='utf-8') as pyvenv_cfg_file:
             for line in pyvenv_cfg_file:
-                match = RE_VENV_HOME.match(line)
-                if match is not None:
-                    original_prefix = match.groupdict().get("home")
-                    break
-    except EnvironmentError:
-        pass
+                key, sep, value = line.partition("=")
+                if sep:
+                    config[key.strip().lower()] = value.strip()
+    except (EnvironmentError, TypeError):
+        return None
 
-    if original_prefix is not None and sys.platform != "win32":
-        # /original/prefix/bin -> /original/prefix
-        original_prefix = os.path.dirname(original_prefix)
-    return original_prefix
+    return config
 
 
-def make_distutils_path(prefix):
-    if prefix is None:
-        return None
+def make_original_prefix(home):
+    if home is None or sys.platform == "win32":
+        return home
 
-    try:
-        distutils_path = os.path.join(prefix,
-                                      LIB_PATH,
-                                      "distutils",
-                                      "__init__.py")
-    except TypeError:
-        distutils_path = None
+    # /original/prefix/bin -> /original/prefix
+    return os.path.dirname(home)
+
+
+def get_venv_info(venv_prefix=None):
+    if venv_prefix is None:
+        venv_prefix = get_venv_prefix()
+        if venv_prefix is None:
+            return None
+
+    key = ("venv", venv_prefix)
+    if key in _venv_info_cache:
+        return _venv_info_cache[key]
+
+    venv_info = None
+    config = parse_pyvenv_cfg(make_pyvenv_cfg_path(venv_prefix))
+    if config is not None:
+        home = config.get("home")
+        # 'version' is written by venv, 'version_info' by virtualenv
+        version = config.get("version", config.get("version_info"))
+        if version is None:
+            version = get_python_version(make_original_prefix(home))
+        include_system_site_packages = config.get(
+            "include-system-site-packages", "false").lower() == "true"
+        executable = config.get("executable",
+                                config.get("base-executable"))
+        venv_info = VenvInfo(venv_prefix, home, version,
+                             include_system_site_packages, executable)
+
+    _venv_info_cache[key] = venv_info
+    return venv_info
+
+
+def get_venv_original_prefix(venv_prefix=None):
+    venv_info = get_venv_info(venv_prefix)
+    if venv_info is None:
+        return None
 
-    return distutils_path
+    return make_original_prefix(venv_info.home)
 
 
 def get_python_version(prefix):
-    distutils_path = make_distutils_path(prefix)
-    if distutils_path is None:
+    if prefix is None:
         return None
 
-    python_version = None
     try:
-        # Using ISO/IEC 8859-1 just in case.
-        with open(distutils_path, encoding='iso8859-1') as distutils_file:
-            for line in distutils_file:
-                match = RE_PYTHON_VERSION.match(line)
-                if match is not None:
-                    python_version = match.groupdict().get("version")
-    except EnvironmentError:
-        pass
+        prefix = os.path.normcase(os.path.abspath(prefix))
+    except TypeError:
+        return None
+
+    # The running interpreter knows its own version
+    for base_prefix in (getattr(sys, "base_prefix", sys.prefix),
+                        sys.prefix):
+        if prefix == os.path.normcase(os.path.abspath(base_prefix)):
+            return "{0}.{1}.{2}".format(*sys.version_info)
 
-    return python_version
+    # Otherwise only the major and minor versions can be told apart
+    # without running the interpreter in that prefix.
+    if os.path.isdir(os.path.join(prefix, LIB_PATH)):
+        return "{0}.{1}".format(*sys.version_info)
+
+    return None
 
 
 def get_venv_version(venv_prefix=None):
-    original_prefix = get_venv_original_prefix(venv_prefix)
-    if original_prefix is None:
+    venv_info = get_venv_info(venv_prefix)
+    if venv_info is None:
         return None
 
-    return get_python_version(original_prefix)
+    return venv_info.version
 
 
 def is_valid_version(version):
-    current_version = distutils.__version__
-    if version != current_version:
+    version_info = parse_version(version)
+    if version_info is None:
         return False
-    return True
 
+    # pyvenv.cfg records the micro version the venv was created with,
+    # while bin/python follows in-place patch upgrades of the base.
+    version_info = version_info[:2]
+    return version_info == tuple(sys.version_info[:len(version_info)])
 
-def is_valid_lib_path(venv_prefix=None):
-    if venv_prefix is None:
-        venv_prefix = get_venv_prefix()
-        if venv_prefix is None:
-            return False
 
-    try:
-        lib_path = os.path.join(venv_prefix, LIB_PATH)
-    except TypeError:
+def is_valid_lib_path(venv_prefix=None):
+    venv_layout = get_venv_layout(venv_prefix)
+    if venv_layout is None:
         return False
 
-    return os.path.isdir(lib_path)
+    return venv_layout.has_lib_path()
 
 
 def make_prognames():
+    global _prognames
+
+    if _prognames is not None:
+        return _prognames
+
     if sys.platform == "win32":
         prognames = ["python.exe"]
     else:
@@ -159,30 +710,53 @@ def make_prognames():
                 sys.abiflags is not None and sys.abiflags != ""):
             prognames.append("python{0}.{1}".format(*sys.version_info) +
                              sys.abiflags)
+    _prognames = prognames
     return prognames
 
 
 def make_venv_executable_path(venv_prefix=None):
-    if venv_prefix is None:
-        venv_prefix = get_venv_prefix()
-        if venv_prefix is None:
-            return None
+    venv_layout = get_venv_layout(venv_prefix)
+    if venv_layout is None:
+        return None
 
-    venv_executable_path = None
-    try:
-        for progname in make_prognames():
-            path = os.path.join(venv_prefix, BIN_PATH, progname)
-            path = os.path.abspath(path)
-            if os.path.isfile(path):
-                venv_executable_path = path
-                break
-    except TypeError:
-        pass
+    return venv_layout.find_executable()
 
-    return venv_executable_path
 
+def make_base_syspath():
+    # The module search path that Py_GetPath() would compute for the
+    # running interpreter.  The venv's site-packages is added later by
+    # site.main().
+    syspath = []
+    if not sys.flags.ignore_environment:
+        pythonpath = os.environ.get("PYTHONPATH", "")
+        syspath.extend(path for path in pythonpath.split(os.pathsep)
+                       if path)
 
-def reset_syspath():
+    base_prefix = getattr(sys, "base_prefix", sys.prefix)
+    base_exec_prefix = getattr(sys, "base_exec_prefix", sys.exec_prefix)
+    zip_name = "python{0}{1}.zip".format(*sys.version_info)
+    if sys.platform == "win32":
+        stdlib_path = os.path.join(base_prefix, LIB_PATH)
+        syspath.extend([os.path.join(base_prefix, zip_name),
+                        os.path.join(base_exec_prefix, "DLLs"),
+                        stdlib_path])
+    else:
+        platlibdir = getattr(sys, "platlibdir", "lib")
+        stdlib_name = "python{0}.{1}".format(*sys.version_info)
+        stdlib_path = os.path.join(base_prefix, platlibdir, stdlib_name)
+        syspath.extend([os.path.join(base_prefix, platlibdir, zip_name),
+                        stdlib_path,
+                        os.path.join(base_exec_prefix, platlibdir,
+                                     stdlib_name, "lib-dynload")])
+
+    # e.g. a zip-only stdlib of an embedded interpreter
+    if not os.path.isfile(os.path.join(stdlib_path, "os.py")):
+        return None
+
+    return syspath
+
+
+def reset_syspath_with_ctypes():
     # id(sys.path) must not be changed.
     original_syspath = sys.path
     try:
@@ -204,9 +778,23 @@ def reset_syspath():
     except (ImportError, AttributeError, EnvironmentError) as exception:
         error = exception
 
+    # Py_GetPath() and PySys_SetPath() have been removed from recent
+    # Python, so sys.path may have been deleted without being reset.
+    sys.path = original_syspath
     return error
 
 
+def reset_syspath():
+    syspath = make_base_syspath()
+    if syspath is None:
+        # ctypes is only the last resort
+        return reset_syspath_with_ctypes()
+
+    # id(sys.path) must not be changed.
+    sys.path[:] = syspath
+    return None
+
+
 def get_vim_special_path():
     vim_special_path = None
     try:
@@ -286,147 +874,2631 @@ def recover_sys_attrs(saved_sys_attrs, sys=sys):
             setattr(sys, attr_name, saved_attr)
 
 
-def activate_venv(venv_prefix=None, force=False):
-    if venv_prefix is None:
-        venv_prefix = get_venv_prefix()
-        if venv_prefix is None:
-            return None
-
-    venv_version = get_venv_version(venv_prefix)
-    if not (force or (is_valid_version(venv_version) and
-                      is_venv_activated())):
+def scan_pth_file(sitedir, name, makepath):
+    fullname = os.path.join(sitedir, name)
+    entries = []
+    imports = []
+    try:
+        # site module reads .pth files in the locale encoding
+        with open(fullname) as pth_file:
+            for line in pth_file:
+                if line.startswith("#") or line.strip() == "":
+                    continue
+                if line.startswith(("import ", "import\t")):
+                    imports.append(line.rstrip())
+                    continue
+                entries.append(list(makepath(sitedir, line.rstrip())))
+    except (EnvironmentError, UnicodeDecodeError, ValueError):
         return None
 
-    venv_executable_path = make_venv_executable_path(venv_prefix)
-    if venv_executable_path is None:
-        return None
+    return {"entries": entries, "imports": imports,
+            "has_import": bool(imports)}
 
-    # Fix attributes in sys module
-    new_sys_attrs = {"__egginsert": NOT_FOUND,
-                     "_home": NOT_FOUND,
-                     "executable": venv_executable_path,
-                     "modules": AS_IS,
-                     "path": AS_IS}
-    saved_sys_attrs = fix_sys_attrs(new_sys_attrs)
 
-    # Save vim_special_path before calling reset_syspath()
-    vim_special_path = get_vim_special_path()
+def load_pth_info(sitedir, name, makepath):
+    fullname = os.path.join(sitedir, name)
+    fingerprint = get_stat_fingerprint(fullname)
+    cached = _pth_cache.get(fullname)
+    if (fingerprint is not None and cached is not None and
+            cached["fingerprint"] == fingerprint):
+        return cached
 
-    error = reset_syspath()
-    if error is not None:
-        recover_sys_attrs(saved_sys_attrs)
-        return None
+    pth_info = None
+    if fingerprint is not None:
+        pth_info = scan_pth_file(sitedir, name, makepath)
+    if pth_info is None:
+        _pth_cache.pop(fullname, None)
+    else:
+        pth_info["fingerprint"] = fingerprint
+        _pth_cache[fullname] = pth_info
+    return pth_info
+
+
+def find_pth_imports(site_dirs):
+    import site
+
+    # [[path of .pth file, [import line, ...]], ...] in the order
+    # site.addsitedir() runs them
+    pth_imports = []
+    for sitedir in site_dirs:
+        try:
+            names = sorted(name for name in os.listdir(sitedir)
+                           if name.endswith(".pth"))
+        except (EnvironmentError, TypeError):
+            continue
+
+        for name in names:
+            pth_info = load_pth_info(sitedir, name, site.makepath)
+            if pth_info is not None and pth_info["imports"]:
+                pth_imports.append([os.path.join(sitedir, name),
+                                    pth_info["imports"]])
+
+    return pth_imports
+
+
+def run_pth_imports(pth_imports):
+    # The import lines of .pth files as site.addpackage() runs them, for
+    # a search path which has been set up without site.main().
+    for fullname, lines in pth_imports:
+        for line in lines:
+            try:
+                exec(line, {"__name__": "site"})
+            except Exception as exception:
+                print("Error processing {}: {!r}".format(fullname,
+                                                         exception),
+                      file=sys.stderr)
+                break
 
-    # Call main() of site module in new module search path
-    try:
-        if "site" in sys.modules:
-            del(sys.modules["site"])
-        import site
-        site.main()
-    except ImportError:
-        recover_sys_attrs(saved_sys_attrs)
-        return None
 
-    if vim_special_path is not None and vim_special_path not in sys.path:
-        sys.path.append(vim_special_path)
+def make_cached_addpackage(site):
+    original_addpackage = site.addpackage
 
-    return venv_prefix
+    def addpackage(sitedir, name, known_paths):
+        cached = _pth_cache.get(os.path.join(sitedir, name))
+        pth_info = load_pth_info(sitedir, name, site.makepath)
+        if (known_paths is not None and pth_info is not None and
+                pth_info is cached and not pth_info["has_import"]):
+            # Replay a pure-path .pth file without reading it again
+            for dir_path, dircase in cached["entries"]:
+                if dircase not in known_paths and os.path.exists(dir_path):
+                    sys.path.append(dir_path)
+                    known_paths.add(dircase)
+            return known_paths
 
+        return original_addpackage(sitedir, name, known_paths)
 
-def get_orig_prefix_txt_path(venv_prefix=None):
-    if venv_prefix is None:
-        venv_prefix = get_venv_prefix()
-        if venv_prefix is None:
-            return None
+    addpackage.__wrapped__ = original_addpackage
+    return addpackage
 
-    try:
-        orig_prefix_path = os.path.join(venv_prefix,
-                                        LIB_PATH,
-                                        "orig-prefix.txt")
-    except TypeError:
-        orig_prefix_path = None
 
-    return orig_prefix_path
+def journal_module(journal, name):
+    # Keep only the first, i.e. the original, entry of each module
+    journal.setdefault(name, sys.modules.get(name, NOT_FOUND))
 
 
-def get_virtualenv_original_prefix(venv_prefix=None):
-    orig_prefix_txt_path = get_orig_prefix_txt_path(venv_prefix)
-    if orig_prefix_txt_path is None:
-        return None
+def rollback_modules(journal, failed_syspath):
+    for name, module in journal.items():
+        if module is NOT_FOUND:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
 
-    original_prefix = None
-    try:
-        # 'orig-prefix.txt' is written in UTF-8
-        with open(orig_prefix_txt_path,
-                  encoding='utf-8') as orig_prefix_txt_file:
-            original_prefix = orig_prefix_txt_file.readline()
-    except EnvironmentError:
-        pass
+    # Modules imported from the entries which have been rolled back
+    return reconcile_modules(failed_syspath)
 
-    return original_prefix
 
+def run_site_main(journal=None):
+    if journal is not None:
+        journal_module(journal, "site")
+    if "site" in sys.modules:
+        del(sys.modules["site"])
+    import site
 
-def get_virtualenv_version(venv_prefix=None):
-    original_prefix = get_virtualenv_original_prefix(venv_prefix)
-    if original_prefix is None:
-        return None
+    # site.addsitedir() looks addpackage() up in the module globals
+    site.addpackage = make_cached_addpackage(site)
+    site.main()
+    return site
 
-    return get_python_version(original_prefix)
 
+def clear_pth_cache():
+    _pth_cache.clear()
 
-def get_virtualenv_activate_this_path(venv_prefix=None):
-    if venv_prefix is None:
-        venv_prefix = get_venv_prefix()
-        if venv_prefix is None:
-            return None
 
-    try:
-        path = os.path.join(venv_prefix, BIN_PATH, "activate_this.py")
-        virtualenv_activate_path = os.path.abspath(path)
-    except TypeError:
-        virtualenv_activate_path = None
+class ProfileSpan:
+    __slots__ = ("profile", "phase", "path", "elapsed", "_started")
 
-    return virtualenv_activate_path
+    def __init__(self, profile, phase, path):
+        self.profile = profile
+        self.phase = phase
+        self.path = path
+        self.elapsed = None
 
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
 
-def activate_virtualenv(venv_prefix=None, force=False):
-    if venv_prefix is None:
-        venv_prefix = get_venv_prefix()
-        if venv_prefix is None:
-            return None
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.perf_counter() - self._started
+        if self.profile is not None:
+            self.profile.spans.append(self)
+        return False
 
-    virtualenv_version = get_virtualenv_version(venv_prefix)
-    if not force and not is_valid_version(virtualenv_version):
+    def as_dict(self):
+        return {"phase": self.phase,
+                "path": self.path,
+                "elapsed": self.elapsed}
+
+
+class ActivationProfile:
+    def __init__(self, venv_prefix):
+        self.venv_prefix = venv_prefix
+        self.timestamp = time.time()
+        self.spans = []
+        self.rejections = []
+        self.result = None
+        self.elapsed = None
+        self._started = time.perf_counter()
+
+    def finish(self, result):
+        self.result = result
+        self.elapsed = time.perf_counter() - self._started
+
+    def as_dict(self):
+        return {"venv_prefix": self.venv_prefix,
+                "timestamp": self.timestamp,
+                "result": self.result,
+                "elapsed": self.elapsed,
+                "spans": [span.as_dict() for span in self.spans],
+                "rejections": self.rejections}
+
+    def format(self):
+        lines = ["py3venv: {} -> {} ({:.3f} ms)".format(
+            self.venv_prefix, self.result, (self.elapsed or 0.0) * 1000)]
+        for span in self.spans:
+            lines.append("  {:<12} {:<24} {:9.3f} ms".format(
+                span.path, span.phase, span.elapsed * 1000))
+        for rejection in self.rejections:
+            lines.append("  {:<12} rejected: {}".format(rejection["path"],
+                                                        rejection["reason"]))
+        return "\n".join(lines)
+
+
+def begin_activation_profile(venv_prefix):
+    global _current_profile
+
+    # Nested calls record their spans into the outermost profile
+    if _current_profile is not None:
         return None
 
-    activate_this_path = get_virtualenv_activate_this_path(venv_prefix)
-    if activate_this_path is None:
-        return None
+    _current_profile = ActivationProfile(venv_prefix)
+    return _current_profile
 
-    new_venv_prefix = None
-    try:
-        # Using ISO/IEC 8859-1 just in case.
-        with open(activate_this_path, encoding='iso8859-1') as activate_file:
-            activate_source = activate_file.read()
-        exec(activate_source, dict(__file__=activate_this_path))
-        new_venv_prefix = venv_prefix
-    except EnvironmentError:
-        pass
 
-    return new_venv_prefix
+def end_activation_profile(profile, result):
+    global _current_profile, _last_profile
 
+    if profile is None:
+        return
 
-def activate(venv_prefix=None):
-    if venv_prefix is None:
-        venv_prefix = get_venv_prefix()
-        if venv_prefix is None:
-            return None
+    profile.finish(result)
+    _current_profile = None
+    _last_profile = profile
 
-    if not is_valid_lib_path(venv_prefix):
-        return None
 
-    new_venv_prefix = activate_venv(venv_prefix)
-    if new_venv_prefix is None:
-        new_venv_prefix = activate_virtualenv(venv_prefix)
+def profile_span(phase, path):
+    return ProfileSpan(_current_profile, phase, path)
+
+
+def reject_activation(path, reason):
+    if _current_profile is not None:
+        _current_profile.rejections.append({"path": path, "reason": reason})
+    return None
+
+
+def get_activation_profile():
+    if _last_profile is None:
+        return None
+
+    return _last_profile.as_dict()
+
+
+def format_activation_profile():
+    if _last_profile is None:
+        return "py3venv: no activation has been profiled"
+
+    return _last_profile.format()
+
+
+def write_activation_profile(path):
+    import json
+
+    if _last_profile is None:
+        return False
+
+    line = json.dumps(_last_profile.as_dict(), sort_keys=True) + "\n"
+    try:
+        # A single write() of a line keeps concurrent appends intact
+        with open(path, "a", encoding="utf-8") as profile_file:
+            profile_file.write(line)
+    except EnvironmentError:
+        return False
+
+    return True
+
+
+def activate_venv(venv_prefix=None, force=False, check_activated=True):
+    profile = begin_activation_profile(venv_prefix)
+    new_venv_prefix = None
+    try:
+        new_venv_prefix = _activate_venv(venv_prefix, force,
+                                         check_activated)
+    finally:
+        end_activation_profile(profile, new_venv_prefix)
+
+    return new_venv_prefix
+
+
+def _activate_venv(venv_prefix, force, check_activated):
+    if venv_prefix is None:
+        venv_prefix = get_venv_prefix()
+        if venv_prefix is None:
+            return reject_activation("venv", "no venv prefix")
+
+    with profile_span("read_pyvenv_cfg", "venv"):
+        venv_info = get_venv_info(venv_prefix)
+
+    with profile_span("check_version", "venv"):
+        venv_version_info = None
+        if venv_info is not None:
+            venv_version_info = venv_info.version_info
+        valid_version = is_valid_version(venv_version_info)
+        venv_activated = not check_activated or is_venv_activated()
+    if not force:
+        if venv_info is None:
+            return reject_activation("venv", "no pyvenv.cfg")
+        elif not valid_version:
+            return reject_activation("venv", "version mismatch")
+        elif not venv_activated:
+            return reject_activation("venv", "venv is not activated")
+
+    with profile_span("find_executable", "venv"):
+        venv_executable_path = make_venv_executable_path(venv_prefix)
+    if venv_executable_path is None:
+        return reject_activation("venv", "no executable")
+
+    # Fix attributes in sys module
+    with profile_span("fix_sys_attrs", "venv"):
+        new_sys_attrs = {"__egginsert": NOT_FOUND,
+                         "_home": NOT_FOUND,
+                         "executable": venv_executable_path,
+                         "path": AS_IS}
+        saved_sys_attrs = fix_sys_attrs(new_sys_attrs)
+        # Only the entries of sys.modules replaced by activation are
+        # saved instead of a copy of the whole dict.
+        modules_journal = {}
+
+        # Save vim_special_path before calling reset_syspath()
+        vim_special_path = get_vim_special_path()
+
+    with profile_span("reset_syspath", "venv"):
+        error = reset_syspath()
+    if error is not None:
+        failed_syspath = sys.path[:]
+        recover_sys_attrs(saved_sys_attrs)
+        rollback_modules(modules_journal, failed_syspath)
+        return reject_activation("venv",
+                                 "reset_syspath() failed: {}".format(error))
+
+    # Call main() of site module in new module search path
+    with profile_span("site_main", "venv"):
+        try:
+            run_site_main(modules_journal)
+            error = None
+        except ImportError as exception:
+            error = exception
+    if error is not None:
+        failed_syspath = sys.path[:]
+        recover_sys_attrs(saved_sys_attrs)
+        rollback_modules(modules_journal, failed_syspath)
+        return reject_activation("venv",
+                                 "site.main() failed: {}".format(error))
+
+    if vim_special_path is not None and vim_special_path not in sys.path:
+        sys.path.append(vim_special_path)
+
+    return venv_prefix
+
+
+def get_orig_prefix_txt_path(venv_prefix=None):
+    venv_layout = get_venv_layout(venv_prefix)
+    if venv_layout is None or not venv_layout.has_orig_prefix_txt():
+        return None
+
+    return os.path.join(venv_layout.prefix, LIB_PATH, "orig-prefix.txt")
+
+
+def get_virtualenv_info(venv_prefix=None):
+    if venv_prefix is None:
+        venv_prefix = get_venv_prefix()
+        if venv_prefix is None:
+            return None
+
+    key = ("virtualenv", venv_prefix)
+    if key in _venv_info_cache:
+        return _venv_info_cache[key]
+
+    venv_info = None
+    orig_prefix_txt_path = get_orig_prefix_txt_path(venv_prefix)
+    if orig_prefix_txt_path is not None:
+        try:
+            # 'orig-prefix.txt' is written in UTF-8
+            with open(orig_prefix_txt_path,
+                      encoding='utf-8') as orig_prefix_txt_file:
+                original_prefix = orig_prefix_txt_file.readline().rstrip()
+        except EnvironmentError:
+            original_prefix = None
+
+        if original_prefix:
+            venv_info = VenvInfo(venv_prefix, original_prefix,
+                                 get_python_version(original_prefix))
+
+    _venv_info_cache[key] = venv_info
+    return venv_info
+
+
+def get_virtualenv_original_prefix(venv_prefix=None):
+    venv_info = get_virtualenv_info(venv_prefix)
+    if venv_info is None:
+        return None
+
+    return venv_info.home
+
+
+def get_virtualenv_version(venv_prefix=None):
+    venv_info = get_virtualenv_info(venv_prefix)
+    if venv_info is None:
+        return None
+
+    return venv_info.version
+
+
+def get_virtualenv_activate_this_path(venv_prefix=None):
+    venv_layout = get_venv_layout(venv_prefix)
+    if venv_layout is None or not venv_layout.has_activate_this():
+        return None
+
+    path = os.path.join(venv_layout.prefix, BIN_PATH, "activate_this.py")
+    return os.path.abspath(path)
+
+
+def make_code_cache_path(source_path):
+    import hashlib
+
+    try:
+        key = os.path.abspath(source_path)
+    except TypeError:
+        return None
+
+    digest = hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()
+    return os.path.join(get_cache_dir(), "code", digest + ".pyc")
+
+
+def make_code_cache_header(fingerprint):
+    from importlib.util import MAGIC_NUMBER
+
+    mtime_ns, size = fingerprint
+    return (MAGIC_NUMBER + mtime_ns.to_bytes(8, "little") +
+            size.to_bytes(8, "little"))
+
+
+def load_activate_this_code(activate_this_path):
+    import marshal
+
+    # Like a .pyc file, but keyed by mtime_ns and size of the source file
+    fingerprint = get_stat_fingerprint(activate_this_path)
+    cache_path = make_code_cache_path(activate_this_path)
+    header = None
+    if fingerprint is not None and cache_path is not None:
+        header = make_code_cache_header(fingerprint)
+        try:
+            with open(cache_path, "rb") as cache_file:
+                data = cache_file.read()
+            if data.startswith(header):
+                return marshal.loads(data[len(header):])
+        except (EnvironmentError, EOFError, ValueError, TypeError):
+            pass
+
+    # Using ISO/IEC 8859-1 just in case.
+    with open(activate_this_path, encoding='iso8859-1') as activate_file:
+        activate_source = activate_file.read()
+    activate_code = compile(activate_source, activate_this_path, "exec")
+
+    if header is not None:
+        write_cache_file_atomically(cache_path,
+                                    header + marshal.dumps(activate_code))
+    return activate_code
+
+
+def activate_virtualenv(venv_prefix=None, force=False):
+    profile = begin_activation_profile(venv_prefix)
+    new_venv_prefix = None
+    try:
+        new_venv_prefix = _activate_virtualenv(venv_prefix, force)
+    finally:
+        end_activation_profile(profile, new_venv_prefix)
+
+    return new_venv_prefix
+
+
+def _activate_virtualenv(venv_prefix, force):
+    if venv_prefix is None:
+        venv_prefix = get_venv_prefix()
+        if venv_prefix is None:
+            return reject_activation("virtualenv", "no venv prefix")
+
+    with profile_span("read_orig_prefix", "virtualenv"):
+        venv_info = get_virtualenv_info(venv_prefix)
+
+    with profile_span("check_version", "virtualenv"):
+        virtualenv_version_info = None
+        if venv_info is not None:
+            virtualenv_version_info = venv_info.version_info
+        valid_version = is_valid_version(virtualenv_version_info)
+    if not force:
+        if venv_info is None:
+            return reject_activation("virtualenv", "no orig-prefix.txt")
+        elif not valid_version:
+            return reject_activation("virtualenv", "version mismatch")
+
+    activate_this_path = get_virtualenv_activate_this_path(venv_prefix)
+    if activate_this_path is None:
+        return reject_activation("virtualenv", "no activate_this.py")
+
+    new_venv_prefix = None
+    try:
+        with profile_span("load_activate_this", "virtualenv"):
+            activate_code = load_activate_this_code(activate_this_path)
+        with profile_span("exec_activate_this", "virtualenv"):
+            exec(activate_code, dict(__file__=activate_this_path))
+        new_venv_prefix = venv_prefix
+    except EnvironmentError as exception:
+        reject_activation("virtualenv",
+                          "activate_this.py failed: {}".format(exception))
+
+    return new_venv_prefix
+
+
+def get_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    if not cache_home:
+        cache_home = os.path.join(os.path.expanduser("~"), ".cache")
+
+    return os.path.join(cache_home, "py3venv")
+
+
+def make_site_packages_path(venv_prefix=None):
+    if venv_prefix is None:
+        venv_prefix = get_venv_prefix()
+        if venv_prefix is None:
+            return None
+
+    try:
+        site_packages_path = os.path.join(venv_prefix, SITE_PACKAGES_PATH)
+    except TypeError:
+        site_packages_path = None
+
+    return site_packages_path
+
+
+def get_stat_fingerprint(path):
+    try:
+        stat_result = os.stat(path)
+    except (EnvironmentError, TypeError):
+        return None
+
+    return [stat_result.st_mtime_ns, stat_result.st_size]
+
+
+def make_venv_fingerprint(venv_prefix=None, check_activated=True):
+    if venv_prefix is None:
+        venv_prefix = get_venv_prefix()
+        if venv_prefix is None:
+            return None
+
+    site_packages_path = make_site_packages_path(venv_prefix)
+    if site_packages_path is None:
+        return None
+
+    paths = [os.path.join(venv_prefix, "pyvenv.cfg"),
+             os.path.join(venv_prefix, LIB_PATH, "orig-prefix.txt"),
+             os.path.join(venv_prefix, BIN_PATH),
+             site_packages_path]
+    try:
+        paths.extend(sorted(os.path.join(site_packages_path, name)
+                            for name in os.listdir(site_packages_path)
+                            if name.endswith(".pth")))
+    except EnvironmentError:
+        pass
+
+    # The validity decision depends on the running interpreter and
+    # on the environment variables checked by is_venv_activated().
+    # reset_syspath() puts $PYTHONPATH into sys.path.
+    pythonpath = None
+    if not sys.flags.ignore_environment:
+        pythonpath = os.environ.get("PYTHONPATH")
+    fingerprint = {"python": list(sys.version_info[:3]),
+                   "activated": (check_activated and
+                                 is_venv_activated()),
+                   "pythonpath": pythonpath,
+                   "files": [[path, get_stat_fingerprint(path)]
+                             for path in paths]}
+    return fingerprint
+
+
+def make_activation_cache_path(venv_prefix):
+    import hashlib
+
+    try:
+        key = "{0}\0{1}.{2}.{3}".format(os.path.abspath(venv_prefix),
+                                        *sys.version_info)
+    except TypeError:
+        return None
+
+    digest = hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()
+    return os.path.join(get_cache_dir(), "activation", digest + ".json")
+
+
+def write_cache_file_atomically(path, data):
+    import tempfile
+
+    cache_dir = os.path.dirname(path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=".tmp-", dir=cache_dir)
+    except EnvironmentError:
+        return False
+
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(data)
+        # Readers see either the old file or the new one, never a
+        # partially written one.
+        os.replace(temp_path, path)
+    except EnvironmentError:
+        try:
+            os.unlink(temp_path)
+        except EnvironmentError:
+            pass
+        return False
+
+    return True
+
+
+def load_activation_snapshot(venv_prefix, fingerprint):
+    import json
+
+    if fingerprint is None:
+        return None
+
+    cache_path = make_activation_cache_path(venv_prefix)
+    if cache_path is None:
+        return None
+
+    try:
+        with open(cache_path, encoding="utf-8") as cache_file:
+            snapshot = json.load(cache_file)
+    except (EnvironmentError, ValueError):
+        return None
+
+    if (type(snapshot) is not dict or
+            snapshot.get("version") != ACTIVATION_CACHE_VERSION or
+            snapshot.get("fingerprint") != fingerprint):
+        return None
+
+    return snapshot
+
+
+def find_site_dirs(syspath):
+    site_dirs = []
+    for dir_path in syspath:
+        try:
+            if os.path.basename(os.path.normpath(dir_path)) in (
+                    "site-packages", "dist-packages"):
+                site_dirs.append(dir_path)
+        except (TypeError, ValueError):
+            pass
+
+    return site_dirs
+
+
+def make_environ_changes(old_environ):
+    environ_changes = {}
+    for name, old_value in old_environ.items():
+        new_value = os.environ.get(name)
+        if new_value == old_value:
+            continue
+        elif new_value is None:
+            environ_changes[name] = ["unset", None]
+        elif old_value and new_value.endswith(os.pathsep + old_value):
+            # e.g. activate_this.py prepends the bin directory to $PATH
+            environ_changes[name] = ["prepend",
+                                     new_value[:-len(old_value)]]
+        else:
+            environ_changes[name] = ["set", new_value]
+
+    return environ_changes
+
+
+def apply_environ_changes(environ_changes):
+    for name, (action, value) in environ_changes.items():
+        old_value = os.environ.get(name)
+        if action == "unset":
+            os.environ.pop(name, None)
+        elif action == "prepend":
+            if not old_value:
+                os.environ[name] = value.rstrip(os.pathsep)
+            elif not old_value.startswith(value):
+                os.environ[name] = value + old_value
+        else:
+            os.environ[name] = value
+
+
+def save_activation_snapshot(venv_prefix, fingerprint, kind,
+                             old_environ=None):
+    import json
+
+    if fingerprint is None:
+        return False
+
+    cache_path = make_activation_cache_path(venv_prefix)
+    if cache_path is None:
+        return False
+
+    snapshot = {"version": ACTIVATION_CACHE_VERSION,
+                "venv_prefix": venv_prefix,
+                "fingerprint": fingerprint,
+                "valid": kind is not None,
+                "kind": kind,
+                "sys_attrs": None,
+                "environ": {},
+                "pth_imports": []}
+    if kind is not None:
+        sys_state = capture_sys_state()
+        del sys_state["environ"]
+        snapshot["sys_attrs"] = sys_state
+        if old_environ is not None:
+            snapshot["environ"] = make_environ_changes(old_environ)
+        # Import lines of .pth files, e.g. the finders of editable
+        # installs, run code whose effects aren't in sys_attrs.
+        snapshot["pth_imports"] = find_pth_imports(
+            find_site_dirs(sys.path))
+
+    data = json.dumps(snapshot, sort_keys=True).encode("utf-8")
+    return write_cache_file_atomically(cache_path, data)
+
+
+def capture_sys_state():
+    vim_special_path = get_vim_special_path()
+    # Missing attributes, e.g. sys.real_prefix outside a virtualenv,
+    # are left out.
+    sys_state = {attr_name: getattr(sys, attr_name)
+                 for attr_name in SNAPSHOT_SYS_ATTRS
+                 if hasattr(sys, attr_name)}
+    sys_state["path"] = [path for path in sys.path
+                         if path != vim_special_path]
+    sys_state["environ"] = {name: os.environ.get(name)
+                            for name in SNAPSHOT_ENVIRON}
+    return sys_state
+
+
+def apply_sys_state(sys_state):
+    # Save vim_special_path before replacing sys.path
+    vim_special_path = get_vim_special_path()
+
+    new_sys_attrs = {"__egginsert": NOT_FOUND,
+                     "_home": NOT_FOUND}
+    for attr_name in SNAPSHOT_SYS_ATTRS:
+        new_sys_attrs[attr_name] = sys_state.get(attr_name, NOT_FOUND)
+    # id(sys.path) must not be changed.
+    new_sys_attrs["path"] = list(sys_state["path"])
+    saved_sys_attrs = fix_sys_attrs(new_sys_attrs)
+
+    if vim_special_path is not None and vim_special_path not in sys.path:
+        sys.path.append(vim_special_path)
+
+    for name, value in sys_state.get("environ", {}).items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+    return saved_sys_attrs
+
+
+def apply_activation_snapshot(snapshot):
+    sys_state = snapshot.get("sys_attrs")
+    try:
+        environ_changes = dict(snapshot.get("environ"))
+        pth_imports = list(snapshot.get("pth_imports"))
+        apply_sys_state(sys_state)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+    try:
+        apply_environ_changes(environ_changes)
+    except (AttributeError, TypeError, ValueError):
+        pass
+    with profile_span("run_pth_imports", "cache"):
+        run_pth_imports(pth_imports)
+
+    return snapshot.get("venv_prefix")
+
+
+def activate(venv_prefix=None, use_cache=True, check_activated=True):
+    profile = begin_activation_profile(venv_prefix)
+    new_venv_prefix = None
+    try:
+        new_venv_prefix = _activate(venv_prefix, use_cache, check_activated)
+    finally:
+        end_activation_profile(profile, new_venv_prefix)
+
+    return new_venv_prefix
+
+
+def _activate(venv_prefix, use_cache, check_activated):
+    if venv_prefix is None:
+        venv_prefix = get_venv_prefix()
+        if venv_prefix is None:
+            return reject_activation("activate", "no venv prefix")
+
+    fingerprint = None
+    if use_cache:
+        with profile_span("fingerprint", "cache"):
+            fingerprint = make_venv_fingerprint(venv_prefix,
+                                                check_activated)
+        with profile_span("load_snapshot", "cache"):
+            snapshot = load_activation_snapshot(venv_prefix, fingerprint)
+        if snapshot is not None:
+            if not snapshot.get("valid"):
+                return reject_activation("cache", "cached as invalid")
+            with profile_span("apply_snapshot", "cache"):
+                new_venv_prefix = apply_activation_snapshot(snapshot)
+            if new_venv_prefix is not None:
+                return new_venv_prefix
+
+    # Look at the venv afresh instead of trusting memoized helpers
+    forget_venv(venv_prefix)
+    old_environ = {name: os.environ.get(name) for name in SNAPSHOT_ENVIRON}
+
+    kind = None
+    new_venv_prefix = None
+    with profile_span("check_lib_path", "activate"):
+        valid_lib_path = is_valid_lib_path(venv_prefix)
+    if not valid_lib_path:
+        reject_activation("activate", "no lib directory")
+    else:
+        new_venv_prefix = activate_venv(venv_prefix,
+                                        check_activated=check_activated)
+        if new_venv_prefix is not None:
+            kind = "venv"
+        else:
+            new_venv_prefix = activate_virtualenv(venv_prefix)
+            if new_venv_prefix is not None:
+                kind = "virtualenv"
+
+    if use_cache:
+        with profile_span("save_snapshot", "cache"):
+            save_activation_snapshot(venv_prefix, fingerprint, kind,
+                                     old_environ)
+
+    return new_venv_prefix
+
+
+def normalize_path_entry(path):
+    try:
+        return os.path.normcase(os.path.abspath(path))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_module_path_entry(module):
+    spec = getattr(module, "__spec__", None)
+    origin = None
+    if spec is not None and getattr(spec, "has_location", False):
+        origin = spec.origin
+    if origin is None:
+        origin = getattr(module, "__file__", None)
+    if not isinstance(origin, str):
+        return None
+
+    # .../entry/name.py or .../entry/name/__init__.py
+    path_entry = os.path.dirname(origin)
+    if getattr(module, "__path__", None) is not None:
+        path_entry = os.path.dirname(path_entry)
+    return normalize_path_entry(path_entry)
+
+
+def find_stale_modules(old_syspath, new_syspath=None):
+    from importlib.machinery import PathFinder
+
+    if new_syspath is None:
+        new_syspath = sys.path
+
+    old_entries = set(normalize_path_entry(path) for path in old_syspath
+                      if isinstance(path, str))
+    new_entries = [normalize_path_entry(path) if isinstance(path, str)
+                   else None
+                   for path in new_syspath]
+    new_entry_indexes = {}
+    for index, path_entry in enumerate(new_entries):
+        new_entry_indexes.setdefault(path_entry, index)
+
+    stale_names = []
+    for name, module in list(sys.modules.items()):
+        if "." in name or name in PROTECTED_MODULES or module is None:
+            continue
+
+        path_entry = get_module_path_entry(module)
+        if path_entry is None or path_entry not in old_entries:
+            # builtin, frozen or not loaded through sys.path
+            continue
+
+        index = new_entry_indexes.get(path_entry)
+        if index is None:
+            stale_names.append(name)
+            continue
+
+        # Only entries added in front of its own one can shadow it
+        shadowing_paths = [new_syspath[shadowing_index]
+                           for shadowing_index in range(index)
+                           if new_entries[shadowing_index] not in old_entries]
+        if shadowing_paths:
+            spec = PathFinder.find_spec(name, shadowing_paths)
+            if spec is not None and spec.loader is not None:
+                stale_names.append(name)
+
+    return stale_names
+
+
+def reconcile_modules(old_syspath, new_syspath=None):
+    import importlib
+
+    if new_syspath is None:
+        new_syspath = sys.path
+
+    if list(old_syspath) == list(new_syspath):
+        return []
+
+    importlib.invalidate_caches()
+    stale_names = find_stale_modules(old_syspath, new_syspath)
+    evicted_names = []
+    for name in stale_names:
+        prefix = name + "."
+        for module_name in list(sys.modules):
+            if module_name == name or module_name.startswith(prefix):
+                del sys.modules[module_name]
+                evicted_names.append(module_name)
+
+    return evicted_names
+
+
+def get_realpath(path):
+    realpath = _realpath_cache.get(path)
+    if realpath is None:
+        realpath = os.path.realpath(path)
+        _realpath_cache[path] = realpath
+    return realpath
+
+
+def path_entry_exists(path):
+    if os.path.exists(path):
+        return True
+
+    # e.g. /path/to/archive.zip/package
+    child_path, parent_path = path, os.path.dirname(path)
+    while parent_path != child_path:
+        if os.path.isfile(parent_path):
+            return True
+        elif os.path.isdir(parent_path):
+            return False
+        child_path, parent_path = parent_path, os.path.dirname(parent_path)
+
+    return False
+
+
+def is_custom_path_entry(path):
+    # Entries handled by a path hook other than the default ones, like
+    # vim.VIM_SPECIAL_PATH
+    from importlib.machinery import FileFinder
+    from zipimport import zipimporter
+
+    finder = sys.path_importer_cache.get(path)
+    return (finder is not None and
+            not isinstance(finder, (FileFinder, zipimporter)))
+
+
+def optimize_syspath():
+    vim_special_path = get_vim_special_path()
+    seen_paths = set()
+    kept_paths = []
+    removed_paths = []
+    for path in sys.path:
+        if (path == vim_special_path or not isinstance(path, str) or
+                path == "" or is_custom_path_entry(path)):
+            kept_paths.append(path)
+            continue
+
+        if not path_entry_exists(path):
+            removed_paths.append({"path": path, "reason": "missing"})
+            continue
+
+        canonical_path = os.path.normcase(get_realpath(path))
+        if canonical_path in seen_paths:
+            removed_paths.append({"path": path, "reason": "duplicate"})
+            continue
+
+        seen_paths.add(canonical_path)
+        kept_paths.append(path)
+
+    # id(sys.path) must not be changed.
+    sys.path[:] = kept_paths
+
+    # A failed import looks into every existing sys.path entry, so each
+    # removed duplicate saves a stat() per import miss.  Missing entries
+    # cost nothing after the first miss, as sys.path_importer_cache
+    # keeps None for them.
+    return {"removed": removed_paths,
+            "stats_saved_per_miss": sum(
+                1 for removed in removed_paths
+                if removed["reason"] == "duplicate")}
+
+
+def get_syspath_report():
+    return _syspath_report
+
+
+def get_module_suffixes():
+    from importlib.machinery import (BYTECODE_SUFFIXES, EXTENSION_SUFFIXES,
+                                     SOURCE_SUFFIXES)
+
+    # Same order as the loaders of FileFinder
+    return EXTENSION_SUFFIXES + SOURCE_SUFFIXES + BYTECODE_SUFFIXES
+
+
+def scan_module_names(dir_path, suffixes):
+    # name -> [kind, filename] of top-level modules and regular packages
+    file_names = set()
+    dir_names = []
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if entry.name.isidentifier():
+                        dir_names.append(entry.name)
+                else:
+                    file_names.add(entry.name)
+    except EnvironmentError:
+        return None
+
+    modules = {}
+    for file_name in file_names:
+        for suffix in suffixes:
+            if not file_name.endswith(suffix):
+                continue
+            name = file_name[:-len(suffix)]
+            if name.isidentifier() and name not in modules:
+                # e.g. foo.cpython-311-x86_64-linux-gnu.so before foo.py
+                for candidate_suffix in suffixes:
+                    if name + candidate_suffix in file_names:
+                        modules[name] = ["module", name + candidate_suffix]
+                        break
+            break
+
+    # A regular package takes precedence over a module of the same name,
+    # while a directory without __init__ is only a namespace portion.
+    init_names = ["__init__" + suffix for suffix in suffixes]
+    for name in dir_names:
+        for init_name in init_names:
+            if os.path.isfile(os.path.join(dir_path, name, init_name)):
+                modules[name] = ["package", init_name]
+                break
+
+    return modules
+
+
+def build_module_index(syspath=None):
+    if syspath is None:
+        syspath = sys.path
+
+    suffixes = get_module_suffixes()
+    indexed_syspath = []
+    dirs = {}
+    modules = {}
+    for path in syspath:
+        # '' and entries of other path hooks (zip archives, Vim's special
+        # path) can't be indexed, so stop indexing at the first of them.
+        if not isinstance(path, str) or path == "":
+            break
+        try:
+            stat_result = os.stat(path)
+        except EnvironmentError:
+            dirs[path] = None
+            indexed_syspath.append(path)
+            continue
+        if not os.path.isdir(path):
+            break
+
+        dir_modules = scan_module_names(path, suffixes)
+        if dir_modules is None:
+            break
+        dirs[path] = stat_result.st_mtime_ns
+        indexed_syspath.append(path)
+        for name, (kind, filename) in dir_modules.items():
+            if name not in modules:
+                modules[name] = [path, kind, filename]
+
+    return {"version": MODULE_INDEX_VERSION,
+            "syspath": indexed_syspath,
+            "dirs": dirs,
+            "modules": modules}
+
+
+def is_module_index_valid(index, syspath):
+    if (type(index) is not dict or
+            index.get("version") != MODULE_INDEX_VERSION or
+            syspath[:len(index["syspath"])] != index["syspath"]):
+        return False
+
+    for path, mtime in index["dirs"].items():
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                return False
+        except EnvironmentError:
+            if mtime is not None:
+                return False
+
+    return True
+
+
+def make_module_index_cache_path(venv_prefix):
+    cache_path = make_activation_cache_path(venv_prefix)
+    if cache_path is None:
+        return None
+
+    # Next to the activation snapshot of the same venv
+    return cache_path[:-len(".json")] + ".modules.json"
+
+
+def load_module_index(venv_prefix):
+    import json
+
+    vim_special_path = get_vim_special_path()
+    syspath = [path for path in sys.path if path != vim_special_path]
+    index = _module_indexes.get(venv_prefix)
+    if index is not None and is_module_index_valid(index, syspath):
+        return index
+
+    cache_path = make_module_index_cache_path(venv_prefix)
+    index = None
+    if cache_path is not None:
+        try:
+            with open(cache_path, encoding="utf-8") as cache_file:
+                index = json.load(cache_file)
+        except (EnvironmentError, ValueError):
+            index = None
+
+    try:
+        valid = index is not None and is_module_index_valid(index, syspath)
+    except (KeyError, TypeError, AttributeError):
+        valid = False
+    if not valid:
+        index = build_module_index(syspath)
+        if cache_path is not None:
+            write_cache_file_atomically(
+                cache_path, json.dumps(index, sort_keys=True).encode("utf-8"))
+
+    _module_indexes[venv_prefix] = index
+    return index
+
+
+class ModuleIndexFinder:
+    def __init__(self, venv_prefix, index):
+        # Imported here, as an import in find_spec() would come back to
+        # find_spec() before importlib.util has been loaded.
+        from importlib.util import spec_from_file_location
+
+        self.spec_from_file_location = spec_from_file_location
+        self.venv_prefix = venv_prefix
+        self.syspath = index["syspath"]
+        self.modules = index["modules"]
+
+    def reload(self):
+        # Imports while reloading are left to the default finders
+        self.syspath = []
+        self.modules = {}
+        index = load_module_index(self.venv_prefix)
+        self.syspath = index["syspath"]
+        self.modules = index["modules"]
+
+    def find_spec(self, fullname, path=None, target=None):
+        if path is not None:
+            return None
+
+        if self.modules is None:
+            self.reload()
+        module_entry = self.modules.get(fullname)
+        if module_entry is None:
+            return None
+
+        # sys.path has been changed since the index was built
+        if sys.path[:len(self.syspath)] != self.syspath:
+            return None
+
+        path_entry, kind, filename = module_entry
+        if kind == "package":
+            package_path = os.path.join(path_entry, fullname)
+            location = os.path.join(package_path, filename)
+            submodule_search_locations = [package_path]
+        else:
+            location = os.path.join(path_entry, filename)
+            submodule_search_locations = None
+
+        # Fall through to the default finders on a stale entry
+        if not os.path.isfile(location):
+            return None
+
+        return self.spec_from_file_location(
+            fullname, location,
+            submodule_search_locations=submodule_search_locations)
+
+    def invalidate_caches(self):
+        _module_indexes.pop(self.venv_prefix, None)
+        # Reloaded by the next find_spec()
+        self.modules = None
+
+
+def uninstall_module_index():
+    sys.meta_path[:] = [finder for finder in sys.meta_path
+                        if not isinstance(finder, ModuleIndexFinder)]
+
+
+def install_module_index(venv_prefix):
+    from importlib.machinery import PathFinder
+
+    finder = ModuleIndexFinder(venv_prefix, load_module_index(venv_prefix))
+    uninstall_module_index()
+
+    # Ahead of the default path based finder
+    index = len(sys.meta_path)
+    if PathFinder in sys.meta_path:
+        index = sys.meta_path.index(PathFinder)
+    sys.meta_path.insert(index, finder)
+    return finder
+
+
+def update_module_index(venv_prefix):
+    if not USE_MODULE_INDEX:
+        return None
+
+    if venv_prefix is None:
+        uninstall_module_index()
+        return None
+
+    return install_module_index(venv_prefix)
+
+
+def preload_modules(module_names):
+    import importlib
+
+    for name in module_names:
+        if name in sys.modules:
+            continue
+        started = time.perf_counter()
+        try:
+            # The per-module import lock makes the main thread wait for
+            # a module being preloaded instead of importing it twice.
+            importlib.import_module(name)
+            error = None
+        except Exception as exc:
+            error = "{}: {}".format(type(exc).__name__, exc)
+        _preload_report[name] = {"elapsed": time.perf_counter() - started,
+                                 "error": error}
+
+
+def start_preload(module_names=None):
+    global _preload_thread
+    import threading
+
+    if module_names is None:
+        module_names = PRELOAD_MODULES
+    module_names = [name for name in module_names if name]
+    if not module_names:
+        return None
+
+    if _preload_thread is not None and _preload_thread.is_alive():
+        return _preload_thread
+
+    _preload_thread = threading.Thread(target=preload_modules,
+                                       args=(module_names,),
+                                       name="py3venv-preload", daemon=True)
+    _preload_thread.start()
+    return _preload_thread
+
+
+def wait_preload(timeout=None):
+    if _preload_thread is None:
+        return True
+
+    _preload_thread.join(timeout)
+    return not _preload_thread.is_alive()
+
+
+def get_preload_report():
+    return [dict(report, name=name)
+            for name, report in list(_preload_report.items())]
+
+
+def format_preload_report():
+    report = get_preload_report()
+    if not report:
+        return "py3venv: no modules have been preloaded"
+
+    lines = ["py3venv: preloaded modules"]
+    for entry in report:
+        lines.append("  {:<24} {:9.3f} ms {}".format(
+            entry["name"], entry["elapsed"] * 1000,
+            entry["error"] or "ok"))
+    return "\n".join(lines)
+
+
+def make_zip_snapshot_path(venv_prefix, fingerprint):
+    import hashlib
+    import json
+
+    cache_path = make_activation_cache_path(venv_prefix)
+    if cache_path is None or fingerprint is None:
+        return None
+
+    # An archive is never rewritten in place, since zipimport keeps the
+    # central directory it has read from an archive on sys.path.
+    venv_digest = os.path.basename(cache_path)[:-len(".json")]
+    data = json.dumps(fingerprint, sort_keys=True).encode("utf-8")
+    fingerprint_digest = hashlib.sha1(data).hexdigest()[:16]
+    return os.path.join(get_cache_dir(), "zip", "{}-{}.zip".format(
+        venv_digest, fingerprint_digest))
+
+
+def hold_zip_snapshot(zip_path):
+    if zip_path in _zip_snapshot_files:
+        return True
+
+    try:
+        zip_file = open(zip_path, "rb")
+    except EnvironmentError:
+        return False
+
+    # The shared lock tells the other sessions that the archive is on
+    # sys.path.  Windows refuses to remove a file which is open.
+    try:
+        import fcntl
+
+        fcntl.flock(zip_file.fileno(), fcntl.LOCK_SH)
+    except ImportError:
+        pass
+    except EnvironmentError:
+        zip_file.close()
+        return False
+
+    # Removed by another session before the lock was taken
+    if os.fstat(zip_file.fileno()).st_nlink == 0:
+        zip_file.close()
+        return False
+
+    _zip_snapshot_files[zip_path] = zip_file
+    return True
+
+
+def remove_zip_snapshot(zip_path):
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    if fcntl is None:
+        try:
+            os.unlink(zip_path)
+        except EnvironmentError:
+            return False
+    else:
+        try:
+            with open(zip_path, "rb") as zip_file:
+                fcntl.flock(zip_file.fileno(),
+                            fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.unlink(zip_path)
+        except EnvironmentError:
+            return False
+
+    try:
+        os.unlink(zip_path[:-len(".zip")] + ".json")
+    except EnvironmentError:
+        pass
+    return True
+
+
+def remove_unused_zip_snapshots(zip_path):
+    zip_dir, zip_name = os.path.split(zip_path)
+    venv_digest = zip_name.rpartition("-")[0]
+    try:
+        names = os.listdir(zip_dir)
+    except EnvironmentError:
+        return []
+
+    removed_paths = []
+    for name in sorted(names):
+        path = os.path.join(zip_dir, name)
+        if (name.rpartition("-")[0] != venv_digest or
+                not name.endswith(".zip") or
+                path == zip_path or path in _zip_snapshot_files):
+            continue
+        if remove_zip_snapshot(path):
+            removed_paths.append(path)
+
+    return removed_paths
+
+
+def find_pure_python_files(site_dir):
+    # top-level name -> [[arcname, path], ...] of the packages and
+    # modules that consist only of Python sources.
+    try:
+        with os.scandir(site_dir) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+    except EnvironmentError:
+        return {}
+
+    packages = {}
+    for entry in entries:
+        if entry.is_file():
+            name = entry.name[:-len(".py")]
+            if entry.name.endswith(".py") and name.isidentifier():
+                packages[name] = [[entry.name, entry.path]]
+            continue
+        if (not entry.name.isidentifier() or
+                not os.path.isfile(os.path.join(entry.path,
+                                                "__init__.py"))):
+            continue
+
+        files = []
+        for dir_path, dir_names, file_names in os.walk(entry.path):
+            dir_names[:] = [name for name in dir_names
+                            if name != "__pycache__"]
+            for file_name in file_names:
+                if not file_name.endswith(ZIP_PACKAGE_FILES):
+                    # Extensions and data files need a real directory
+                    files = None
+                    break
+                path = os.path.join(dir_path, file_name)
+                arcname = os.path.relpath(path, site_dir)
+                files.append([arcname.replace(os.sep, "/"), path])
+            if files is None:
+                break
+        if files:
+            packages[entry.name] = files
+
+    return packages
+
+
+def make_zip_pyc(code, date_time, size):
+    import marshal
+    from importlib.util import MAGIC_NUMBER
+
+    # zipimport checks the mtime of a .pyc against the DOS time of the
+    # .py entry, not against the file system.
+    mtime = int(time.mktime(date_time + (0, 0, -1)))
+    return (MAGIC_NUMBER + (0).to_bytes(4, "little") +
+            (mtime & 0xFFFFFFFF).to_bytes(4, "little") +
+            (size & 0xFFFFFFFF).to_bytes(4, "little") + marshal.dumps(code))
+
+
+def build_zip_snapshot(venv_prefix, fingerprint=None):
+    import json
+    import tempfile
+    import zipfile
+
+    if fingerprint is None:
+        fingerprint = make_venv_fingerprint(venv_prefix, check_activated=False)
+    zip_path = make_zip_snapshot_path(venv_prefix, fingerprint)
+    site_dir = make_site_packages_path(venv_prefix)
+    if fingerprint is None or zip_path is None:
+        return None
+
+    zip_dir = os.path.dirname(zip_path)
+    try:
+        os.makedirs(zip_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=".tmp-", dir=zip_dir)
+    except EnvironmentError:
+        return None
+
+    package_names = []
+    try:
+        with os.fdopen(fd, "wb") as temp_file, \
+                zipfile.ZipFile(temp_file, "w") as zip_file:
+            for name, files in sorted(
+                    find_pure_python_files(site_dir).items()):
+                members = []
+                try:
+                    for arcname, path in files:
+                        with open(path, "rb") as source_file:
+                            source = source_file.read()
+                        date_time = time.localtime(
+                            max(os.stat(path).st_mtime, 315619200))[:6]
+                        members.append((zipfile.ZipInfo(arcname, date_time),
+                                        source))
+                        if arcname.endswith(".py"):
+                            code = compile(source,
+                                           os.path.join(zip_path, arcname),
+                                           "exec", dont_inherit=True)
+                            members.append((
+                                zipfile.ZipInfo(arcname + "c", date_time),
+                                make_zip_pyc(code, date_time, len(source))))
+                except (EnvironmentError, SyntaxError, ValueError):
+                    # Left on the original path
+                    continue
+                for zip_info, data in members:
+                    zip_file.writestr(zip_info, data)
+                package_names.append(name)
+        try:
+            # Unlike os.replace(), never replaces an existing archive
+            os.link(temp_path, zip_path)
+        except FileExistsError:
+            # Built by another session from the same fingerprint
+            pass
+    except EnvironmentError:
+        return None
+    finally:
+        try:
+            os.unlink(temp_path)
+        except EnvironmentError:
+            pass
+
+    meta = {"version": ZIP_SNAPSHOT_VERSION,
+            "fingerprint": fingerprint,
+            "packages": package_names}
+    write_cache_file_atomically(
+        zip_path[:-len(".zip")] + ".json",
+        json.dumps(meta, sort_keys=True).encode("utf-8"))
+    remove_unused_zip_snapshots(zip_path)
+    return zip_path
+
+
+def load_zip_snapshot(venv_prefix, fingerprint):
+    import json
+
+    zip_path = make_zip_snapshot_path(venv_prefix, fingerprint)
+    if zip_path is None:
+        return None
+
+    try:
+        with open(zip_path[:-len(".zip")] + ".json",
+                  encoding="utf-8") as meta_file:
+            meta = json.load(meta_file)
+    except (EnvironmentError, ValueError):
+        return None
+
+    if (type(meta) is not dict or
+            meta.get("version") != ZIP_SNAPSHOT_VERSION or
+            meta.get("fingerprint") != fingerprint or
+            not os.path.isfile(zip_path)):
+        return None
+
+    return zip_path
+
+
+def start_zip_snapshot_build(venv_prefix, fingerprint):
+    import threading
+
+    thread = _zip_build_threads.get(venv_prefix)
+    if thread is not None and thread.is_alive():
+        return thread
+
+    thread = threading.Thread(target=build_zip_snapshot,
+                              args=(venv_prefix, fingerprint),
+                              name="py3venv-zip-snapshot", daemon=True)
+    _zip_build_threads[venv_prefix] = thread
+    thread.start()
+    return thread
+
+
+def apply_zip_snapshot(venv_prefix):
+    if not ZIP_SITE_PACKAGES:
+        return None
+
+    site_dir = make_site_packages_path(venv_prefix)
+    if site_dir not in sys.path:
+        return None
+
+    fingerprint = make_venv_fingerprint(venv_prefix, check_activated=False)
+    zip_path = load_zip_snapshot(venv_prefix, fingerprint)
+    if zip_path is not None and not hold_zip_snapshot(zip_path):
+        zip_path = None
+    if zip_path is None:
+        # Packing reads the whole of site-packages, so the archive is
+        # built in the background and used from the next activation.
+        start_zip_snapshot_build(venv_prefix, fingerprint)
+        return None
+
+    if zip_path not in sys.path:
+        sys.path.insert(sys.path.index(site_dir), zip_path)
+    return zip_path
+
+
+def get_baseline_sys_state():
+    global _baseline_sys_state, _baseline_sys_attrs, _baseline_environ
+
+    # The state of sys before any venv has been activated
+    if _baseline_sys_state is None:
+        _baseline_sys_state = capture_sys_state()
+        # deactivate() hands these to recover_sys_attrs()
+        _baseline_sys_attrs = fix_sys_attrs(
+            dict.fromkeys(BASELINE_SYS_ATTRS, AS_IS))
+        _baseline_environ = {name: os.environ.get(name)
+                             for name in BASELINE_ENVIRON}
+
+    return _baseline_sys_state
+
+
+def get_current_venv_prefix():
+    return _current_venv_prefix
+
+
+def remember_venv_state(venv_prefix):
+    sys_state = capture_sys_state()
+    # Run again when the venv is switched back to, as switching away
+    # removes the finders they have installed.
+    sys_state["pth_imports"] = find_pth_imports(find_site_dirs(sys.path))
+    _venv_pool.pop(venv_prefix, None)
+    _venv_pool[venv_prefix] = sys_state
+    while len(_venv_pool) > max(VENV_POOL_SIZE, 0):
+        del _venv_pool[next(iter(_venv_pool))]
+
+
+def forget_venv_state(venv_prefix=None):
+    if venv_prefix is None:
+        _venv_pool.clear()
+    else:
+        _venv_pool.pop(venv_prefix, None)
+
+
+def finish_activation(venv_prefix):
+    global _syspath_report
+
+    apply_zip_snapshot(venv_prefix)
+    if OPTIMIZE_SYSPATH:
+        _syspath_report = optimize_syspath()
+    remember_venv_state(venv_prefix)
+
+
+def ensure_activated(venv_prefix=None, use_cache=True, profile_log=None,
+                     discover_path=None):
+    global _activation_done, _activated_venv_prefix, _current_venv_prefix
+
+    if not _activation_done:
+        _activation_done = True
+        if TRACE_MEMORY:
+            import tracemalloc
+
+            # Allocations before start() aren't traced, so deactivate()
+            # can only measure what the venv allocates after this.
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+        old_syspath = get_baseline_sys_state()["path"]
+        check_activated = True
+        if (venv_prefix is None and get_venv_prefix() is None and
+                discover_path is not None):
+            venv_prefix = find_venv_prefix(discover_path)
+            check_activated = False
+        _activated_venv_prefix = activate(venv_prefix, use_cache=use_cache,
+                                          check_activated=check_activated)
+        if profile_log:
+            write_activation_profile(profile_log)
+        if _activated_venv_prefix is not None:
+            _current_venv_prefix = _activated_venv_prefix
+            finish_activation(_activated_venv_prefix)
+            reconcile_modules(old_syspath)
+            update_module_index(_activated_venv_prefix)
+            start_preload()
+            start_precompile(_activated_venv_prefix)
+
+    return _activated_venv_prefix
+
+
+def switch_venv(venv_prefix, use_cache=True):
+    if venv_prefix == _current_venv_prefix:
+        return venv_prefix
+
+    old_syspath = sys.path[:]
+    new_venv_prefix = _switch_venv(venv_prefix, use_cache)
+    reconcile_modules(old_syspath)
+    update_module_index(new_venv_prefix)
+    return new_venv_prefix
+
+
+def _switch_venv(venv_prefix, use_cache):
+    global _current_venv_prefix
+
+    if _current_venv_prefix is not None:
+        remove_venv_finders(_current_venv_prefix)
+
+    # The user cache of bytecode belongs to the venv it was made for
+    restore_pycache_prefix()
+    if (venv_prefix is not None and _precompile_report is not None and
+            _precompile_report["venv_prefix"] == venv_prefix and
+            _precompile_report["pycache_prefix"] is not None):
+        set_pycache_prefix(_precompile_report["pycache_prefix"])
+
+    baseline_sys_state = get_baseline_sys_state()
+    if venv_prefix is None:
+        apply_sys_state(baseline_sys_state)
+        _current_venv_prefix = None
+        return None
+
+    sys_state = _venv_pool.get(venv_prefix)
+    if sys_state is not None:
+        _venv_pool[venv_prefix] = _venv_pool.pop(venv_prefix)
+        apply_sys_state(sys_state)
+        run_pth_imports(sys_state["pth_imports"])
+        _current_venv_prefix = venv_prefix
+        return venv_prefix
+
+    # Not pooled yet or evicted, so rebuild it on top of the baseline
+    apply_sys_state(baseline_sys_state)
+    new_venv_prefix = activate(venv_prefix, use_cache=use_cache,
+                               check_activated=False)
+    if new_venv_prefix is not None:
+        finish_activation(new_venv_prefix)
+    _current_venv_prefix = new_venv_prefix
+    return new_venv_prefix
+
+
+def is_inside_prefix(path, prefix):
+    path = normalize_path_entry(path)
+    return path is not None and (path == prefix or
+                                 path.startswith(prefix.rstrip(os.sep) +
+                                                 os.sep))
+
+
+def is_venv_module(module, venv_prefix):
+    spec = getattr(module, "__spec__", None)
+    origin = None
+    if spec is not None and getattr(spec, "has_location", False):
+        origin = spec.origin
+    if origin is None:
+        origin = getattr(module, "__file__", None)
+    if isinstance(origin, str):
+        return is_inside_prefix(origin, venv_prefix)
+
+    # Namespace packages have no origin, only portions in __path__
+    module_path = getattr(module, "__path__", None)
+    try:
+        portions = [path for path in module_path if isinstance(path, str)]
+    except TypeError:
+        return False
+    return bool(portions) and all(is_inside_prefix(path, venv_prefix)
+                                  for path in portions)
+
+
+def unload_venv_modules(venv_prefix):
+    venv_prefix = normalize_path_entry(venv_prefix)
+    unloaded_names = []
+    for name, module in list(sys.modules.items()):
+        if (name in PROTECTED_MODULES or module is None or
+                not is_venv_module(module, venv_prefix)):
+            continue
+        del sys.modules[name]
+        unloaded_names.append(name)
+
+    return unloaded_names
+
+
+def remove_venv_finders(venv_prefix):
+    venv_prefix = normalize_path_entry(venv_prefix)
+
+    # e.g. the finders of editable installs and the shim of setuptools,
+    # which .pth files of the venv have installed
+    def is_venv_finder(finder):
+        module_name = getattr(finder, "__module__", None)
+        if (not isinstance(module_name, str) or
+                module_name in PROTECTED_MODULES):
+            return False
+        module = sys.modules.get(module_name)
+        return module is not None and is_venv_module(module, venv_prefix)
+
+    removed_finders = []
+    for finders in (sys.meta_path, sys.path_hooks):
+        kept_finders = []
+        for finder in finders:
+            if is_venv_finder(finder):
+                removed_finders.append(finder)
+            else:
+                kept_finders.append(finder)
+        finders[:] = kept_finders
+
+    for path, finder in list(sys.path_importer_cache.items()):
+        if finder is not None and is_venv_finder(finder):
+            del sys.path_importer_cache[path]
+
+    return removed_finders
+
+
+def release_import_references():
+    # Finders of removed entries and the last traceback keep the
+    # modules and their frames alive.
+    syspath = set(path for path in sys.path if isinstance(path, str))
+    for path in list(sys.path_importer_cache):
+        if path not in syspath:
+            del sys.path_importer_cache[path]
+
+    for attr_name in ("last_type", "last_value", "last_traceback"):
+        if hasattr(sys, attr_name):
+            delattr(sys, attr_name)
+
+    if "linecache" in sys.modules:
+        sys.modules["linecache"].clearcache()
+
+
+def deactivate():
+    global _activated_venv_prefix, _current_venv_prefix
+    import gc
+    import importlib
+    import tracemalloc
+
+    venv_prefix = _current_venv_prefix
+    if venv_prefix is None or _baseline_sys_attrs is None:
+        return None
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        gc.collect()
+        traced_memory = tracemalloc.get_traced_memory()[0]
+
+    old_syspath = sys.path[:]
+    vim_special_path = get_vim_special_path()
+    recover_sys_attrs(_baseline_sys_attrs)
+    if vim_special_path is not None and vim_special_path not in sys.path:
+        sys.path.append(vim_special_path)
+    for name, value in _baseline_environ.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+    uninstall_module_index()
+    restore_pycache_prefix()
+    # Before the modules of the finders are unloaded
+    removed_finders = remove_venv_finders(venv_prefix)
+    _activated_venv_prefix = None
+    _current_venv_prefix = None
+
+    unloaded_names = reconcile_modules(old_syspath)
+    unloaded_names.extend(unload_venv_modules(venv_prefix))
+    importlib.invalidate_caches()
+    release_import_references()
+    del old_syspath
+    collected = gc.collect()
+
+    freed = None
+    if tracing:
+        freed = traced_memory - tracemalloc.get_traced_memory()[0]
+
+    return {"venv_prefix": venv_prefix,
+            "unloaded": len(unloaded_names),
+            "modules": sorted(unloaded_names),
+            "finders": len(removed_finders),
+            "collected": collected,
+            "freed": freed}
+
+
+def format_deactivation(result):
+    if result is None:
+        return "py3venv: no venv is active"
+
+    freed = "unknown"
+    if result["freed"] is not None:
+        freed = "{:.1f} KiB".format(result["freed"] / 1024)
+    return ("py3venv: deactivated {}, unloaded {} modules and {} finders, "
+            "collected {} objects, freed {}".format(
+                result["venv_prefix"], result["unloaded"],
+                result["finders"], result["collected"], freed))
+
+
+class SitePackagesWatcher:
+    def __init__(self, venv_prefix):
+        self.venv_prefix = venv_prefix
+        self.site_dir = make_site_packages_path(venv_prefix)
+        self.site_mtime = None
+        self.pth_fingerprints = {}
+        self.pth_entries = {}
+        self.pth_names = []
+        self.next_pth = 0
+        self.ticks = 0
+        self.refreshes = 0
+        self.last_stats = 0
+        self.max_stats = 0
+        self.last_elapsed = 0.0
+        self.max_elapsed = 0.0
+        self.total_elapsed = 0.0
+        self.added = []
+        self.removed = []
+        self.scan(initial=True)
+
+    def scan(self, initial=False):
+        import site
+
+        try:
+            self.site_mtime = os.stat(self.site_dir).st_mtime_ns
+            names = sorted(name for name in os.listdir(self.site_dir)
+                           if name.endswith(".pth"))
+        except (EnvironmentError, TypeError):
+            self.site_mtime = None
+            names = []
+
+        new_pth_names = []
+        for name in names:
+            fullname = os.path.join(self.site_dir, name)
+            pth_info = scan_pth_file(self.site_dir, name, site.makepath)
+            if pth_info is None:
+                continue
+            new_pth_names.append(name)
+            self.pth_fingerprints[name] = get_stat_fingerprint(fullname)
+            # site only adds the directories which exist
+            self.pth_entries[name] = [dir_path for dir_path, dircase
+                                      in pth_info["entries"]
+                                      if os.path.exists(dir_path)]
+            if (not initial and name not in self.pth_names and
+                    pth_info["has_import"]):
+                # Left to site.addpackage() by refresh()
+                self.pth_entries[name] = None
+
+        for name in set(self.pth_fingerprints) - set(new_pth_names):
+            del self.pth_fingerprints[name]
+            self.pth_entries.pop(name, None)
+        self.pth_names = new_pth_names
+        self.next_pth = 0
+
+    def get_entries(self):
+        entries = []
+        for name in self.pth_names:
+            for dir_path in self.pth_entries.get(name) or []:
+                if dir_path not in entries:
+                    entries.append(dir_path)
+        return entries
+
+    def is_changed(self):
+        stats = 1
+        try:
+            site_mtime = os.stat(self.site_dir).st_mtime_ns
+        except (EnvironmentError, TypeError):
+            site_mtime = None
+        if site_mtime != self.site_mtime:
+            return True, stats
+
+        # .pth files rewritten in place don't touch the directory, so
+        # check a bounded number of them per tick in turn.
+        for _ in range(min(len(self.pth_names), WATCH_STAT_BUDGET - 1)):
+            name = self.pth_names[self.next_pth % len(self.pth_names)]
+            self.next_pth = (self.next_pth + 1) % len(self.pth_names)
+            stats += 1
+            fingerprint = get_stat_fingerprint(os.path.join(self.site_dir,
+                                                            name))
+            if fingerprint != self.pth_fingerprints.get(name):
+                return True, stats
+
+        return False, stats
+
+    def refresh(self):
+        import importlib
+        import site
+
+        old_pth_names = set(self.pth_names)
+        old_entries = self.get_entries()
+        self.scan()
+        new_entries = self.get_entries()
+
+        removed = [path for path in old_entries if path not in new_entries]
+        for path in removed:
+            while path in sys.path:
+                sys.path.remove(path)
+
+        # Save vim_special_path before appending to sys.path
+        vim_special_path = get_vim_special_path()
+        if vim_special_path is not None and vim_special_path in sys.path:
+            sys.path.remove(vim_special_path)
+
+        added = []
+        for path in new_entries:
+            if path not in sys.path:
+                sys.path.append(path)
+                added.append(path)
+
+        # New .pth files with import lines are handed to site as a whole
+        for name in self.pth_names:
+            if name in old_pth_names or self.pth_entries[name] is not None:
+                continue
+            old_syspath = sys.path[:]
+            known_paths = set(site.makepath(path)[1] for path in sys.path
+                              if isinstance(path, str))
+            site.addpackage(self.site_dir, name, known_paths)
+            self.pth_entries[name] = [path for path in sys.path
+                                      if path not in old_syspath]
+            added.extend(self.pth_entries[name])
+
+        if vim_special_path is not None and vim_special_path not in sys.path:
+            sys.path.append(vim_special_path)
+
+        importlib.invalidate_caches()
+        self.refreshes += 1
+        self.added.extend(added)
+        self.removed.extend(removed)
+        return {"added": added, "removed": removed}
+
+    def tick(self):
+        started = time.perf_counter()
+        changed, stats = self.is_changed()
+        delta = None
+        if changed:
+            delta = self.refresh()
+
+        self.ticks += 1
+        self.last_stats = stats
+        self.max_stats = max(self.max_stats, stats)
+        self.last_elapsed = time.perf_counter() - started
+        self.max_elapsed = max(self.max_elapsed, self.last_elapsed)
+        self.total_elapsed += self.last_elapsed
+        return delta
+
+    def as_dict(self):
+        return {"venv_prefix": self.venv_prefix,
+                "site_dir": self.site_dir,
+                "ticks": self.ticks,
+                "refreshes": self.refreshes,
+                "last_stats": self.last_stats,
+                "max_stats": self.max_stats,
+                "last_elapsed": self.last_elapsed,
+                "max_elapsed": self.max_elapsed,
+                "total_elapsed": self.total_elapsed,
+                "added": self.added,
+                "removed": self.removed}
+
+
+def start_watch(venv_prefix=None):
+    global _watcher
+
+    if venv_prefix is None:
+        venv_prefix = _current_venv_prefix
+    if venv_prefix is None:
+        _watcher = None
+        return None
+
+    _watcher = SitePackagesWatcher(venv_prefix)
+    return _watcher
+
+
+def stop_watch():
+    global _watcher
+
+    _watcher = None
+
+
+def watch_tick():
+    # Follow switches made by switch_venv() and deactivate()
+    if _watcher is None or _watcher.venv_prefix != _current_venv_prefix:
+        if start_watch() is None:
+            return None
+
+    delta = _watcher.tick()
+    if delta is not None and (delta["added"] or delta["removed"]):
+        remember_venv_state(_watcher.venv_prefix)
+        update_module_index(_watcher.venv_prefix)
+    return delta
+
+
+def get_watch_report():
+    if _watcher is None:
+        return None
+
+    return _watcher.as_dict()
+
+
+def format_watch_report():
+    report = get_watch_report()
+    if report is None:
+        return "py3venv: site-packages is not watched"
+
+    lines = ["py3venv: watching {} ({} ticks, {} refreshes)".format(
+        report["site_dir"], report["ticks"], report["refreshes"]),
+        "  per tick: {} stat calls at most, {:.3f} ms last, "
+        "{:.3f} ms max".format(report["max_stats"],
+                               report["last_elapsed"] * 1000,
+                               report["max_elapsed"] * 1000)]
+    for path in report["added"]:
+        lines.append("  added:   {}".format(path))
+    for path in report["removed"]:
+        lines.append("  removed: {}".format(path))
+    return "\n".join(lines)
+
+
+def make_probe_command(venv_prefix):
+    executable = make_venv_executable_path(venv_prefix)
+    if executable is None:
+        return None
+
+    # sys.path[0] of "-c" is dropped by the script itself
+    return [executable, "-c", PROBE_SCRIPT]
+
+
+def make_probe_cache_path(executable):
+    import hashlib
+
+    key = os.path.abspath(executable)
+    digest = hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()
+    return os.path.join(get_cache_dir(), "probe", digest + ".json")
+
+
+def make_probe_fingerprint(venv_prefix, executable):
+    # The interpreter binary decides the search path; site-packages
+    # covers .pth files added or removed since the last probe.
+    return {"executable": get_stat_fingerprint(executable),
+            "site_packages": get_stat_fingerprint(
+                make_site_packages_path(venv_prefix))}
+
+
+def load_probe_result(venv_prefix):
+    import json
+
+    executable = make_venv_executable_path(venv_prefix)
+    if executable is None:
+        return None
+
+    try:
+        with open(make_probe_cache_path(executable),
+                  encoding="utf-8") as cache_file:
+            cached = json.load(cache_file)
+    except (EnvironmentError, ValueError):
+        return None
+
+    if (type(cached) is not dict or
+            cached.get("version") != PROBE_CACHE_VERSION or
+            cached.get("fingerprint") != make_probe_fingerprint(
+                venv_prefix, executable)):
+        return None
+
+    return cached.get("result")
+
+
+def parse_probe_output(venv_prefix, output):
+    import json
+
+    try:
+        result = json.loads(output)
+        if (type(result) is not dict or
+                not all(isinstance(path, str) for path in result["path"]) or
+                not isinstance(result["prefix"], str) or
+                not isinstance(result["exec_prefix"], str)):
+            return None
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    executable = make_venv_executable_path(venv_prefix)
+    if executable is not None:
+        cached = {"version": PROBE_CACHE_VERSION,
+                  "fingerprint": make_probe_fingerprint(venv_prefix,
+                                                        executable),
+                  "result": result}
+        write_cache_file_atomically(
+            make_probe_cache_path(executable),
+            json.dumps(cached, sort_keys=True).encode("utf-8"))
+
+    return result
+
+
+def probe_venv(venv_prefix):
+    import subprocess
+
+    result = load_probe_result(venv_prefix)
+    if result is not None:
+        return result
+
+    command = make_probe_command(venv_prefix)
+    if command is None:
+        return None
+
+    try:
+        output = subprocess.check_output(command, stdin=subprocess.DEVNULL,
+                                         universal_newlines=True)
+    except (EnvironmentError, subprocess.CalledProcessError):
+        return None
+
+    return parse_probe_output(venv_prefix, output)
+
+
+def apply_probe_result(venv_prefix, result):
+    global _activated_venv_prefix, _current_venv_prefix
+
+    if result is None or not is_valid_version(result.get("version")):
+        return None
+
+    old_syspath = get_baseline_sys_state()["path"]
+    apply_sys_state({"executable": make_venv_executable_path(venv_prefix),
+                     "prefix": result["prefix"],
+                     "exec_prefix": result["exec_prefix"],
+                     "path": result["path"]})
+    # The child process has run them for itself only, e.g. the finders
+    # of editable installs and the shim of setuptools.
+    run_pth_imports(find_pth_imports(result.get("site_dirs") or []))
+
+    _activated_venv_prefix = venv_prefix
+    _current_venv_prefix = venv_prefix
+    finish_activation(venv_prefix)
+    reconcile_modules(old_syspath)
+    update_module_index(venv_prefix)
+    start_preload()
+    start_precompile(venv_prefix)
+    return venv_prefix
+
+
+def begin_async_activation(venv_prefix=None, discover_path=None):
+    global _activation_done, _pending_probe
+
+    if _activation_done:
+        return None
+
+    probe_venv_prefix = venv_prefix
+    if probe_venv_prefix is None:
+        probe_venv_prefix = get_venv_prefix()
+        if probe_venv_prefix is None and discover_path is not None:
+            probe_venv_prefix = find_venv_prefix(discover_path)
+
+    command = None
+    if probe_venv_prefix is not None:
+        command = make_probe_command(probe_venv_prefix)
+    if command is None:
+        ensure_activated(venv_prefix, discover_path=discover_path)
+        return None
+
+    # Don't let anything activate in-process while the probe runs
+    _activation_done = True
+    result = load_probe_result(probe_venv_prefix)
+    if result is not None:
+        apply_probe_result(probe_venv_prefix, result)
+        return None
+
+    _pending_probe = (probe_venv_prefix, venv_prefix, discover_path)
+    return command
+
+
+def get_pending_probe_command():
+    if _pending_probe is None:
+        return None
+
+    return make_probe_command(_pending_probe[0])
+
+
+def end_async_activation(output):
+    global _activation_done, _pending_probe
+
+    if _pending_probe is None:
+        return None
+    probe_venv_prefix, venv_prefix, discover_path = _pending_probe
+    _pending_probe = None
+
+    new_venv_prefix = apply_probe_result(
+        probe_venv_prefix, parse_probe_output(probe_venv_prefix, output))
+    if new_venv_prefix is None:
+        # Fall back to the in-process activation
+        _activation_done = False
+        new_venv_prefix = ensure_activated(venv_prefix,
+                                           discover_path=discover_path)
 
     return new_venv_prefix
+
+
+def get_pycache_prefix(site_dir):
+    pycache_prefix = sys.pycache_prefix
+    if _saved_pycache_prefix is not NOT_FOUND:
+        pycache_prefix = _saved_pycache_prefix
+    if pycache_prefix is not None:
+        return pycache_prefix
+
+    # Only read-only venvs need bytecode outside of __pycache__
+    if not PRECOMPILE_USER_CACHE or os.access(site_dir, os.W_OK):
+        return None
+
+    return os.path.join(get_cache_dir(), "pycache")
+
+
+def set_pycache_prefix(pycache_prefix):
+    global _saved_pycache_prefix
+
+    # This applies to every import in the process, the standard library
+    # included, until restore_pycache_prefix() is called.
+    if _saved_pycache_prefix is NOT_FOUND:
+        _saved_pycache_prefix = sys.pycache_prefix
+    sys.pycache_prefix = pycache_prefix
+
+
+def restore_pycache_prefix():
+    global _saved_pycache_prefix
+
+    if _saved_pycache_prefix is NOT_FOUND:
+        return
+
+    sys.pycache_prefix = _saved_pycache_prefix
+    _saved_pycache_prefix = NOT_FOUND
+
+
+def count_source_files(site_dir):
+    count = 0
+    for dir_path, dir_names, file_names in os.walk(site_dir):
+        dir_names[:] = [name for name in dir_names if name != "__pycache__"]
+        count += sum(1 for name in file_names if name.endswith(".py"))
+    return count
+
+
+def read_precompile_output(process, report):
+    started = time.perf_counter()
+    report["sources"] = count_source_files(report["site_dir"])
+    for line in process.stdout:
+        # compileall prints a line for each stale file it compiles
+        if line.startswith("Compiling "):
+            report["compiled"] += 1
+        elif line.startswith("*** "):
+            report["errors"] += 1
+    process.stdout.close()
+    report["returncode"] = process.wait()
+    report["elapsed"] = time.perf_counter() - started
+    report["running"] = False
+
+
+def start_precompile(venv_prefix):
+    global _precompile_report
+    import subprocess
+    import threading
+
+    if not PRECOMPILE_BYTECODE or venv_prefix is None:
+        return None
+    if _precompile_report is not None and _precompile_report["running"]:
+        return None
+
+    executable = make_venv_executable_path(venv_prefix)
+    site_dir = make_site_packages_path(venv_prefix)
+    if executable is None or not os.path.isdir(site_dir):
+        return None
+
+    env = os.environ.copy()
+    pycache_prefix = get_pycache_prefix(site_dir)
+    if pycache_prefix is not None:
+        env["PYTHONPYCACHEPREFIX"] = pycache_prefix
+        # Imports in this process have to look there too
+        set_pycache_prefix(pycache_prefix)
+
+    # The venv's python compiles for its own version, which is the
+    # version of this process as activation has checked.
+    command = [executable, "-c", PRECOMPILE_SCRIPT,
+               "-j", str(max(PRECOMPILE_WORKERS, 0)), site_dir]
+    creationflags = 0
+    if sys.platform == "win32":
+        creationflags = subprocess.BELOW_NORMAL_PRIORITY_CLASS
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, env=env,
+                                   universal_newlines=True,
+                                   creationflags=creationflags)
+    except EnvironmentError:
+        return None
+
+    _precompile_report = {"venv_prefix": venv_prefix,
+                          "site_dir": site_dir,
+                          "pycache_prefix": pycache_prefix,
+                          "running": True,
+                          "sources": None,
+                          "compiled": 0,
+                          "errors": 0,
+                          "returncode": None,
+                          "elapsed": None}
+    thread = threading.Thread(target=read_precompile_output,
+                              args=(process, _precompile_report),
+                              name="py3venv-precompile", daemon=True)
+    thread.start()
+    return thread
+
+
+def get_precompile_report():
+    if _precompile_report is None:
+        return None
+
+    return dict(_precompile_report)
+
+
+def format_precompile_report():
+    report = get_precompile_report()
+    if report is None:
+        return "py3venv: bytecode is not precompiled"
+
+    state = "running"
+    if not report["running"]:
+        state = "finished in {:.3f} s, exit status {}".format(
+            report["elapsed"], report["returncode"])
+    lines = ["py3venv: precompiling {} ({})".format(report["site_dir"],
+                                                    state),
+             "  {} stale of {} source files compiled, {} errors".format(
+                 report["compiled"], report["sources"], report["errors"])]
+    if report["pycache_prefix"] is not None:
+        lines.append("  into {}".format(report["pycache_prefix"]))
+    return "\n".join(lines)
+
+
+def find_audit_targets(root):
+    # The root itself, or venvs in its children and their .venv/venv
+    venv_prefix = find_local_venv(root)
+    if venv_prefix is not None:
+        return [venv_prefix]
+
+    try:
+        with os.scandir(root) as entries:
+            child_paths = sorted(entry.path for entry in entries
+                                 if entry.is_dir())
+    except EnvironmentError:
+        return []
+
+    targets = []
+    for child_path in child_paths:
+        venv_prefix = find_local_venv(child_path)
+        if venv_prefix is not None:
+            targets.append(venv_prefix)
+    return targets
+
+
+def audit_venv(venv_prefix):
+    kind = None
+    version = get_venv_version(venv_prefix)
+    if version is not None:
+        kind = "venv"
+    else:
+        version = get_virtualenv_version(venv_prefix)
+        if version is not None:
+            kind = "virtualenv"
+
+    executable = make_venv_executable_path(venv_prefix)
+    problems = []
+    if kind is None:
+        problems.append("no pyvenv.cfg or orig-prefix.txt")
+    elif not is_valid_version(version):
+        problems.append("version mismatch")
+    if not is_valid_lib_path(venv_prefix):
+        problems.append("no lib path")
+    if executable is None:
+        problems.append("no executable")
+    if (kind == "virtualenv" and
+            get_virtualenv_activate_this_path(venv_prefix) is None):
+        problems.append("no activate_this.py")
+
+    return {"venv_prefix": venv_prefix,
+            "kind": kind,
+            "version": version,
+            "executable": executable,
+            "activatable": not problems,
+            "problems": problems}
+
+
+def audit(roots, jobs=None, output=None):
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+
+    if output is None:
+        output = sys.stdout
+
+    started = time.perf_counter()
+    summary = {"venvs": 0, "activatable": 0}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        targets = []
+        for root_targets in executor.map(find_audit_targets, roots):
+            targets.extend(root_targets)
+
+        # Results are written in order as soon as they are ready
+        for result in executor.map(audit_venv, targets):
+            output.write(json.dumps(result, sort_keys=True) + "\n")
+            output.flush()
+            summary["venvs"] += 1
+            if result["activatable"]:
+                summary["activatable"] += 1
+
+    summary["elapsed"] = time.perf_counter() - started
+    summary["throughput"] = summary["venvs"] / max(summary["elapsed"], 1e-9)
+    return summary
+
+
+def format_audit_summary(summary):
+    return ("py3venv: audited {} venvs in {:.3f} s ({:.1f} venvs/s), "
+            "{} activatable, {} not".format(
+                summary["venvs"], summary["elapsed"], summary["throughput"],
+                summary["activatable"],
+                summary["venvs"] - summary["activatable"]))
+
+
+def get_catalog_roots(roots=None):
+    if roots is None:
+        roots = CATALOG_ROOTS
+
+    catalog_roots = []
+    for root in ([os.environ.get("WORKON_HOME"),
+                  os.path.join("~", ".virtualenvs")] + list(roots)):
+        if not root:
+            continue
+        root = os.path.abspath(os.path.expanduser(root))
+        if root not in catalog_roots:
+            catalog_roots.append(root)
+    return catalog_roots
+
+
+def make_catalog_path():
+    return os.path.join(get_cache_dir(), "catalog.json")
+
+
+def load_catalog():
+    import json
+
+    try:
+        with open(make_catalog_path(), encoding="utf-8") as catalog_file:
+            catalog = json.load(catalog_file)
+    except (EnvironmentError, ValueError):
+        catalog = None
+
+    # Activatability depends on the version of the running python
+    if (type(catalog) is not dict or
+            catalog.get("version") != CATALOG_VERSION or
+            catalog.get("python") != list(sys.version_info[:3]) or
+            type(catalog.get("roots")) is not dict):
+        catalog = {"version": CATALOG_VERSION,
+                   "python": list(sys.version_info[:3]),
+                   "roots": {}}
+    return catalog
+
+
+def save_catalog(catalog):
+    import json
+
+    return write_cache_file_atomically(
+        make_catalog_path(),
+        json.dumps(catalog, sort_keys=True).encode("utf-8"))
+
+
+def get_dir_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except EnvironmentError:
+        return None
+
+
+def make_catalog_entry(venv_prefix):
+    forget_venv(venv_prefix)
+    result = audit_venv(venv_prefix)
+    return {"venv_prefix": venv_prefix,
+            "mtime": get_dir_mtime(venv_prefix),
+            "kind": result["kind"],
+            "version": result["version"],
+            "activatable": result["activatable"]}
+
+
+def scan_catalog_root(root, old_venvs):
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Only new venvs and the ones whose own directory has changed are
+    # audited again.
+    old_entries = {entry["venv_prefix"]: entry for entry in old_venvs}
+    venvs = []
+    for venv_prefix in find_audit_targets(root):
+        entry = old_entries.get(venv_prefix)
+        if entry is not None and entry["mtime"] != get_dir_mtime(venv_prefix):
+            entry = None
+        venvs.append(entry or venv_prefix)
+
+    stale_prefixes = [venv for venv in venvs if isinstance(venv, str)]
+    if stale_prefixes:
+        with ThreadPoolExecutor() as executor:
+            new_entries = dict(zip(stale_prefixes,
+                                   executor.map(make_catalog_entry,
+                                                stale_prefixes)))
+        venvs = [new_entries.get(venv, venv) if isinstance(venv, str)
+                 else venv
+                 for venv in venvs]
+    return venvs
+
+
+def refresh_catalog(roots=None):
+    global _catalog
+
+    if _catalog is None:
+        _catalog = load_catalog()
+
+    changed = False
+    catalog_roots = {}
+    for root in get_catalog_roots(roots):
+        mtime = get_dir_mtime(root)
+        if mtime is None:
+            continue
+        root_entry = _catalog["roots"].get(root)
+        if root_entry is None or root_entry["mtime"] != mtime:
+            old_venvs = [] if root_entry is None else root_entry["venvs"]
+            root_entry = {"mtime": mtime,
+                          "venvs": scan_catalog_root(root, old_venvs)}
+            changed = True
+        catalog_roots[root] = root_entry
+
+    if changed or set(catalog_roots) != set(_catalog["roots"]):
+        _catalog["roots"] = catalog_roots
+        save_catalog(_catalog)
+
+    return [entry for root in sorted(catalog_roots)
+            for entry in catalog_roots[root]["venvs"]]
+
+
+def complete_venvs(arglead, roots=None):
+    expanded_arglead = os.path.expanduser(arglead)
+    candidates = []
+    for entry in refresh_catalog(roots):
+        venv_prefix = entry["venv_prefix"]
+        if entry["activatable"] and (
+                os.path.basename(venv_prefix).startswith(arglead) or
+                venv_prefix.startswith(expanded_arglead)):
+            candidates.append(venv_prefix)
+    return sorted(candidates, key=os.path.basename)
+
+
+def find_catalog_venv(name, roots=None):
+    path = os.path.expanduser(name)
+    if os.path.isdir(path):
+        return os.path.abspath(path)
+
+    for entry in refresh_catalog(roots):
+        if (entry["activatable"] and
+                os.path.basename(entry["venv_prefix"]) == name):
+            return entry["venv_prefix"]
+    return None
+
+
+def positive_int(value):
+    import argparse
+
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            "must be a positive integer: {!r}".format(value))
+    return number
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m py3venv")
+    subparsers = parser.add_subparsers(dest="command")
+    audit_parser = subparsers.add_parser(
+        "audit", help="check which venvs under the roots can be activated")
+    audit_parser.add_argument("roots", nargs="+", metavar="root")
+    audit_parser.add_argument("-j", "--jobs", type=positive_int,
+                              default=None,
+                              help="number of worker threads")
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_usage(sys.stderr)
+        return 2
+
+    summary = audit(args.roots, jobs=args.jobs)
+    print(format_audit_summary(summary), file=sys.stderr)
+    return 0 if summary["activatable"] == summary["venvs"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,6 +10,12 @@ if !has('python3')
   finish
 endif
 
+" os.scandir(), ordered dicts and sys.pycache_prefix
+if !py3eval('__import__("sys").version_info >= (3, 8)')
+  echomsg "Error: Required vim compiled with Python 3.8 or later"
+  finish
+endif
+
 if exists("g:loaded_py3venv")
   finish
 endif
@@ -18,13 +24,21 @@ let g:loaded_py3venv = 1
 let s:save_cpo = &cpo
 set cpo&vim
 
+let s:plugin_path = expand('<sfile>:p:h')
+
+function! s:Import()
+  if exists('s:imported')
+    return
+  endif
+  let s:imported = 1
+
 python3 << PYTHONEOF
 try:
     class DummyClassForLocalScope():
         import sys
         import vim
 
-        plugin_path = vim.eval('expand("<sfile>:p:h")')
+        plugin_path = vim.eval('s:plugin_path')
         sys.path.insert(0, plugin_path)
         import py3venv
 
@@ -32,12 +46,214 @@ try:
         if plugin_path in sys.path:
             sys.path.remove(plugin_path)
 
-        py3venv.activate()
+        raise RuntimeError
+except RuntimeError:
+    pass
+PYTHONEOF
+endfunction
+
+function! s:Activate()
+  if exists('s:activated')
+    return
+  endif
+  let s:activated = 1
+
+  if exists('#py3venv_lazy')
+    autocmd! py3venv_lazy
+  endif
+
+  call s:Import()
+
+python3 << PYTHONEOF
+try:
+    class DummyClassForLocalScope():
+        import vim
+        import py3venv
+
+        if vim.eval('exists("g:py3venv_pool_size")') != "0":
+            py3venv.VENV_POOL_SIZE = int(vim.eval('g:py3venv_pool_size'))
+        py3venv.OPTIMIZE_SYSPATH = (
+            vim.eval('get(g:, "py3venv_optimize_syspath", 0)') != "0")
+        py3venv.USE_MODULE_INDEX = (
+            vim.eval('get(g:, "py3venv_module_index", 0)') != "0")
+        py3venv.PRELOAD_MODULES = tuple(
+            vim.eval('get(g:, "py3venv_preload", [])'))
+        py3venv.TRACE_MEMORY = (
+            vim.eval('get(g:, "py3venv_trace_memory", 0)') != "0")
+        if vim.eval('exists("g:py3venv_watch_stat_budget")') != "0":
+            py3venv.WATCH_STAT_BUDGET = int(
+                vim.eval('g:py3venv_watch_stat_budget'))
+        py3venv.ZIP_SITE_PACKAGES = (
+            vim.eval('get(g:, "py3venv_zip_site_packages", 0)') != "0")
+        py3venv.PRECOMPILE_BYTECODE = (
+            vim.eval('get(g:, "py3venv_precompile", 0)') != "0")
+        py3venv.PRECOMPILE_WORKERS = int(
+            vim.eval('get(g:, "py3venv_precompile_workers", 0)'))
+        # For a read-only venv, this sets sys.pycache_prefix, so every
+        # module imported by the editor, the standard library included,
+        # uses bytecode under the cache directory until the venv is
+        # deactivated or another venv is switched to.
+        py3venv.PRECOMPILE_USER_CACHE = (
+            vim.eval('get(g:, "py3venv_precompile_cache", 0)') != "0")
+        use_cache = vim.eval('get(g:, "py3venv_use_cache", 1)')
+        profile_log = vim.eval('expand(get(g:, "py3venv_profile_log", ""))')
+        discover_path = None
+        if vim.eval('get(g:, "py3venv_discover", 0)') != "0":
+            discover_path = vim.eval('expand("%:p:h")') or vim.eval('getcwd()')
+        if (vim.eval('get(g:, "py3venv_async", 0)') != "0" and
+                vim.eval('has("job")') != "0"):
+            # The search path comes from the venv's python run as a job
+            py3venv.begin_async_activation(discover_path=discover_path)
+        else:
+            py3venv.ensure_activated(use_cache=bool(int(use_cache)),
+                                     profile_log=profile_log or None,
+                                     discover_path=discover_path)
 
         raise RuntimeError
 except RuntimeError:
     pass
 PYTHONEOF
 
+  let l:command = py3eval('__import__("py3venv").get_pending_probe_command()')
+  if type(l:command) == v:t_list
+    let s:probe_output = []
+    let s:probe_job = job_start(l:command, {
+          \ 'out_cb': function('s:ProbeOutput'),
+          \ 'close_cb': function('s:ProbeClosed')})
+  endif
+
+  if get(g:, 'py3venv_watch', 0) && has('timers')
+    python3 __import__("py3venv").start_watch()
+    let s:watch_timer = timer_start(get(g:, 'py3venv_watch_interval', 2000),
+          \ function('s:WatchTick'), {'repeat': -1})
+  endif
+endfunction
+
+function! s:ProbeOutput(channel, msg)
+  call add(s:probe_output, a:msg)
+endfunction
+
+function! s:ProbeClosed(channel)
+  while ch_status(a:channel, {'part': 'out'}) ==# 'buffered'
+    call add(s:probe_output, ch_read(a:channel))
+  endwhile
+  let l:output = join(s:probe_output, "\n")
+  python3 __import__("py3venv").end_async_activation(
+        \ __import__("vim").eval('l:output'))
+endfunction
+
+function! s:WatchTick(timer)
+  python3 __import__("py3venv").watch_tick()
+endfunction
+
+function! s:FollowBuffer()
+  " Still lazy.  'autocmd!' doesn't delete the py3venv_lazy group.
+  if !exists('s:activated') && !exists('b:py3venv_prefix')
+    return
+  endif
+  call s:Activate()
+
+python3 << PYTHONEOF
+try:
+    class DummyClassForLocalScope():
+        import vim
+        import py3venv
+
+        use_cache = vim.eval('get(g:, "py3venv_use_cache", 1)')
+        venv_prefix = vim.eval('get(b:, "py3venv_prefix", "")')
+        if (not venv_prefix and vim.eval('&buftype') == "" and
+                vim.eval('get(g:, "py3venv_discover", 0)') != "0"):
+            dir_path = vim.eval('expand("%:p:h")')
+            if dir_path:
+                venv_prefix = py3venv.find_venv_prefix(dir_path)
+        py3venv.switch_venv(venv_prefix or py3venv.ensure_activated(),
+                            use_cache=bool(int(use_cache)))
+
+        raise RuntimeError
+except RuntimeError:
+    pass
+PYTHONEOF
+endfunction
+
+function! s:Profile()
+  call s:Import()
+  python3 print(__import__("py3venv").format_activation_profile())
+  python3 print(__import__("py3venv").format_preload_report())
+  python3 print(__import__("py3venv").format_watch_report())
+  python3 print(__import__("py3venv").format_precompile_report())
+endfunction
+
+function! s:Deactivate()
+  call s:Import()
+  python3 print(__import__("py3venv").format_deactivation(
+        \ __import__("py3venv").deactivate()))
+endfunction
+
+function! s:ActivateCommand(name)
+  call s:Activate()
+  if a:name ==# ''
+    return
+  endif
+
+python3 << PYTHONEOF
+try:
+    class DummyClassForLocalScope():
+        import sys
+        import vim
+        import py3venv
+
+        name = vim.eval('a:name')
+        roots = vim.eval('map(copy(get(g:, "py3venv_roots", [])), '
+                         '"expand(v:val)")')
+        venv_prefix = py3venv.find_catalog_venv(name, roots)
+        if venv_prefix is None:
+            print("py3venv: no such venv: {}".format(name), file=sys.stderr)
+        else:
+            use_cache = vim.eval('get(g:, "py3venv_use_cache", 1)')
+            py3venv.switch_venv(venv_prefix, use_cache=bool(int(use_cache)))
+
+        raise RuntimeError
+except RuntimeError:
+    pass
+PYTHONEOF
+endfunction
+
+function! s:CompleteVenvs(arglead, cmdline, cursorpos)
+  call s:Import()
+  let l:roots = map(copy(get(g:, 'py3venv_roots', [])), 'expand(v:val)')
+  return py3eval('__import__("py3venv").complete_venvs('
+        \ . '__import__("vim").eval("a:arglead"), '
+        \ . '__import__("vim").eval("l:roots"))')
+endfunction
+
+command! -bar -nargs=? -complete=customlist,s:CompleteVenvs
+      \ Py3venvActivate call s:ActivateCommand(<q-args>)
+command! -bar Py3venvDeactivate call s:Deactivate()
+command! -bar Py3venvProfile call s:Profile()
+
+if get(g:, 'py3venv_follow_buffer', 0)
+  augroup py3venv_follow_buffer
+    autocmd!
+    autocmd BufEnter * call s:FollowBuffer()
+  augroup END
+endif
+
+if get(g:, 'py3venv_lazy', 0)
+  " Other plugins can run ':doautocmd User Py3venvRequired' before their
+  " python3 code.  g:py3venv_lazy_funcs lists patterns of autoload
+  " functions, e.g. ['jedi#*'], whose first call activates the venv.
+  augroup py3venv_lazy
+    autocmd!
+    autocmd FileType python call s:Activate()
+    autocmd User Py3venvRequired call s:Activate()
+    for s:pattern in get(g:, 'py3venv_lazy_funcs', [])
+      execute 'autocmd FuncUndefined' s:pattern 'call s:Activate()'
+    endfor
+    unlet! s:pattern
+  augroup END
+else
+  call s:Activate()
+endif
+
 let &cpo = s:save_cpo
 unlet s:save_cpo
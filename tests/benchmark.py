@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# vim:fileencoding=utf-8
+
+# Copyright (c) 2013 Masami HIRATA <msmhrt@gmail.com>
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "benchmark_baseline.json")
+DEFAULT_ITERATIONS = 50
+DEFAULT_TOLERANCE = 3.0
+SAVED_SYS_ATTRS = ("path", "executable", "prefix", "exec_prefix",
+                   "real_prefix", "_home", "__egginsert")
+
+ACTIVATE_THIS_SOURCE = """\
+import os
+import site
+import sys
+
+bin_dir = os.path.dirname(os.path.abspath(__file__))
+base = os.path.dirname(bin_dir)
+
+os.environ["PATH"] = os.pathsep.join(
+    [bin_dir] + os.environ.get("PATH", "").split(os.pathsep))
+os.environ["VIRTUAL_ENV"] = base
+
+prev_length = len(sys.path)
+site.addsitedir(os.path.realpath(os.path.join(base, {site_packages!r})))
+sys.path[:] = sys.path[prev_length:] + sys.path[0:prev_length]
+
+sys.real_prefix = sys.prefix
+sys.prefix = base
+"""
+
+
+def import_py3venv():
+    plugin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    plugin_dir = os.path.join(plugin_dir, "plugin")
+    if sys.path[0] != plugin_dir:
+        sys.path.insert(0, plugin_dir)
+    import py3venv
+    return py3venv
+
+
+def write_file(path, content=""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(content)
+
+
+def make_synthetic_venv(root, name="venv", kind="venv", packages=20,
+                        pth_files=5, editables=5, depth=3):
+    py3venv = import_py3venv()
+    venv_prefix = os.path.join(root, name)
+    site_packages_path = os.path.join(venv_prefix,
+                                      py3venv.SITE_PACKAGES_PATH)
+    bin_path = os.path.join(venv_prefix, py3venv.BIN_PATH)
+    os.makedirs(site_packages_path)
+    os.makedirs(bin_path)
+
+    if kind == "venv":
+        write_file(os.path.join(venv_prefix, "pyvenv.cfg"),
+                   "home = {}\ninclude-system-site-packages = false\n"
+                   "version = {}.{}.{}\n".format(
+                       os.path.dirname(sys.executable), *sys.version_info))
+        write_file(os.path.join(bin_path, py3venv.make_prognames()[0]))
+    elif kind == "virtualenv":
+        write_file(os.path.join(venv_prefix, py3venv.LIB_PATH,
+                                "orig-prefix.txt"),
+                   sys.base_prefix)
+        write_file(os.path.join(bin_path, "activate_this.py"),
+                   ACTIVATE_THIS_SOURCE.format(
+                       site_packages=py3venv.SITE_PACKAGES_PATH))
+    else:
+        raise ValueError("unknown kind: {!r}".format(kind))
+
+    for number in range(packages):
+        package_path = os.path.join(site_packages_path,
+                                    "synthetic_pkg{}".format(number))
+        for level in range(max(depth, 1)):
+            write_file(os.path.join(package_path, "__init__.py"))
+            write_file(os.path.join(package_path, "module.py"),
+                       "VALUE = {}\n".format(level))
+            package_path = os.path.join(package_path,
+                                        "sub{}".format(level))
+
+    for number in range(editables):
+        source_path = os.path.join(root, name + "-src",
+                                   "project{}".format(number), "src")
+        write_file(os.path.join(source_path,
+                                "editable{}".format(number),
+                                "__init__.py"))
+        write_file(os.path.join(site_packages_path,
+                                "__editable__.project{}.pth".format(number)),
+                   source_path + "\n")
+
+    for number in range(pth_files):
+        lines = ["# synthetic .pth file {}".format(number),
+                 os.path.join(root, name + "-extra{}".format(number))]
+        os.makedirs(lines[-1], exist_ok=True)
+        if number % 2:
+            lines.append("import sys")
+        write_file(os.path.join(site_packages_path,
+                                "synthetic{}.pth".format(number)),
+                   "\n".join(lines) + "\n")
+
+    return venv_prefix
+
+
+class SavedState:
+    def __init__(self):
+        self.py3venv = import_py3venv()
+
+    def __enter__(self):
+        py3venv = self.py3venv
+        self.environ = os.environ.copy()
+        self.saved_sys_attrs = py3venv.fix_sys_attrs(
+            dict.fromkeys(SAVED_SYS_ATTRS, py3venv.AS_IS))
+        self.site = sys.modules.get("site")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.py3venv.recover_sys_attrs(self.saved_sys_attrs)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        if self.site is not None:
+            sys.modules["site"] = self.site
+        return False
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    index = min(int(round(fraction * (len(samples) - 1))), len(samples) - 1)
+    return samples[index]
+
+
+def measure(function, iterations=DEFAULT_ITERATIONS, setup=None):
+    samples = []
+    for _ in range(iterations):
+        with SavedState():
+            if setup is not None:
+                setup()
+            started = time.perf_counter()
+            function()
+            samples.append(time.perf_counter() - started)
+
+    with SavedState():
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            function()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {"p50": percentile(samples, 0.50),
+            "p95": percentile(samples, 0.95),
+            "peak_memory": peak_memory,
+            "iterations": iterations}
+
+
+def make_benchmarks(root, **layout):
+    py3venv = import_py3venv()
+    venv_prefix = make_synthetic_venv(root, "venv", "venv", **layout)
+    virtualenv_prefix = make_synthetic_venv(root, "virtualenv",
+                                            "virtualenv", **layout)
+
+    def activated(prefix):
+        def setup():
+            os.environ["VIRTUAL_ENV"] = prefix
+            py3venv.clear_venv_info_cache()
+            py3venv.clear_venv_layout_cache()
+        return setup
+
+    activate_this_path = py3venv.get_virtualenv_activate_this_path(
+        virtualenv_prefix)
+
+    def compile_activate_this():
+        with open(activate_this_path, encoding="iso8859-1") as activate_file:
+            compile(activate_file.read(), activate_this_path, "exec")
+
+    def run_site_main():
+        sys.executable = py3venv.make_venv_executable_path(venv_prefix)
+        py3venv.reset_syspath()
+        py3venv.run_site_main()
+
+    return [("activate", activated(venv_prefix),
+             lambda: py3venv.activate(venv_prefix, use_cache=False)),
+            ("activate_cached", activated(venv_prefix),
+             lambda: py3venv.activate(venv_prefix)),
+            ("activate_venv", activated(venv_prefix),
+             lambda: py3venv.activate_venv(venv_prefix)),
+            ("activate_virtualenv", activated(virtualenv_prefix),
+             lambda: py3venv.activate_virtualenv(virtualenv_prefix)),
+            ("activate_this_compile", None, compile_activate_this),
+            ("activate_this_cached", None,
+             lambda: py3venv.load_activate_this_code(activate_this_path)),
+            ("reset_syspath", None, py3venv.reset_syspath),
+            ("site_main", activated(venv_prefix), run_site_main)]
+
+
+def run_benchmarks(iterations=DEFAULT_ITERATIONS, **layout):
+    root = tempfile.mkdtemp(prefix="py3venv-benchmark-")
+    saved_cache_home = os.environ.get("XDG_CACHE_HOME")
+    os.environ["XDG_CACHE_HOME"] = os.path.join(root, "cache")
+    try:
+        results = {}
+        for name, setup, function in make_benchmarks(root, **layout):
+            results[name] = measure(function, iterations, setup)
+    finally:
+        if saved_cache_home is None:
+            os.environ.pop("XDG_CACHE_HOME", None)
+        else:
+            os.environ["XDG_CACHE_HOME"] = saved_cache_home
+        shutil.rmtree(root, ignore_errors=True)
+
+    return results
+
+
+def load_baseline(path=BASELINE_PATH):
+    try:
+        with open(path, encoding="utf-8") as baseline_file:
+            return json.load(baseline_file)
+    except (EnvironmentError, ValueError):
+        return None
+
+
+def save_baseline(results, path=BASELINE_PATH, tolerance=DEFAULT_TOLERANCE):
+    baseline = {"tolerance": tolerance,
+                "benchmarks": {name: {"p50": result["p50"],
+                                      "p95": result["p95"]}
+                               for name, result in results.items()}}
+    with open(path, "w", encoding="utf-8") as baseline_file:
+        json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        baseline_file.write("\n")
+
+
+def find_regressions(results, baseline):
+    if baseline is None:
+        return []
+
+    tolerance = baseline.get("tolerance", DEFAULT_TOLERANCE)
+    regressions = []
+    for name, expected in sorted(baseline.get("benchmarks", {}).items()):
+        result = results.get(name)
+        if result is None:
+            continue
+        for key in ("p50", "p95"):
+            if result[key] > expected[key] * tolerance:
+                regressions.append("{}: {} {:.3f} ms > {:.3f} ms x {}".format(
+                    name, key, result[key] * 1000, expected[key] * 1000,
+                    tolerance))
+    return regressions
+
+
+def format_results(results):
+    lines = ["{:<22} {:>10} {:>10} {:>12}".format(
+        "benchmark", "p50 ms", "p95 ms", "peak KiB")]
+    for name, result in results.items():
+        lines.append("{:<22} {:10.3f} {:10.3f} {:12.1f}".format(
+            name, result["p50"] * 1000, result["p95"] * 1000,
+            result["peak_memory"] / 1024))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark py3venv activation on synthetic venvs")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument("--packages", type=int, default=20)
+    parser.add_argument("--pth-files", type=int, default=5)
+    parser.add_argument("--editables", type=int, default=5)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.iterations, packages=args.packages,
+                             pth_files=args.pth_files,
+                             editables=args.editables, depth=args.depth)
+    print(format_results(results))
+
+    if args.update_baseline:
+        save_baseline(results, args.baseline)
+        return 0
+
+    regressions = find_regressions(results, load_baseline(args.baseline))
+    for regression in regressions:
+        print("REGRESSION " + regression, file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# vim:fileencoding=utf-8
+
+# Copyright (c) 2013 Masami HIRATA <msmhrt@gmail.com>
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from tests import benchmark
+
+
+class TestSyntheticVenv(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        patcher = mock.patch.dict(
+            os.environ,
+            {"XDG_CACHE_HOME": os.path.join(self.temp_dir, "cache")})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.py3venv = benchmark.import_py3venv()
+        self.addCleanup(self.py3venv.clear_venv_info_cache)
+
+    def test_activate_venv(self):
+        py3venv = self.py3venv
+        venv_prefix = benchmark.make_synthetic_venv(
+            self.temp_dir, packages=3, pth_files=2, editables=2, depth=2)
+        site_packages_path = os.path.join(venv_prefix,
+                                          py3venv.SITE_PACKAGES_PATH)
+        with benchmark.SavedState():
+            os.environ["VIRTUAL_ENV"] = venv_prefix
+            self.assertEqual(py3venv.activate(venv_prefix, use_cache=False),
+                             venv_prefix)
+            self.assertIn(site_packages_path, sys.path)
+            for number in range(2):
+                self.assertIn(os.path.join(self.temp_dir, "venv-src",
+                                           "project{}".format(number), "src"),
+                              sys.path)
+                self.assertIn(os.path.join(self.temp_dir,
+                                           "venv-extra{}".format(number)),
+                              sys.path)
+
+    def test_activate_virtualenv(self):
+        py3venv = self.py3venv
+        venv_prefix = benchmark.make_synthetic_venv(
+            self.temp_dir, kind="virtualenv", packages=1, pth_files=0,
+            editables=1, depth=1)
+        with benchmark.SavedState():
+            self.assertEqual(py3venv.activate_virtualenv(venv_prefix),
+                             venv_prefix)
+            self.assertEqual(sys.prefix, venv_prefix)
+            self.assertEqual(os.environ["VIRTUAL_ENV"], venv_prefix)
+        self.assertNotEqual(sys.prefix, venv_prefix)
+
+    def test_activate_this_code_cache(self):
+        py3venv = self.py3venv
+        venv_prefix = benchmark.make_synthetic_venv(
+            self.temp_dir, kind="virtualenv", packages=0, pth_files=0,
+            editables=0)
+        activate_this_path = py3venv.get_virtualenv_activate_this_path(
+            venv_prefix)
+        code = py3venv.load_activate_this_code(activate_this_path)
+        self.assertEqual(code.co_filename, activate_this_path)
+        cache_path = py3venv.make_code_cache_path(activate_this_path)
+        self.assertTrue(os.path.isfile(cache_path))
+
+        with mock.patch("builtins.compile") as mock_compile:
+            cached_code = py3venv.load_activate_this_code(activate_this_path)
+            self.assertFalse(mock_compile.called)
+        self.assertEqual(cached_code, code)
+
+        with open(activate_this_path, "a", encoding="utf-8") as source_file:
+            source_file.write("sys.py3venv_marker = True\n")
+        new_code = py3venv.load_activate_this_code(activate_this_path)
+        self.assertNotEqual(new_code, code)
+        self.assertIn("py3venv_marker", new_code.co_names)
+
+        with open(cache_path, "wb") as cache_file:
+            cache_file.write(b"broken")
+        self.assertEqual(py3venv.load_activate_this_code(activate_this_path),
+                         new_code)
+
+    def test_find_regressions(self):
+        results = {"activate": {"p50": 0.004, "p95": 0.005}}
+        baseline = {"tolerance": 2.0,
+                    "benchmarks": {"activate": {"p50": 0.001,
+                                                "p95": 0.003}}}
+        regressions = benchmark.find_regressions(results, baseline)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith("activate: p50"))
+        self.assertEqual(benchmark.find_regressions(results, None), [])
+
+
+@unittest.skipUnless(os.environ.get("PY3VENV_BENCHMARK"),
+                     "set PY3VENV_BENCHMARK=1 to run benchmarks")
+class TestBenchmark(unittest.TestCase):
+    def test_benchmark(self):
+        results = benchmark.run_benchmarks()
+        regressions = benchmark.find_regressions(results,
+                                                 benchmark.load_baseline())
+        message = "\n".join([benchmark.format_results(results)] +
+                            regressions)
+        self.assertEqual(regressions, [], message)
+        self.assertLess(results["activate_this_cached"]["p50"],
+                        results["activate_this_compile"]["p50"], message)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# vim:fileencoding=utf-8
+
+# Copyright (c) 2013 Masami HIRATA <msmhrt@gmail.com>
+
+import ast
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "plugin")
+
+# Self time of "import py3venv" in microseconds with its bytecode cached
+IMPORT_TIME_BUDGET = int(os.environ.get("PY3VENV_IMPORT_TIME_BUDGET", 5000))
+# Only activation may need these
+DEFERRED_MODULES = ("distutils", "ctypes", "re", "json", "hashlib",
+                    "tempfile", "collections", "threading", "tracemalloc")
+
+# Nothing but sys may be imported before the snapshot of sys.modules
+IMPORT_SCRIPT = """\
+import sys
+before = set(sys.modules)
+sys.path.insert(0, {plugin_dir!r})
+import py3venv
+sys.stdout.write(repr(sorted(set(sys.modules) - before)))
+"""
+
+
+class TestImportTime(unittest.TestCase):
+    def setUp(self):
+        pycache_prefix = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, pycache_prefix, ignore_errors=True)
+        self.env = os.environ.copy()
+        self.env.pop("PYTHONDONTWRITEBYTECODE", None)
+        self.env["PYTHONPYCACHEPREFIX"] = pycache_prefix
+
+    def import_py3venv(self):
+        script = IMPORT_SCRIPT.format(plugin_dir=PLUGIN_DIR)
+        process = subprocess.run([sys.executable, "-X", "importtime",
+                                  "-c", script],
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 env=self.env, universal_newlines=True,
+                                 check=True)
+
+        self_time = None
+        for line in process.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == "py3venv":
+                self_time = int(fields[0].rpartition(":")[2])
+        return self_time, ast.literal_eval(process.stdout)
+
+    def test_import_time(self):
+        # The first import compiles py3venv.py and caches its bytecode
+        self.import_py3venv()
+
+        self_times = []
+        for _ in range(3):
+            self_time, imported_modules = self.import_py3venv()
+            self.assertIsNotNone(self_time)
+            self_times.append(self_time)
+        self.assertLessEqual(min(self_times), IMPORT_TIME_BUDGET,
+                             "import py3venv took {} us".format(self_times))
+
+        imported_modules = set(name.partition(".")[0]
+                               for name in imported_modules)
+        self.assertEqual(imported_modules & set(DEFERRED_MODULES), set())
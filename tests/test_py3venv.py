@@ -3,7 +3,92 @@
 
 # Copyright (c) 2013 Masami HIRATA <msmhrt@gmail.com>
 
-from unittest import TestCase
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest import TestCase, mock
+
+
+def import_py3venv():
+    plugin_dir = os.path.dirname(os.path.dirname(__file__))
+    plugin_dir = os.path.join(plugin_dir, "plugin")
+    if sys.path[0] != plugin_dir:
+        sys.path.insert(0, plugin_dir)
+    import py3venv
+    return py3venv
+
+
+def make_fake_venv(root, name="venv", home=None):
+    py3venv = import_py3venv()
+    venv_prefix = os.path.join(root, name)
+    if home is None:
+        home = os.path.dirname(sys.executable)
+    os.makedirs(os.path.join(venv_prefix, py3venv.BIN_PATH))
+    os.makedirs(os.path.join(venv_prefix, py3venv.SITE_PACKAGES_PATH))
+    with open(os.path.join(venv_prefix, "pyvenv.cfg"), "w",
+              encoding="utf-8") as pyvenv_cfg_file:
+        pyvenv_cfg_file.write("home = {}\n".format(home))
+        pyvenv_cfg_file.write("include-system-site-packages = false\n")
+        pyvenv_cfg_file.write("version = {0}.{1}.{2}\n".format(
+            *sys.version_info))
+    for progname in py3venv.make_prognames()[:1]:
+        with open(os.path.join(venv_prefix, py3venv.BIN_PATH, progname),
+                  "w"):
+            pass
+    return venv_prefix
+
+
+class TempDirTestCase(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        patcher = mock.patch.dict(
+            os.environ,
+            {"XDG_CACHE_HOME": os.path.join(self.temp_dir, "cache")})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.py3venv = import_py3venv()
+        self.addCleanup(self.py3venv.clear_venv_info_cache)
+        self.addCleanup(self.py3venv.clear_venv_layout_cache)
+
+    def reset_py3venv_state(self, **values):
+        py3venv = self.py3venv
+        # As in a process where no venv has been activated yet
+        state = {"_activation_done": False,
+                 "_activated_venv_prefix": None,
+                 "_current_venv_prefix": None,
+                 "_baseline_sys_state": None,
+                 "_baseline_sys_attrs": None,
+                 "_baseline_environ": None,
+                 "_venv_pool": {},
+                 "_module_indexes": {},
+                 "_preload_thread": None,
+                 "_preload_report": {},
+                 "_watcher": None,
+                 "_pending_probe": None,
+                 "_precompile_report": None,
+                 "_saved_pycache_prefix": py3venv.NOT_FOUND,
+                 "_zip_build_threads": {},
+                 "_zip_snapshot_files": {}}
+        state.update(values)
+        for name, value in state.items():
+            patcher = mock.patch.object(py3venv, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def save_sys_attrs(self):
+        py3venv = self.py3venv
+        saved_sys_attrs = py3venv.fix_sys_attrs(
+            dict.fromkeys(py3venv.SNAPSHOT_SYS_ATTRS, py3venv.AS_IS))
+        self.addCleanup(py3venv.recover_sys_attrs, saved_sys_attrs)
+
+
+def write_file(path, content=""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(content)
 
 
 class TestPy3venv(TestCase):
@@ -147,3 +232,1553 @@ class TestPy3venv(TestCase):
             else:
                 self.assertIs(original_attr, backuped["id"], msg=test_id)
                 self.assertEqual(original_attr, backuped["value"], msg=test_id)
+
+
+class TestActivationCache(TempDirTestCase):
+    def test_cache_dir(self):
+        cache_dir = self.py3venv.get_cache_dir()
+        self.assertEqual(cache_dir,
+                         os.path.join(self.temp_dir, "cache", "py3venv"))
+
+    def test_fingerprint(self):
+        py3venv = self.py3venv
+        venv_prefix = make_fake_venv(self.temp_dir)
+        fingerprint = py3venv.make_venv_fingerprint(venv_prefix)
+        self.assertEqual(fingerprint,
+                         py3venv.make_venv_fingerprint(venv_prefix))
+
+        pth_path = os.path.join(venv_prefix, py3venv.SITE_PACKAGES_PATH,
+                                "extra.pth")
+        with open(pth_path, "w") as pth_file:
+            pth_file.write("/nonexistent\n")
+        self.assertNotEqual(fingerprint,
+                            py3venv.make_venv_fingerprint(venv_prefix))
+
+        fingerprint = py3venv.make_venv_fingerprint(venv_prefix)
+        with mock.patch.dict(os.environ, {"PYTHONPATH": self.temp_dir}):
+            self.assertNotEqual(fingerprint,
+                                py3venv.make_venv_fingerprint(venv_prefix))
+
+    def test_snapshot_roundtrip(self):
+        py3venv = self.py3venv
+        self.save_sys_attrs()
+        venv_prefix = make_fake_venv(self.temp_dir)
+        fingerprint = py3venv.make_venv_fingerprint(venv_prefix)
+        self.assertIsNone(py3venv.load_activation_snapshot(venv_prefix,
+                                                           fingerprint))
+
+        with mock.patch.object(sys, "path", [venv_prefix]):
+            self.assertTrue(py3venv.save_activation_snapshot(venv_prefix,
+                                                             fingerprint,
+                                                             "venv"))
+        snapshot = py3venv.load_activation_snapshot(venv_prefix,
+                                                    fingerprint)
+        self.assertTrue(snapshot["valid"])
+        self.assertEqual(snapshot["sys_attrs"]["executable"],
+                         sys.executable)
+
+        cache_dir = os.path.dirname(
+            py3venv.make_activation_cache_path(venv_prefix))
+        self.assertEqual([name for name in os.listdir(cache_dir)
+                          if name.startswith(".tmp-")], [])
+
+        fingerprint["python"] = [0, 0, 0]
+        self.assertIsNone(py3venv.load_activation_snapshot(venv_prefix,
+                                                           fingerprint))
+
+    def test_activate_from_snapshot(self):
+        py3venv = self.py3venv
+        self.save_sys_attrs()
+        venv_prefix = make_fake_venv(self.temp_dir)
+        fingerprint = py3venv.make_venv_fingerprint(venv_prefix)
+        syspath = sys.path
+        new_path = [os.path.join(venv_prefix, py3venv.SITE_PACKAGES_PATH)]
+        with mock.patch.object(sys, "path", new_path[:]):
+            with mock.patch.object(sys, "executable", "venv-python"):
+                py3venv.save_activation_snapshot(venv_prefix, fingerprint,
+                                                 "venv")
+
+        with mock.patch.object(py3venv, "activate_venv") as activate_venv:
+            self.assertEqual(py3venv.activate(venv_prefix), venv_prefix)
+            self.assertFalse(activate_venv.called)
+        self.assertIs(sys.path, syspath)
+        self.assertEqual(sys.executable, "venv-python")
+        self.assertEqual(sys.path[:1], new_path)
+
+    def test_pth_imports_are_replayed(self):
+        py3venv = self.py3venv
+        self.save_sys_attrs()
+        self.addCleanup(py3venv.clear_pth_cache)
+        self.addCleanup(lambda: sys.__dict__.pop("_py3venv_test_hook",
+                                                 None))
+        venv_prefix = make_fake_venv(self.temp_dir)
+        site_dir = os.path.join(venv_prefix, py3venv.SITE_PACKAGES_PATH)
+        write_file(os.path.join(site_dir, "hook.pth"),
+                   "{}\nimport sys; sys._py3venv_test_hook = True\n".format(
+                       self.temp_dir))
+        fingerprint = py3venv.make_venv_fingerprint(venv_prefix)
+        with mock.patch.object(sys, "path", [site_dir]):
+            py3venv.save_activation_snapshot(venv_prefix, fingerprint, "venv")
+        snapshot = py3venv.load_activation_snapshot(venv_prefix, fingerprint)
+        self.assertEqual(snapshot["pth_imports"],
+                         [[os.path.join(site_dir, "hook.pth"),
+                           ["import sys; sys._py3venv_test_hook = True"]]])
+
+        py3venv.clear_pth_cache()
+        with mock.patch.object(py3venv, "activate_venv") as activate_venv, \
+                mock.patch("builtins.open", side_effect=open) as mock_open:
+            self.assertEqual(py3venv.activate(venv_prefix), venv_prefix)
+            self.assertFalse(activate_venv.called)
+            # Only the snapshot itself is read
+            self.assertEqual(mock_open.call_count, 1)
+        self.assertTrue(sys._py3venv_test_hook)
+        self.assertEqual(sys.path, [site_dir])
+
+    def test_virtualenv_snapshot(self):
+        py3venv = self.py3venv
+        self.save_sys_attrs()
+        venv_prefix = make_fake_venv(self.temp_dir)
+        bin_path = os.path.join(venv_prefix, py3venv.BIN_PATH)
+        fingerprint = py3venv.make_venv_fingerprint(venv_prefix)
+        with mock.patch.dict(os.environ, {"PATH": "/usr/bin"}):
+            os.environ.pop("VIRTUAL_ENV", None)
+            old_environ = {"PATH": "/usr/bin", "VIRTUAL_ENV": None}
+            os.environ["PATH"] = bin_path + os.pathsep + "/usr/bin"
+            os.environ["VIRTUAL_ENV"] = venv_prefix
+            with mock.patch.object(sys, "real_prefix", sys.base_prefix,
+                                   create=True), \
+                    mock.patch.object(sys, "path", [venv_prefix]):
+                py3venv.save_activation_snapshot(venv_prefix, fingerprint,
+                                                 "virtualenv", old_environ)
+
+        with mock.patch.dict(os.environ, {"PATH": "/bin"}):
+            os.environ.pop("VIRTUAL_ENV", None)
+            snapshot = py3venv.load_activation_snapshot(venv_prefix,
+                                                        fingerprint)
+            self.assertEqual(py3venv.apply_activation_snapshot(snapshot),
+                             venv_prefix)
+            self.assertEqual(os.environ["PATH"],
+                             bin_path + os.pathsep + "/bin")
+            self.assertEqual(os.environ["VIRTUAL_ENV"], venv_prefix)
+        self.assertEqual(sys.real_prefix, sys.base_prefix)
+
+    def test_invalid_decision_is_cached(self):
+        py3venv = self.py3venv
+        venv_prefix = os.path.join(self.temp_dir, "missing")
+        self.assertIsNone(py3venv.activate(venv_prefix))
+        fingerprint = py3venv.make_venv_fingerprint(venv_prefix)
+        snapshot = py3venv.load_activation_snapshot(venv_prefix, fingerprint)
+        self.assertFalse(snapshot["valid"])
+
+
+class TestVenvInfo(TempDirTestCase):
+    def test_venv_info(self):
+        py3venv = self.py3venv
+        venv_prefix = make_fake_venv(self.temp_dir)
+        venv_info = py3venv.get_venv_info(venv_prefix)
+        self.assertEqual(venv_info.home, os.path.dirname(sys.executable))
+        self.assertEqual(venv_info.version_info, sys.version_info[:3])
+        self.assertFalse(venv_info.include_system_site_packages)
+        self.assertFalse(hasattr(venv_info, "__dict__"))
+        self.assertTrue(py3venv.is_valid_version(venv_info.version))
+
+        with mock.patch("builtins.open") as mock_open:
+            self.assertIs(py3venv.get_venv_info(venv_prefix), venv_info)
+            self.assertEqual(py3venv.get_venv_version(venv_prefix),
+                             venv_info.version)
+            self.assertFalse(mock_open.called)
+
+    def test_patch_upgraded_base(self):
+        py3venv = self.py3venv
+        venv_prefix = make_fake_venv(self.temp_dir)
+        with open(os.path.join(venv_prefix, "pyvenv.cfg"), "w",
+                  encoding="utf-8") as pyvenv_cfg_file:
+            pyvenv_cfg_file.write("home = {}\n".format(
+                os.path.dirname(sys.executable)))
+            pyvenv_cfg_file.write("version = {0}.{1}.{2}\n".format(
+                sys.version_info[0], sys.version_info[1],
+                sys.version_info[2] + 1))
+        with mock.patch.dict(os.environ, {"VIRTUAL_ENV": venv_prefix}), \
+                mock.patch.object(py3venv, "reset_syspath",
+                                  return_value=RuntimeError("stop")):
+            self.assertIsNone(py3venv.activate(venv_prefix, use_cache=False))
+        profile = py3venv.get_activation_profile()
+        self.assertEqual(profile["rejections"][0],
+                         {"path": "venv",
+                          "reason": "reset_syspath() failed: stop"})
+
+    def test_venv_info_without_version(self):
+        py3venv = self.py3venv
+        venv_prefix = os.path.join(self.temp_dir, "venv")
+        os.makedirs(venv_prefix)
+        home = os.path.join(sys.base_prefix, "bin")
+        with open(os.path.join(venv_prefix, "pyvenv.cfg"), "w") as cfg_file:
+            cfg_file.write("home = {}\n".format(home))
+            cfg_file.write("include-system-site-packages = true\n")
+        venv_info = py3venv.get_venv_info(venv_prefix)
+        if sys.platform != "win32":
+            self.assertEqual(venv_info.version_info, sys.version_info[:3])
+        self.assertTrue(venv_info.include_system_site_packages)
+        self.assertIsNone(py3venv.get_venv_info(self.temp_dir))
+
+    def test_is_valid_version(self):
+        is_valid_version = self.py3venv.is_valid_version
+        self.assertTrue(is_valid_version("{0}.{1}.{2}".format(
+            *sys.version_info)))
+        self.assertTrue(is_valid_version("{0}.{1}.{2}.final.0".format(
+            *sys.version_info)))
+        self.assertTrue(is_valid_version(sys.version_info[:2]))
+        self.assertTrue(is_valid_version(list(sys.version_info[:3])))
+        self.assertTrue(is_valid_version("{0}.{1}.{2}".format(
+            sys.version_info[0], sys.version_info[1],
+            sys.version_info[2] + 1)))
+        self.assertFalse(is_valid_version("{0}.{1}.{2}".format(
+            sys.version_info[0], sys.version_info[1] + 1,
+            sys.version_info[2])))
+        self.assertFalse(is_valid_version("2.7.18"))
+        self.assertFalse(is_valid_version(""))
+        self.assertFalse(is_valid_version(None))
+
+    def test_virtualenv_info(self):
+        py3venv = self.py3venv
+        venv_prefix = os.path.join(self.temp_dir, "virtualenv")
+        os.makedirs(os.path.join(venv_prefix, py3venv.LIB_PATH))
+        orig_prefix_txt_path = os.path.join(venv_prefix, py3venv.LIB_PATH,
+                                            "orig-prefix.txt")
+        with open(orig_prefix_txt_path, "w") as orig_prefix_txt_file:
+            orig_prefix_txt_file.write(sys.base_prefix)
+        self.assertEqual(py3venv.get_virtualenv_original_prefix(venv_prefix),
+                         sys.base_prefix)
+        self.assertTrue(py3venv.is_valid_version(
+            py3venv.get_virtualenv_version(venv_prefix)))
+
+
+class TestEnsureActivated(TestCase):
+    def test_ensure_activated(self):
+        py3venv = import_py3venv()
+        with mock.patch.object(py3venv, "_activation_done", False), \
+                mock.patch.object(py3venv, "_activated_venv_prefix", None), \
+                mock.patch.object(py3venv, "activate",
+                                  return_value="/venv") as activate:
+            self.assertEqual(py3venv.ensure_activated(), "/venv")
+            self.assertEqual(py3venv.ensure_activated(), "/venv")
+            self.assertEqual(activate.call_count, 1)
+
+
+class TestActivationProfile(TempDirTestCase):
+    def test_rejections_and_spans(self):
+        py3venv = self.py3venv
+        self.save_sys_attrs()
+        venv_prefix = make_fake_venv(self.temp_dir)
+        with mock.patch.dict(os.environ):
+            os.environ.pop("VIRTUAL_ENV", None)
+            os.environ.pop("_OLD_VIRTUAL_PATH", None)
+            self.assertIsNone(py3venv.activate(venv_prefix, use_cache=False))
+
+        profile = py3venv.get_activation_profile()
+        self.assertEqual(profile["venv_prefix"], venv_prefix)
+        self.assertIsNone(profile["result"])
+        phases = [span["phase"] for span in profile["spans"]]
+        self.assertIn("check_lib_path", phases)
+        self.assertIn("read_pyvenv_cfg", phases)
+        self.assertIn({"path": "venv", "reason": "venv is not activated"},
+                      profile["rejections"])
+        self.assertIn({"path": "virtualenv", "reason": "no orig-prefix.txt"},
+                      profile["rejections"])
+        self.assertIn("venv is not activated",
+                      py3venv.format_activation_profile())
+
+    def test_write_activation_profile(self):
+        import json
+
+        py3venv = self.py3venv
+        py3venv.activate_venv(os.path.join(self.temp_dir, "missing"))
+        log_path = os.path.join(self.temp_dir, "profile.jsonl")
+        self.assertTrue(py3venv.write_activation_profile(log_path))
+        self.assertTrue(py3venv.write_activation_profile(log_path))
+        with open(log_path, encoding="utf-8") as log_file:
+            records = [json.loads(line) for line in log_file]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]["rejections"],
+                         [{"path": "venv", "reason": "no pyvenv.cfg"}])
+
+
+class TestVenvPool(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        py3venv = self.py3venv
+        self.save_sys_attrs()
+        self.reset_py3venv_state(VENV_POOL_SIZE=2)
+
+        def fake_activate(venv_prefix, **kwargs):
+            sys.path.insert(0, venv_prefix)
+            sys.executable = os.path.join(venv_prefix, "python")
+            return venv_prefix
+
+        patcher = mock.patch.object(py3venv, "activate",
+                                    side_effect=fake_activate)
+        self.activate = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_switch_venv(self):
+        py3venv = self.py3venv
+        syspath = sys.path
+        baseline_path = sys.path[:]
+
+        self.assertEqual(py3venv.switch_venv("/a"), "/a")
+        self.assertEqual(py3venv.switch_venv("/b"), "/b")
+        self.assertEqual(sys.path[0], "/b")
+        self.assertNotIn("/a", sys.path)
+        self.assertEqual(self.activate.call_count, 2)
+
+        self.assertEqual(py3venv.switch_venv("/a"), "/a")
+        self.assertEqual(sys.path[0], "/a")
+        self.assertEqual(sys.executable, os.path.join("/a", "python"))
+        self.assertEqual(self.activate.call_count, 2)
+        self.assertIs(sys.path, syspath)
+
+        self.assertIsNone(py3venv.switch_venv(None))
+        self.assertEqual(sys.path, baseline_path)
+        self.assertIsNone(py3venv.get_current_venv_prefix())
+
+    def test_virtualenv_state(self):
+        py3venv = self.py3venv
+
+        def fake_activate(venv_prefix, **kwargs):
+            sys.path.insert(0, venv_prefix)
+            if venv_prefix == "/v":
+                sys.real_prefix = sys.base_prefix
+                os.environ["VIRTUAL_ENV"] = venv_prefix
+            return venv_prefix
+
+        self.activate.side_effect = fake_activate
+        with mock.patch.dict(os.environ):
+            os.environ.pop("VIRTUAL_ENV", None)
+            self.assertFalse(hasattr(sys, "real_prefix"))
+            self.assertEqual(py3venv.switch_venv("/v"), "/v")
+            self.assertEqual(py3venv.switch_venv("/a"), "/a")
+            self.assertFalse(hasattr(sys, "real_prefix"))
+            self.assertNotIn("VIRTUAL_ENV", os.environ)
+
+            self.assertEqual(py3venv.switch_venv("/v"), "/v")
+            self.assertEqual(self.activate.call_count, 2)
+            self.assertEqual(sys.real_prefix, sys.base_prefix)
+            self.assertEqual(os.environ["VIRTUAL_ENV"], "/v")
+
+            self.assertIsNone(py3venv.switch_venv(None))
+            self.assertFalse(hasattr(sys, "real_prefix"))
+            self.assertNotIn("VIRTUAL_ENV", os.environ)
+
+    def test_venv_finders(self):
+        py3venv = self.py3venv
+        saved_sys_attrs = py3venv.fix_sys_attrs({"meta_path": py3venv.AS_IS})
+        self.addCleanup(py3venv.recover_sys_attrs, saved_sys_attrs)
+        self.addCleanup(py3venv.clear_pth_cache)
+        self.addCleanup(sys.modules.pop, "py3venv_pool_finder", None)
+        venv_prefix = os.path.join(self.temp_dir, "venv")
+        site_dir = os.path.join(venv_prefix, "site-packages")
+        write_file(os.path.join(site_dir, "py3venv_pool_finder.py"),
+                   "import sys\n"
+                   "class Finder:\n"
+                   "    def find_spec(self, *args):\n"
+                   "        return None\n"
+                   "def install():\n"
+                   "    sys.meta_path.append(Finder())\n")
+        write_file(os.path.join(site_dir, "finder.pth"),
+                   "import py3venv_pool_finder; "
+                   "py3venv_pool_finder.install()\n")
+
+        def fake_activate(venv_prefix, **kwargs):
+            sys.path.insert(0, venv_prefix)
+            if venv_prefix == site_dir:
+                py3venv.run_pth_imports(py3venv.find_pth_imports([site_dir]))
+            return venv_prefix
+
+        def count_finders():
+            return sum(1 for finder in sys.meta_path
+                       if type(finder).__module__ == "py3venv_pool_finder")
+
+        self.activate.side_effect = fake_activate
+        self.assertEqual(py3venv.switch_venv(site_dir), site_dir)
+        self.assertEqual(count_finders(), 1)
+        self.assertEqual(py3venv.switch_venv("/a"), "/a")
+        self.assertEqual(count_finders(), 0)
+        self.assertEqual(py3venv.switch_venv(site_dir), site_dir)
+        self.assertEqual(self.activate.call_count, 2)
+        self.assertEqual(count_finders(), 1)
+
+    def test_eviction(self):
+        py3venv = self.py3venv
+        for venv_prefix in ("/a", "/b", "/c"):
+            py3venv.switch_venv(venv_prefix)
+        self.assertEqual(list(py3venv._venv_pool), ["/b", "/c"])
+
+        self.assertEqual(py3venv.switch_venv("/a"), "/a")
+        self.assertEqual(self.activate.call_count, 4)
+        self.assertEqual(sys.path.count("/a"), 1)
+        self.assertEqual(list(py3venv._venv_pool), ["/c", "/a"])
+
+
+class TestVenvDiscovery(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(self.py3venv.clear_discovery_index)
+        self.project_dir = os.path.join(self.temp_dir, "project")
+        self.source_dir = os.path.join(self.project_dir, "src", "package")
+        os.makedirs(self.source_dir)
+
+    def test_find_venv_prefix(self):
+        py3venv = self.py3venv
+        self.assertIsNone(py3venv.find_venv_prefix(self.source_dir))
+
+        venv_prefix = make_fake_venv(self.project_dir, ".venv")
+        py3venv.clear_discovery_index()
+        self.assertEqual(py3venv.find_venv_prefix(self.source_dir),
+                         venv_prefix)
+        site_packages_path = os.path.join(venv_prefix,
+                                          py3venv.SITE_PACKAGES_PATH)
+        self.assertEqual(py3venv.find_venv_prefix(site_packages_path),
+                         venv_prefix)
+
+    def test_negative_cache(self):
+        py3venv = self.py3venv
+        self.assertIsNone(py3venv.find_venv_prefix(self.source_dir))
+
+        with mock.patch("os.stat") as mock_stat, \
+                mock.patch("os.path.isfile") as mock_isfile:
+            self.assertIsNone(py3venv.find_venv_prefix(self.source_dir))
+            self.assertFalse(mock_stat.called)
+            self.assertFalse(mock_isfile.called)
+
+    def test_invalidation_by_mtime(self):
+        py3venv = self.py3venv
+        self.assertIsNone(py3venv.find_venv_prefix(self.source_dir))
+
+        venv_prefix = make_fake_venv(self.project_dir, "venv")
+        stat_result = os.stat(self.project_dir)
+        os.utime(self.project_dir, ns=(stat_result.st_atime_ns,
+                                       stat_result.st_mtime_ns + 10 ** 9))
+        with mock.patch.object(py3venv, "DISCOVERY_TTL", 0):
+            self.assertEqual(py3venv.find_venv_prefix(self.source_dir),
+                             venv_prefix)
+
+
+class TestResetSyspath(TestCase):
+    def test_make_base_syspath(self):
+        import json
+        import subprocess
+
+        py3venv = import_py3venv()
+        env = os.environ.copy()
+        env.pop("PYTHONPATH", None)
+        env.pop("PYTHONHOME", None)
+        output = subprocess.check_output(
+            [sys.executable, "-S", "-c",
+             "import json, sys; print(json.dumps(sys.path))"],
+            env=env)
+        expected_syspath = json.loads(output.decode("utf-8"))[1:]
+
+        with mock.patch.dict(os.environ, env, clear=True):
+            syspath = py3venv.make_base_syspath()
+        self.assertEqual([os.path.normcase(path) for path in syspath],
+                         [os.path.normcase(path)
+                          for path in expected_syspath])
+
+    def test_reset_syspath(self):
+        py3venv = import_py3venv()
+        saved_sys_attrs = py3venv.fix_sys_attrs({"path": py3venv.AS_IS})
+        self.addCleanup(py3venv.recover_sys_attrs, saved_sys_attrs)
+
+        syspath = sys.path
+        sys.path.append(os.path.join(os.sep, "nonexistent"))
+        with mock.patch.dict("sys.modules", {"ctypes": None}):
+            self.assertIsNone(py3venv.reset_syspath())
+        self.assertIs(sys.path, syspath)
+        self.assertNotIn(os.path.join(os.sep, "nonexistent"), sys.path)
+
+    def test_ctypes_fallback(self):
+        py3venv = import_py3venv()
+        saved_sys_attrs = py3venv.fix_sys_attrs({"path": py3venv.AS_IS})
+        self.addCleanup(py3venv.recover_sys_attrs, saved_sys_attrs)
+
+        syspath = sys.path
+        with mock.patch.object(py3venv, "make_base_syspath",
+                               return_value=None), \
+                mock.patch.dict("sys.modules", {"ctypes": None}):
+            self.assertIsInstance(py3venv.reset_syspath(), ImportError)
+        self.assertIs(sys.path, syspath)
+
+
+class TestPthCache(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        import site
+
+        self.save_sys_attrs()
+        self.addCleanup(self.py3venv.clear_pth_cache)
+        self.site = site
+        self.site_dir = os.path.join(self.temp_dir, "site-packages")
+        self.extra_dir = os.path.join(self.temp_dir, "extra")
+        os.makedirs(self.site_dir)
+        os.makedirs(self.extra_dir)
+
+    def write_pth(self, name, *lines):
+        with open(os.path.join(self.site_dir, name), "w") as pth_file:
+            pth_file.write("\n".join(lines) + "\n")
+
+    def call_addpackage(self, name):
+        site = self.site
+        original_addpackage = mock.Mock(wraps=site.addpackage)
+        with mock.patch.object(site, "addpackage", original_addpackage):
+            addpackage = self.py3venv.make_cached_addpackage(site)
+        sys.path[:] = []
+        known_paths = set()
+        addpackage(self.site_dir, name, known_paths)
+        return original_addpackage.call_count
+
+    def test_replay_pure_path_pth(self):
+        self.write_pth("extra.pth", "# comment", "", self.extra_dir,
+                       os.path.join(self.temp_dir, "missing"))
+        self.assertEqual(self.call_addpackage("extra.pth"), 1)
+        self.assertEqual(sys.path, [self.extra_dir])
+
+        self.assertEqual(self.call_addpackage("extra.pth"), 0)
+        self.assertEqual(sys.path, [self.extra_dir])
+
+        pth_path = os.path.join(self.site_dir, "extra.pth")
+        stat_result = os.stat(pth_path)
+        os.utime(pth_path, ns=(stat_result.st_atime_ns,
+                               stat_result.st_mtime_ns + 10 ** 9))
+        self.assertEqual(self.call_addpackage("extra.pth"), 1)
+
+    def test_import_lines_are_executed(self):
+        self.write_pth("hook.pth", "import sys; sys._py3venv_test_hook = 1",
+                       self.extra_dir)
+        self.addCleanup(delattr, sys, "_py3venv_test_hook")
+        self.assertEqual(self.call_addpackage("hook.pth"), 1)
+        del sys._py3venv_test_hook
+        self.assertEqual(self.call_addpackage("hook.pth"), 1)
+        self.assertEqual(sys._py3venv_test_hook, 1)
+        self.assertEqual(sys.path, [self.extra_dir])
+
+
+class TestReconcileModules(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.save_sys_attrs()
+        self.old_site = os.path.join(self.temp_dir, "old-site")
+        self.new_site = os.path.join(self.temp_dir, "new-site")
+        for site_dir in (self.old_site, self.new_site):
+            package_dir = os.path.join(site_dir, "py3venv_probe_pkg")
+            os.makedirs(package_dir)
+            for name in ("__init__.py", "sub.py"):
+                with open(os.path.join(package_dir, name), "w"):
+                    pass
+        with open(os.path.join(self.old_site, "py3venv_probe_mod.py"), "w"):
+            pass
+
+        sys.path.insert(0, self.old_site)
+        self.addCleanup(self.unload)
+        import py3venv_probe_pkg.sub
+        import py3venv_probe_mod
+        self.assertEqual(py3venv_probe_mod.__name__, "py3venv_probe_mod")
+        self.assertTrue(py3venv_probe_pkg.sub.__file__.startswith(
+            self.old_site))
+
+    def unload(self):
+        for name in ("py3venv_probe_pkg", "py3venv_probe_pkg.sub",
+                     "py3venv_probe_mod"):
+            sys.modules.pop(name, None)
+
+    def test_removed_entry(self):
+        old_syspath = sys.path[:]
+        sys.path.remove(self.old_site)
+        evicted_names = self.py3venv.reconcile_modules(old_syspath)
+        self.assertEqual(sorted(evicted_names),
+                         ["py3venv_probe_mod", "py3venv_probe_pkg",
+                          "py3venv_probe_pkg.sub"])
+        self.assertIn("os", sys.modules)
+
+    def test_shadowing_entry(self):
+        old_syspath = sys.path[:]
+        sys.path.insert(0, self.new_site)
+        evicted_names = self.py3venv.reconcile_modules(old_syspath)
+        self.assertEqual(sorted(evicted_names),
+                         ["py3venv_probe_pkg", "py3venv_probe_pkg.sub"])
+        self.assertIn("py3venv_probe_mod", sys.modules)
+
+        import py3venv_probe_pkg
+        self.assertTrue(py3venv_probe_pkg.__file__.startswith(self.new_site))
+
+    def test_unaffected_entry(self):
+        old_syspath = sys.path[:]
+        sys.path.append(self.new_site)
+        self.assertEqual(self.py3venv.reconcile_modules(old_syspath), [])
+        self.assertIn("py3venv_probe_pkg.sub", sys.modules)
+
+
+class TestVenvLayout(TempDirTestCase):
+    def test_venv_layout(self):
+        py3venv = self.py3venv
+        venv_prefix = make_fake_venv(self.temp_dir)
+        scandir = mock.Mock(wraps=os.scandir)
+        with mock.patch("os.scandir", scandir), \
+                mock.patch("os.path.isfile") as mock_isfile, \
+                mock.patch("os.path.isdir") as mock_isdir:
+            self.assertTrue(py3venv.is_valid_lib_path(venv_prefix))
+            self.assertEqual(py3venv.make_pyvenv_cfg_path(venv_prefix),
+                             os.path.join(venv_prefix, "pyvenv.cfg"))
+            self.assertEqual(
+                py3venv.make_venv_executable_path(venv_prefix),
+                os.path.join(venv_prefix, py3venv.BIN_PATH,
+                             py3venv.make_prognames()[0]))
+            self.assertIsNone(py3venv.get_orig_prefix_txt_path(venv_prefix))
+            self.assertIsNone(
+                py3venv.get_virtualenv_activate_this_path(venv_prefix))
+            self.assertFalse(mock_isfile.called)
+            self.assertFalse(mock_isdir.called)
+        self.assertEqual(scandir.call_count, 3)
+
+    def test_missing_venv(self):
+        py3venv = self.py3venv
+        venv_prefix = os.path.join(self.temp_dir, "missing")
+        self.assertFalse(py3venv.is_valid_lib_path(venv_prefix))
+        self.assertIsNone(py3venv.make_pyvenv_cfg_path(venv_prefix))
+        self.assertIsNone(py3venv.make_venv_executable_path(venv_prefix))
+        self.assertFalse(py3venv.is_valid_lib_path(1))
+
+
+class TestOptimizeSyspath(TempDirTestCase):
+    def test_optimize_syspath(self):
+        import zipfile
+
+        py3venv = self.py3venv
+        self.save_sys_attrs()
+        first_dir = os.path.join(self.temp_dir, "first")
+        second_dir = os.path.join(self.temp_dir, "second")
+        link_dir = os.path.join(self.temp_dir, "link")
+        missing_dir = os.path.join(self.temp_dir, "missing")
+        archive_path = os.path.join(self.temp_dir, "archive.zip")
+        os.makedirs(first_dir)
+        os.makedirs(second_dir)
+        with zipfile.ZipFile(archive_path, "w") as archive:
+            archive.writestr("package/__init__.py", "")
+        special_path = "_vim_path_"
+
+        syspath = sys.path
+        sys.path[:] = ["", first_dir, special_path, second_dir, missing_dir,
+                       os.path.join(archive_path, "package"),
+                       os.path.join(self.temp_dir, "missing.zip", "package"),
+                       first_dir + os.sep]
+        expected_syspath = sys.path[:4] + sys.path[5:6]
+        removed_paths = sys.path[4:5] + sys.path[6:8]
+        duplicates = 1
+        if hasattr(os, "symlink"):
+            os.symlink(second_dir, link_dir)
+            sys.path.append(link_dir)
+            removed_paths.append(link_dir)
+            duplicates += 1
+
+        with mock.patch.object(py3venv, "get_vim_special_path",
+                               return_value=special_path):
+            report = py3venv.optimize_syspath()
+        self.assertIs(sys.path, syspath)
+        self.assertEqual(sys.path, expected_syspath)
+        self.assertEqual([removed["path"] for removed in report["removed"]],
+                         removed_paths)
+        self.assertEqual(report["stats_saved_per_miss"], duplicates)
+
+
+class TestModuleIndex(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        py3venv = self.py3venv
+        self.save_sys_attrs()
+        saved_sys_attrs = py3venv.fix_sys_attrs({"meta_path": py3venv.AS_IS})
+        self.addCleanup(py3venv.recover_sys_attrs, saved_sys_attrs)
+        self.reset_py3venv_state()
+        self.addCleanup(self.unload)
+
+        self.first_site = os.path.join(self.temp_dir, "first")
+        self.second_site = os.path.join(self.temp_dir, "second")
+        for path in (os.path.join(self.first_site, "py3venv_idx_pkg",
+                                  "__init__.py"),
+                     os.path.join(self.first_site, "py3venv_idx_pkg.py"),
+                     os.path.join(self.first_site, "py3venv_idx_mod.py"),
+                     os.path.join(self.first_site, "py3venv_idx_ns",
+                                  "module.py"),
+                     os.path.join(self.first_site, "foo-1.0.dist-info",
+                                  "METADATA"),
+                     os.path.join(self.second_site, "py3venv_idx_mod.py"),
+                     os.path.join(self.second_site, "py3venv_idx_ns.py")):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as file:
+                file.write("LOCATION = {!r}\n".format(path))
+
+    def unload(self):
+        for name in ("py3venv_idx_pkg", "py3venv_idx_mod", "py3venv_idx_ns"):
+            sys.modules.pop(name, None)
+
+    def test_build_module_index(self):
+        index = self.py3venv.build_module_index(
+            [self.first_site, os.path.join(self.temp_dir, "missing"),
+             self.second_site, "", self.first_site])
+        self.assertEqual(index["syspath"][-1], self.second_site)
+        modules = index["modules"]
+        self.assertEqual(modules["py3venv_idx_pkg"],
+                         [self.first_site, "package", "__init__.py"])
+        self.assertEqual(modules["py3venv_idx_mod"],
+                         [self.first_site, "module", "py3venv_idx_mod.py"])
+        self.assertEqual(modules["py3venv_idx_ns"],
+                         [self.second_site, "module", "py3venv_idx_ns.py"])
+        self.assertNotIn("foo-1", modules)
+
+    def test_module_index_finder(self):
+        py3venv = self.py3venv
+        sys.path[:0] = [self.first_site, self.second_site]
+        py3venv.USE_MODULE_INDEX = True
+        self.addCleanup(setattr, py3venv, "USE_MODULE_INDEX", False)
+        finder = py3venv.update_module_index("/venv")
+        self.assertIn(finder, sys.meta_path)
+
+        with mock.patch.object(finder, "find_spec",
+                               wraps=finder.find_spec) as find_spec:
+            import py3venv_idx_pkg
+            import py3venv_idx_ns
+            self.assertTrue(find_spec.called)
+        self.assertEqual(py3venv_idx_pkg.LOCATION,
+                         os.path.join(self.first_site, "py3venv_idx_pkg",
+                                      "__init__.py"))
+        self.assertEqual(py3venv_idx_ns.LOCATION,
+                         os.path.join(self.second_site, "py3venv_idx_ns.py"))
+
+        os.remove(os.path.join(self.first_site, "py3venv_idx_mod.py"))
+        self.assertIsNone(finder.find_spec("py3venv_idx_mod"))
+        import py3venv_idx_mod
+        self.assertEqual(py3venv_idx_mod.LOCATION,
+                         os.path.join(self.second_site, "py3venv_idx_mod.py"))
+
+        py3venv.update_module_index(None)
+        self.assertNotIn(finder, sys.meta_path)
+
+    def test_invalidate_caches(self):
+        import importlib
+
+        py3venv = self.py3venv
+        sys.path[:0] = [self.first_site, self.second_site]
+        py3venv.USE_MODULE_INDEX = True
+        self.addCleanup(setattr, py3venv, "USE_MODULE_INDEX", False)
+        finder = py3venv.update_module_index("/venv")
+        write_file(os.path.join(self.second_site, "py3venv_idx_new.py"),
+                   "LOCATION = 'new'\n")
+        self.addCleanup(sys.modules.pop, "py3venv_idx_new", None)
+        self.assertIsNone(finder.find_spec("py3venv_idx_new"))
+
+        importlib.invalidate_caches()
+        self.assertIsNotNone(finder.find_spec("py3venv_idx_new"))
+
+    def test_fresh_interpreter(self):
+        import subprocess
+
+        # importlib.util isn't loaded yet in a fresh interpreter
+        script = "\n".join([
+            "import sys",
+            "sys.path.insert(0, {!r})".format(
+                os.path.dirname(self.py3venv.__file__)),
+            "import py3venv",
+            "sys.path[:0] = [{!r}]".format(self.first_site),
+            "finder = py3venv.install_module_index('/venv')",
+            "assert 'importlib.util' in sys.modules",
+            "import threading, textwrap, py3venv_idx_mod",
+            "print(py3venv_idx_mod.LOCATION)"])
+        output = subprocess.check_output(
+            [sys.executable, "-I", "-S", "-c", script],
+            env=dict(os.environ, PYTHONDONTWRITEBYTECODE="1"),
+            universal_newlines=True)
+        self.assertEqual(output.strip(),
+                         os.path.join(self.first_site, "py3venv_idx_mod.py"))
+
+    def test_persistent_module_index(self):
+        py3venv = self.py3venv
+        sys.path[:] = [self.first_site, self.second_site]
+        index = py3venv.load_module_index("/venv")
+        self.assertTrue(os.path.isfile(
+            py3venv.make_module_index_cache_path("/venv")))
+
+        py3venv._module_indexes.clear()
+        with mock.patch.object(py3venv, "build_module_index") as build:
+            self.assertEqual(py3venv.load_module_index("/venv"), index)
+            self.assertFalse(build.called)
+
+        py3venv._module_indexes.clear()
+        stat_result = os.stat(self.second_site)
+        os.utime(self.second_site, ns=(stat_result.st_atime_ns,
+                                       stat_result.st_mtime_ns + 10 ** 9))
+        with mock.patch.object(py3venv, "build_module_index",
+                               wraps=py3venv.build_module_index) as build:
+            py3venv.load_module_index("/venv")
+            self.assertTrue(build.called)
+
+
+class TestPreload(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.save_sys_attrs()
+        self.reset_py3venv_state()
+        self.addCleanup(self.unload)
+
+        site_path = os.path.join(self.temp_dir, "site")
+        os.makedirs(site_path)
+        with open(os.path.join(site_path, "py3venv_slow.py"), "w") as file:
+            file.write("import sys\nimport time\n"
+                       "time.sleep(0.2)\n"
+                       "sys.py3venv_slow_count = "
+                       "getattr(sys, 'py3venv_slow_count', 0) + 1\n")
+        with open(os.path.join(site_path, "py3venv_broken.py"), "w") as file:
+            file.write("raise ValueError('broken')\n")
+        sys.path.insert(0, site_path)
+
+    def unload(self):
+        for name in ("py3venv_slow", "py3venv_broken"):
+            sys.modules.pop(name, None)
+        if hasattr(sys, "py3venv_slow_count"):
+            del sys.py3venv_slow_count
+
+    def test_preload(self):
+        py3venv = self.py3venv
+        thread = py3venv.start_preload(["py3venv_slow", "py3venv_broken",
+                                        "py3venv_missing", ""])
+        self.assertIsNotNone(thread)
+
+        # Racing the background thread imports the module only once
+        import py3venv_slow
+        self.assertTrue(py3venv.wait_preload(10))
+        self.assertIs(sys.modules["py3venv_slow"], py3venv_slow)
+        self.assertEqual(sys.py3venv_slow_count, 1)
+
+        report = {entry["name"]: entry
+                  for entry in py3venv.get_preload_report()}
+        self.assertEqual(sorted(report), ["py3venv_broken", "py3venv_missing",
+                                          "py3venv_slow"])
+        self.assertIsNone(report["py3venv_slow"]["error"])
+        self.assertGreater(report["py3venv_slow"]["elapsed"], 0.0)
+        self.assertEqual(report["py3venv_broken"]["error"],
+                         "ValueError: broken")
+        self.assertTrue(report["py3venv_missing"]["error"].startswith(
+            "ModuleNotFoundError"))
+        self.assertIn("py3venv_broken", py3venv.format_preload_report())
+
+    def test_nothing_to_preload(self):
+        py3venv = self.py3venv
+        self.assertIsNone(py3venv.start_preload())
+        self.assertTrue(py3venv.wait_preload())
+        self.assertEqual(py3venv.format_preload_report(),
+                         "py3venv: no modules have been preloaded")
+
+
+class TestDeactivate(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        py3venv = self.py3venv
+        self.save_sys_attrs()
+        self.reset_py3venv_state()
+        patcher = mock.patch.dict(os.environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.venv_prefix = os.path.join(self.temp_dir, "venv")
+        self.site_path = os.path.join(self.venv_prefix,
+                                      py3venv.SITE_PACKAGES_PATH)
+        package_path = os.path.join(self.site_path, "py3venv_deact_pkg")
+        os.makedirs(package_path)
+        with open(os.path.join(package_path, "__init__.py"), "w") as file:
+            file.write("DATA = bytes(1 << 20)\n")
+        with open(os.path.join(package_path, "sub.py"), "w") as file:
+            file.write("from . import DATA\n")
+        with open(os.path.join(self.site_path, "py3venv_deact_finder.py"),
+                  "w") as file:
+            file.write("class Finder:\n"
+                       "    def find_spec(self, *args):\n"
+                       "        return None\n"
+                       "def path_hook(path):\n"
+                       "    return Finder()\n")
+        self.addCleanup(sys.modules.pop, "py3venv_deact_pkg", None)
+        self.addCleanup(sys.modules.pop, "py3venv_deact_pkg.sub", None)
+        self.addCleanup(sys.modules.pop, "py3venv_deact_finder", None)
+        saved_sys_attrs = py3venv.fix_sys_attrs(
+            dict.fromkeys(("meta_path", "path_hooks", "path_importer_cache"),
+                          py3venv.AS_IS))
+        self.addCleanup(py3venv.recover_sys_attrs, saved_sys_attrs)
+
+    def fake_activate(self):
+        py3venv = self.py3venv
+        baseline_path = py3venv.get_baseline_sys_state()["path"]
+        sys.path.insert(0, self.site_path)
+        sys.prefix = self.venv_prefix
+        sys.real_prefix = sys.base_prefix
+        os.environ["VIRTUAL_ENV"] = self.venv_prefix
+        py3venv._current_venv_prefix = self.venv_prefix
+        py3venv._activated_venv_prefix = self.venv_prefix
+        return baseline_path
+
+    def test_deactivate(self):
+        import tracemalloc
+
+        py3venv = self.py3venv
+        os.environ.pop("VIRTUAL_ENV", None)
+        syspath = sys.path
+        prefix = sys.prefix
+        baseline_path = self.fake_activate()
+
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+            self.addCleanup(tracemalloc.stop)
+        import py3venv_deact_pkg.sub
+        import py3venv_deact_finder
+        del py3venv_deact_pkg
+        meta_path = sys.meta_path[:]
+        path_hooks = sys.path_hooks[:]
+        sys.meta_path.insert(0, py3venv_deact_finder.Finder())
+        sys.path_hooks.insert(0, py3venv_deact_finder.path_hook)
+        sys.path_importer_cache[self.site_path] = (
+            py3venv_deact_finder.Finder())
+        del py3venv_deact_finder
+
+        result = py3venv.deactivate()
+        self.assertEqual(result["finders"], 2)
+        self.assertEqual(sys.meta_path, meta_path)
+        self.assertEqual(sys.path_hooks, path_hooks)
+        self.assertNotIn(self.site_path, sys.path_importer_cache)
+        self.assertEqual(result["venv_prefix"], self.venv_prefix)
+        self.assertEqual(result["modules"], ["py3venv_deact_finder",
+                                             "py3venv_deact_pkg",
+                                             "py3venv_deact_pkg.sub"])
+        self.assertEqual(result["unloaded"], 3)
+        self.assertGreater(result["freed"], 1 << 19)
+        self.assertNotIn("py3venv_deact_pkg", sys.modules)
+
+        self.assertIs(sys.path, syspath)
+        self.assertEqual(sys.path, baseline_path)
+        self.assertEqual(sys.prefix, prefix)
+        self.assertFalse(hasattr(sys, "real_prefix"))
+        self.assertNotIn("VIRTUAL_ENV", os.environ)
+        self.assertIsNone(py3venv.get_current_venv_prefix())
+        self.assertIn("unloaded 3 modules and 2 finders",
+                      py3venv.format_deactivation(result))
+
+    def test_nothing_to_deactivate(self):
+        py3venv = self.py3venv
+        self.assertIsNone(py3venv.deactivate())
+        self.assertEqual(py3venv.format_deactivation(None),
+                         "py3venv: no venv is active")
+
+
+class TestVenvResolvers(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        py3venv = self.py3venv
+        self.addCleanup(py3venv.clear_discovery_index)
+        for name in py3venv.RESOLVER_ENVIRON:
+            os.environ.pop(name, None)
+        self.home_dir = os.path.join(self.temp_dir, "home")
+        os.environ["HOME"] = self.home_dir
+        self.project_dir = os.path.join(self.home_dir, "My Project")
+        self.source_dir = os.path.join(self.project_dir, "src")
+        os.makedirs(self.source_dir)
+
+    def make_path_hash(self, path, length):
+        import base64
+        import hashlib
+
+        digest = hashlib.sha256(os.path.realpath(path).encode()).digest()
+        return base64.urlsafe_b64encode(digest[:length]).decode()[:8]
+
+    def test_poetry(self):
+        py3venv = self.py3venv
+        write_file(os.path.join(self.project_dir, "pyproject.toml"),
+                   '[tool.poetry]\nname = "My.Project__x"\n')
+        env_name = "my-project-x-{}-py{}.{}".format(
+            self.make_path_hash(self.project_dir, 32), *sys.version_info)
+        virtualenvs_path = os.path.join(self.home_dir, ".cache", "pypoetry",
+                                        "virtualenvs")
+        self.assertIsNone(py3venv.resolve_poetry_venv(self.project_dir))
+
+        venv_prefix = make_fake_venv(virtualenvs_path, env_name)
+        self.assertEqual(py3venv.find_venv_prefix(self.source_dir),
+                         venv_prefix)
+
+        write_file(os.path.join(self.home_dir, ".config", "pypoetry",
+                                "config.toml"),
+                   '[virtualenvs]\npath = "{cache-dir}/envs"\n')
+        venv_prefix = make_fake_venv(os.path.join(self.home_dir, ".cache",
+                                                  "pypoetry", "envs"),
+                                     env_name)
+        self.assertEqual(py3venv.resolve_poetry_venv(self.project_dir),
+                         venv_prefix)
+
+    def test_pipenv(self):
+        py3venv = self.py3venv
+        write_file(os.path.join(self.project_dir, "Pipfile"))
+        env_name = "My_Project-{}".format(self.make_path_hash(
+            os.path.join(self.project_dir, "Pipfile"), 6))
+        venv_prefix = make_fake_venv(os.path.join(self.home_dir, ".local",
+                                                  "share", "virtualenvs"),
+                                     env_name)
+        self.assertEqual(py3venv.find_venv_prefix(self.source_dir),
+                         venv_prefix)
+
+        os.environ["WORKON_HOME"] = os.path.join(self.temp_dir, "workon")
+        self.assertIsNone(py3venv.resolve_pipenv_venv(self.project_dir))
+        write_file(os.path.join(self.project_dir, ".venv"), "custom\n")
+        venv_prefix = make_fake_venv(os.environ["WORKON_HOME"], "custom")
+        self.assertEqual(py3venv.resolve_pipenv_venv(self.project_dir),
+                         venv_prefix)
+
+    def test_uv(self):
+        py3venv = self.py3venv
+        write_file(os.path.join(self.project_dir, "uv.lock"))
+        os.environ["UV_PROJECT_ENVIRONMENT"] = "env"
+        self.assertIsNone(py3venv.resolve_uv_venv(self.project_dir))
+        venv_prefix = make_fake_venv(self.project_dir, "env")
+        self.assertEqual(py3venv.find_venv_prefix(self.source_dir),
+                         venv_prefix)
+
+    def test_pyenv_virtualenv(self):
+        py3venv = self.py3venv
+        write_file(os.path.join(self.project_dir, ".python-version"),
+                   "3.99.0\nmyenv\n")
+        versions_path = os.path.join(self.home_dir, ".pyenv", "versions")
+        make_fake_venv(os.path.join(versions_path, "3.99.0", "envs"),
+                       "myenv")
+        os.symlink(os.path.join(versions_path, "3.99.0", "envs", "myenv"),
+                   os.path.join(versions_path, "myenv"))
+        self.assertEqual(py3venv.find_venv_prefix(self.source_dir),
+                         os.path.join(versions_path, "myenv"))
+
+    def test_memoization(self):
+        py3venv = self.py3venv
+        write_file(os.path.join(self.project_dir, "uv.lock"))
+        venv_prefix = make_fake_venv(self.project_dir, "env")
+        os.environ["UV_PROJECT_ENVIRONMENT"] = "env"
+        self.assertEqual(py3venv.lookup_managed_venv(self.project_dir, 0.0),
+                         venv_prefix)
+
+        with mock.patch.object(py3venv, "resolve_managed_venv") as resolve:
+            self.assertEqual(
+                py3venv.lookup_managed_venv(self.project_dir, 1.0),
+                venv_prefix)
+            self.assertEqual(
+                py3venv.lookup_managed_venv(self.project_dir, 10.0),
+                venv_prefix)
+            self.assertFalse(resolve.called)
+
+        os.environ["UV_PROJECT_ENVIRONMENT"] = "missing"
+        self.assertIsNone(py3venv.lookup_managed_venv(self.project_dir,
+                                                      20.0))
+
+    def test_directories_without_markers(self):
+        py3venv = self.py3venv
+        self.assertIsNone(py3venv.find_venv_prefix(self.source_dir))
+        now = time.monotonic() + py3venv.DISCOVERY_TTL * 2
+        with mock.patch.object(time, "monotonic", return_value=now), \
+                mock.patch.object(os, "stat", wraps=os.stat) as mock_stat:
+            self.assertIsNone(py3venv.find_venv_prefix(self.source_dir))
+        # Only the directories themselves, no markers in them
+        self.assertEqual(mock_stat.call_count,
+                         len(self.source_dir.split(os.sep)))
+
+        write_file(os.path.join(self.project_dir, "uv.lock"))
+        venv_prefix = make_fake_venv(self.project_dir, ".venv-uv")
+        os.environ["UV_PROJECT_ENVIRONMENT"] = ".venv-uv"
+        now += py3venv.DISCOVERY_TTL * 2
+        with mock.patch.object(time, "monotonic", return_value=now):
+            self.assertEqual(py3venv.find_venv_prefix(self.source_dir),
+                             venv_prefix)
+
+
+class TestWatch(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        py3venv = self.py3venv
+        self.save_sys_attrs()
+        self.venv_prefix = make_fake_venv(self.temp_dir)
+        self.reset_py3venv_state(_current_venv_prefix=self.venv_prefix)
+        self.addCleanup(sys.modules.pop, "py3venv_watched", None)
+
+        self.site_dir = os.path.join(self.venv_prefix,
+                                     py3venv.SITE_PACKAGES_PATH)
+        self.extra_dirs = [os.path.join(self.temp_dir, "extra{}".format(n))
+                           for n in range(3)]
+        for extra_dir in self.extra_dirs:
+            os.makedirs(extra_dir)
+        write_file(os.path.join(self.site_dir, "first.pth"),
+                   self.extra_dirs[0] + "\n")
+        sys.path.extend([self.site_dir, self.extra_dirs[0]])
+
+    def test_watch_tick(self):
+        py3venv = self.py3venv
+        syspath = sys.path
+        self.assertIsNone(py3venv.watch_tick())
+        self.assertEqual(py3venv.get_watch_report()["last_stats"], 2)
+
+        write_file(os.path.join(self.site_dir, "py3venv_watched.py"))
+        write_file(os.path.join(self.site_dir, "second.pth"),
+                   "# comment\n" + self.extra_dirs[1] + "\n")
+        self.assertEqual(py3venv.watch_tick(),
+                         {"added": [self.extra_dirs[1]], "removed": []})
+        self.assertIs(sys.path, syspath)
+        self.assertIn(self.extra_dirs[1], sys.path)
+        import py3venv_watched
+        self.assertEqual(os.path.dirname(py3venv_watched.__file__),
+                         self.site_dir)
+        self.assertIn(self.venv_prefix, py3venv._venv_pool)
+
+        # Rewritten in place, so only the .pth file itself has changed
+        with open(os.path.join(self.site_dir, "second.pth"), "w") as file:
+            file.write(self.extra_dirs[2] + "\n# longer than before\n")
+        self.assertEqual(py3venv.watch_tick(),
+                         {"added": [self.extra_dirs[2]],
+                          "removed": [self.extra_dirs[1]]})
+
+        os.remove(os.path.join(self.site_dir, "first.pth"))
+        self.assertEqual(py3venv.watch_tick(),
+                         {"added": [], "removed": [self.extra_dirs[0]]})
+        self.assertNotIn(self.extra_dirs[0], sys.path)
+
+        report = py3venv.get_watch_report()
+        self.assertEqual(report["ticks"], 4)
+        self.assertEqual(report["refreshes"], 3)
+        self.assertIn("removed: " + self.extra_dirs[0],
+                      py3venv.format_watch_report())
+
+    def test_stat_budget(self):
+        py3venv = self.py3venv
+        for number in range(5):
+            write_file(os.path.join(self.site_dir,
+                                    "extra{}.pth".format(number)))
+        with mock.patch.object(py3venv, "WATCH_STAT_BUDGET", 3):
+            for _ in range(4):
+                self.assertIsNone(py3venv.watch_tick())
+                self.assertLessEqual(
+                    py3venv.get_watch_report()["last_stats"], 3)
+        self.assertEqual(py3venv.get_watch_report()["max_stats"], 3)
+
+    def test_follow_current_venv(self):
+        py3venv = self.py3venv
+        watcher = py3venv.start_watch()
+        py3venv._current_venv_prefix = None
+        self.assertIsNone(py3venv.watch_tick())
+        self.assertIsNone(py3venv.get_watch_report())
+        self.assertIsNotNone(watcher)
+
+
+class TestAudit(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.root = os.path.join(self.temp_dir, "workon")
+        self.good_prefix = make_fake_venv(self.root, "good")
+        self.project_prefix = make_fake_venv(
+            os.path.join(self.root, "project"), ".venv")
+        self.old_prefix = make_fake_venv(self.root, "old")
+        with open(os.path.join(self.old_prefix, "pyvenv.cfg"), "w") as file:
+            file.write("version = 2.7.18\n")
+        os.makedirs(os.path.join(self.root, "not-a-venv"))
+
+    def test_audit(self):
+        import io
+        import json
+
+        py3venv = self.py3venv
+        output = io.StringIO()
+        summary = py3venv.audit([self.root, self.good_prefix,
+                                 os.path.join(self.temp_dir, "missing")],
+                                jobs=4, output=output)
+        results = [json.loads(line)
+                   for line in output.getvalue().splitlines()]
+        self.assertEqual([result["venv_prefix"] for result in results],
+                         [self.good_prefix, self.old_prefix,
+                          self.project_prefix, self.good_prefix])
+        self.assertTrue(results[0]["activatable"])
+        self.assertEqual(results[0]["kind"], "venv")
+        self.assertEqual(results[1]["problems"], ["version mismatch"])
+        self.assertEqual(summary["venvs"], 4)
+        self.assertEqual(summary["activatable"], 3)
+        self.assertGreater(summary["throughput"], 0)
+        self.assertIn("3 activatable, 1 not",
+                      py3venv.format_audit_summary(summary))
+
+    def test_main(self):
+        import io
+
+        py3venv = self.py3venv
+        with mock.patch("sys.stdout", new=io.StringIO()) as stdout, \
+                mock.patch("sys.stderr", new=io.StringIO()) as stderr:
+            self.assertEqual(py3venv.main(["audit", self.good_prefix]), 0)
+            self.assertEqual(py3venv.main(["audit", self.root]), 1)
+        self.assertEqual(len(stdout.getvalue().splitlines()), 4)
+        self.assertIn("venvs/s", stderr.getvalue())
+
+        for jobs in ("0", "-1", "x"):
+            with mock.patch("sys.stderr", new=io.StringIO()) as stderr, \
+                    self.assertRaises(SystemExit) as context:
+                py3venv.main(["audit", "-j", jobs, self.root])
+            self.assertEqual(context.exception.code, 2)
+            self.assertIn("must be a positive integer", stderr.getvalue())
+
+
+class TestProbe(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        py3venv = self.py3venv
+        self.save_sys_attrs()
+        self.reset_py3venv_state()
+
+        self.venv_prefix = make_fake_venv(self.temp_dir)
+        executable = py3venv.make_venv_executable_path(self.venv_prefix)
+        os.remove(executable)
+        os.symlink(os.path.realpath(sys.executable), executable)
+        self.site_dir = os.path.join(self.venv_prefix,
+                                     py3venv.SITE_PACKAGES_PATH)
+
+    def test_probe_venv(self):
+        import subprocess
+
+        py3venv = self.py3venv
+        result = py3venv.probe_venv(self.venv_prefix)
+        self.assertEqual(os.path.realpath(result["prefix"]),
+                         os.path.realpath(self.venv_prefix))
+        self.assertEqual(result["version"], list(sys.version_info[:3]))
+        self.assertIn(self.site_dir, result["site_dirs"])
+        self.assertIn(self.site_dir, result["path"])
+
+        with mock.patch.object(subprocess, "check_output") as check_output:
+            self.assertEqual(py3venv.probe_venv(self.venv_prefix), result)
+            self.assertFalse(check_output.called)
+
+            stat_result = os.stat(self.site_dir)
+            os.utime(self.site_dir, ns=(stat_result.st_atime_ns,
+                                        stat_result.st_mtime_ns + 10 ** 9))
+            self.assertIsNone(py3venv.probe_venv(self.venv_prefix))
+            self.assertTrue(check_output.called)
+
+    def test_async_activation(self):
+        import subprocess
+
+        py3venv = self.py3venv
+        syspath = sys.path
+        write_file(os.path.join(self.site_dir, "hook.pth"),
+                   "import sys; sys._py3venv_probe_hook = 1\n")
+        self.addCleanup(self.py3venv.clear_pth_cache)
+        self.addCleanup(lambda: sys.__dict__.pop("_py3venv_probe_hook",
+                                                 None))
+        with mock.patch.dict(os.environ, {"VIRTUAL_ENV": self.venv_prefix}), \
+                mock.patch.object(py3venv, "activate") as activate:
+            command = py3venv.begin_async_activation()
+            self.assertEqual(py3venv.get_pending_probe_command(), command)
+            self.assertIsNone(py3venv.ensure_activated())
+
+            output = subprocess.check_output(command,
+                                             universal_newlines=True)
+            self.assertEqual(py3venv.end_async_activation(output),
+                             self.venv_prefix)
+            self.assertFalse(activate.called)
+        self.assertEqual(sys._py3venv_probe_hook, 1)
+        self.assertIs(sys.path, syspath)
+        self.assertIn(self.site_dir, sys.path)
+        self.assertEqual(os.path.realpath(sys.prefix),
+                         os.path.realpath(self.venv_prefix))
+        self.assertEqual(py3venv.get_current_venv_prefix(), self.venv_prefix)
+        self.assertIsNone(py3venv.get_pending_probe_command())
+
+    def test_fallback(self):
+        py3venv = self.py3venv
+        with mock.patch.dict(os.environ, {"VIRTUAL_ENV": self.venv_prefix}), \
+                mock.patch.object(py3venv, "activate",
+                                  return_value=None) as activate:
+            self.assertIsNotNone(py3venv.begin_async_activation())
+            self.assertIsNone(py3venv.end_async_activation("not json"))
+            self.assertEqual(activate.call_count, 1)
+
+
+class TestModulesJournal(TempDirTestCase):
+    def test_rollback_failed_site_main(self):
+        import types
+
+        py3venv = self.py3venv
+        self.save_sys_attrs()
+        venv_prefix = make_fake_venv(self.temp_dir)
+        original_site = sys.modules["site"]
+        syspath = sys.path[:]
+        partial_entry = os.path.join(self.temp_dir, "partial")
+        self.addCleanup(sys.modules.pop, "py3venv_partial", None)
+        self.addCleanup(sys.modules.__setitem__, "site", original_site)
+
+        def failing_run_site_main(journal=None):
+            py3venv.journal_module(journal, "site")
+            sys.modules["site"] = types.ModuleType("site")
+            module = types.ModuleType("py3venv_partial")
+            module.__file__ = os.path.join(partial_entry, "partial.py")
+            sys.modules["py3venv_partial"] = module
+            sys.path.append(partial_entry)
+            raise ImportError("broken sitecustomize")
+
+        with mock.patch.dict(os.environ, {"VIRTUAL_ENV": venv_prefix}), \
+                mock.patch.object(py3venv, "run_site_main",
+                                  side_effect=failing_run_site_main), \
+                mock.patch.object(py3venv, "fix_sys_attrs",
+                                  wraps=py3venv.fix_sys_attrs) as fix:
+            self.assertIsNone(py3venv.activate_venv(venv_prefix))
+            for call in fix.call_args_list:
+                self.assertNotIn("modules", call[0][0])
+
+        self.assertIs(sys.modules["site"], original_site)
+        self.assertNotIn("py3venv_partial", sys.modules)
+        self.assertEqual(sys.path, syspath)
+        self.assertEqual(py3venv.get_activation_profile()["rejections"],
+                         [{"path": "venv", "reason": "site.main() failed: "
+                           "broken sitecustomize"}])
+
+
+class TestPrecompile(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        py3venv = self.py3venv
+        self.reset_py3venv_state(PRECOMPILE_BYTECODE=True,
+                                 PRECOMPILE_WORKERS=1)
+        patcher = mock.patch.object(sys, "pycache_prefix", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.venv_prefix = make_fake_venv(self.temp_dir)
+        executable = py3venv.make_venv_executable_path(self.venv_prefix)
+        os.remove(executable)
+        os.symlink(os.path.realpath(sys.executable), executable)
+        self.site_dir = os.path.join(self.venv_prefix,
+                                     py3venv.SITE_PACKAGES_PATH)
+        write_file(os.path.join(self.site_dir, "module.py"), "VALUE = 1\n")
+        write_file(os.path.join(self.site_dir, "package", "__init__.py"))
+        write_file(os.path.join(self.site_dir, "broken.py"), "def (:\n")
+
+    def precompile(self):
+        thread = self.py3venv.start_precompile(self.venv_prefix)
+        self.assertIsNotNone(thread)
+        thread.join(60)
+        report = self.py3venv.get_precompile_report()
+        self.assertFalse(report["running"])
+        return report
+
+    def test_precompile(self):
+        import importlib.util
+
+        py3venv = self.py3venv
+        self.assertIsNone(py3venv.start_precompile(None))
+        report = self.precompile()
+        self.assertEqual(report["sources"], 3)
+        self.assertEqual(report["compiled"], 3)
+        self.assertEqual(report["errors"], 1)
+        self.assertIsNone(report["pycache_prefix"])
+        self.assertTrue(os.path.isfile(importlib.util.cache_from_source(
+            os.path.join(self.site_dir, "module.py"))))
+        self.assertIn("3 stale of 3 source files compiled, 1 errors",
+                      py3venv.format_precompile_report())
+
+        # Only the file which still can't be compiled is stale
+        self.assertEqual(self.precompile()["compiled"], 1)
+
+    def test_user_cache(self):
+        py3venv = self.py3venv
+        with mock.patch.object(py3venv, "PRECOMPILE_USER_CACHE", True), \
+                mock.patch("os.access", return_value=False):
+            report = self.precompile()
+        pycache_prefix = os.path.join(py3venv.get_cache_dir(), "pycache")
+        self.assertEqual(report["pycache_prefix"], pycache_prefix)
+        self.assertEqual(sys.pycache_prefix, pycache_prefix)
+        self.assertFalse(os.path.isdir(os.path.join(self.site_dir,
+                                                    "__pycache__")))
+        self.assertTrue(os.path.isdir(pycache_prefix))
+
+        # Only while the read-only venv is the current one
+        self.save_sys_attrs()
+        py3venv._current_venv_prefix = self.venv_prefix
+        py3venv.remember_venv_state(self.venv_prefix)
+        self.assertIsNone(py3venv.switch_venv(None))
+        self.assertIsNone(sys.pycache_prefix)
+        self.assertEqual(py3venv.switch_venv(self.venv_prefix),
+                         self.venv_prefix)
+        self.assertEqual(sys.pycache_prefix, pycache_prefix)
+        py3venv.restore_pycache_prefix()
+        self.assertIsNone(sys.pycache_prefix)
+
+
+class TestZipSnapshot(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        py3venv = self.py3venv
+        self.save_sys_attrs()
+        self.reset_py3venv_state(ZIP_SITE_PACKAGES=True)
+        self.addCleanup(self.release)
+        self.addCleanup(self.unload)
+
+        self.venv_prefix = make_fake_venv(self.temp_dir)
+        self.site_dir = os.path.join(self.venv_prefix,
+                                     py3venv.SITE_PACKAGES_PATH)
+        for path, content in (
+                ("py3venv_zpkg/__init__.py", "VALUE = 1\n"),
+                ("py3venv_zpkg/sub.py", "from . import VALUE\n"),
+                ("py3venv_zpkg/py.typed", ""),
+                ("py3venv_zmod.py", "VALUE = 2\n"),
+                ("py3venv_zext/__init__.py", ""),
+                ("py3venv_zext/_speedups.so", ""),
+                ("py3venv_zdata/__init__.py", ""),
+                ("py3venv_zdata/data.txt", ""),
+                ("py3venv_zold.py", "print 'python 2'\n"),
+                ("py3venv_z-1.0.dist-info/METADATA", "")):
+            write_file(os.path.join(self.site_dir, path), content)
+
+    def unload(self):
+        for name in ("py3venv_zpkg", "py3venv_zpkg.sub", "py3venv_zmod"):
+            sys.modules.pop(name, None)
+
+    def release(self):
+        for zip_file in self.py3venv._zip_snapshot_files.values():
+            zip_file.close()
+        self.py3venv._zip_snapshot_files.clear()
+
+    def test_find_pure_python_files(self):
+        packages = self.py3venv.find_pure_python_files(self.site_dir)
+        self.assertEqual(sorted(packages), ["py3venv_zmod", "py3venv_zold",
+                                            "py3venv_zpkg"])
+        self.assertEqual(sorted(arcname for arcname, path
+                                in packages["py3venv_zpkg"]),
+                         ["py3venv_zpkg/__init__.py",
+                          "py3venv_zpkg/py.typed",
+                          "py3venv_zpkg/sub.py"])
+
+    def test_apply_zip_snapshot(self):
+        import builtins
+        import zipimport
+
+        py3venv = self.py3venv
+        sys.path.append(self.site_dir)
+        self.assertIsNone(py3venv.apply_zip_snapshot(self.venv_prefix))
+        py3venv._zip_build_threads[self.venv_prefix].join(60)
+
+        fingerprint = py3venv.make_venv_fingerprint(self.venv_prefix,
+                                                    check_activated=False)
+        zip_path = py3venv.apply_zip_snapshot(self.venv_prefix)
+        self.assertEqual(zip_path,
+                         py3venv.make_zip_snapshot_path(self.venv_prefix,
+                                                        fingerprint))
+        self.assertEqual(sys.path.index(zip_path) + 1,
+                         sys.path.index(self.site_dir))
+        self.assertEqual(py3venv.apply_zip_snapshot(self.venv_prefix),
+                         zip_path)
+        self.assertEqual(sys.path.count(zip_path), 1)
+
+        # Served from the bytecode in the archive
+        with mock.patch.object(builtins, "compile",
+                               wraps=builtins.compile) as mock_compile:
+            import py3venv_zpkg.sub
+            import py3venv_zmod
+            self.assertFalse(mock_compile.called)
+        self.assertIsInstance(py3venv_zpkg.__loader__, zipimport.zipimporter)
+        self.assertTrue(py3venv_zpkg.sub.__file__.startswith(zip_path))
+        self.assertEqual(py3venv_zmod.VALUE, 2)
+
+        write_file(os.path.join(self.site_dir, "py3venv_znew.py"))
+        fingerprint = py3venv.make_venv_fingerprint(self.venv_prefix,
+                                                    check_activated=False)
+        self.assertIsNone(py3venv.load_zip_snapshot(self.venv_prefix,
+                                                    fingerprint))
+
+    def test_archives_in_use_are_kept(self):
+        py3venv = self.py3venv
+        sys.path.append(self.site_dir)
+        old_zip_path = py3venv.build_zip_snapshot(self.venv_prefix)
+        self.assertEqual(py3venv.apply_zip_snapshot(self.venv_prefix),
+                         old_zip_path)
+        inode = os.stat(old_zip_path).st_ino
+        self.assertEqual(py3venv.build_zip_snapshot(self.venv_prefix),
+                         old_zip_path)
+        self.assertEqual(os.stat(old_zip_path).st_ino, inode)
+
+        write_file(os.path.join(self.site_dir, "py3venv_znew.py"))
+        new_zip_path = py3venv.build_zip_snapshot(self.venv_prefix)
+        self.assertNotEqual(new_zip_path, old_zip_path)
+        self.assertTrue(os.path.isfile(old_zip_path))
+        import py3venv_zmod
+        self.assertTrue(py3venv_zmod.__file__.startswith(old_zip_path))
+
+        self.release()
+        write_file(os.path.join(self.site_dir, "py3venv_znew2.py"))
+        py3venv.build_zip_snapshot(self.venv_prefix)
+        self.assertFalse(os.path.exists(old_zip_path))
+        self.assertFalse(os.path.exists(new_zip_path))
+
+
+class TestCatalog(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        py3venv = self.py3venv
+        patcher = mock.patch.object(py3venv, "_catalog", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ["HOME"] = os.path.join(self.temp_dir, "home")
+        os.environ["WORKON_HOME"] = os.path.join(self.temp_dir, "workon")
+        self.extra_root = os.path.join(self.temp_dir, "projects")
+
+        self.good_prefix = make_fake_venv(os.environ["WORKON_HOME"], "good")
+        old_prefix = make_fake_venv(os.environ["WORKON_HOME"], "old")
+        with open(os.path.join(old_prefix, "pyvenv.cfg"), "w") as file:
+            file.write("version = 2.7.18\n")
+        self.project_prefix = make_fake_venv(
+            os.path.join(self.extra_root, "project"), ".venv")
+
+    def test_complete_venvs(self):
+        py3venv = self.py3venv
+        self.assertEqual(py3venv.complete_venvs("", [self.extra_root]),
+                         [self.project_prefix, self.good_prefix])
+        self.assertEqual(py3venv.complete_venvs("go"), [self.good_prefix])
+        self.assertEqual(py3venv.complete_venvs(self.extra_root,
+                                                [self.extra_root]),
+                         [self.project_prefix])
+        self.assertEqual(py3venv.complete_venvs("old"), [])
+
+        entries = {entry["venv_prefix"]: entry
+                   for entry in py3venv.refresh_catalog()}
+        self.assertEqual(entries[self.good_prefix]["kind"], "venv")
+        self.assertEqual(entries[self.good_prefix]["version"],
+                         "{0}.{1}.{2}".format(*sys.version_info))
+        self.assertNotIn(self.project_prefix, entries)
+
+    def test_incremental_refresh(self):
+        py3venv = self.py3venv
+        self.assertEqual(len(py3venv.refresh_catalog()), 2)
+
+        with mock.patch.object(py3venv, "audit_venv",
+                               wraps=py3venv.audit_venv) as audit_venv:
+            self.assertEqual(len(py3venv.refresh_catalog()), 2)
+            self.assertFalse(audit_venv.called)
+
+            new_prefix = make_fake_venv(os.environ["WORKON_HOME"], "new")
+            stat_result = os.stat(os.environ["WORKON_HOME"])
+            os.utime(os.environ["WORKON_HOME"],
+                     ns=(stat_result.st_atime_ns,
+                         stat_result.st_mtime_ns + 10 ** 9))
+            self.assertEqual(len(py3venv.refresh_catalog()), 3)
+            audit_venv.assert_called_once_with(new_prefix)
+
+            # Loaded from the cache directory in a new session
+            py3venv._catalog = None
+            self.assertEqual(py3venv.complete_venvs("n"), [new_prefix])
+            self.assertEqual(audit_venv.call_count, 1)
+
+    def test_find_catalog_venv(self):
+        py3venv = self.py3venv
+        self.assertEqual(py3venv.find_catalog_venv("good"),
+                         self.good_prefix)
+        self.assertEqual(py3venv.find_catalog_venv(self.project_prefix),
+                         self.project_prefix)
+        self.assertIsNone(py3venv.find_catalog_venv("old"))
+        self.assertIsNone(py3venv.find_catalog_venv("missing"))